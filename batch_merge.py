@@ -0,0 +1,189 @@
+"""Batch finalization: join the per-stage output files into one record per image.
+
+Each stage writes its own pipe file for a batch, with its own header:
+
+    Outputs/{batch}/{batch}_APN.txt
+    Outputs/{batch}/{batch}_Mailing.txt
+    Outputs/{batch}/{batch}_Legal.txt
+    output/processed/{batch}/{batch}_Property.txt
+
+`merge_batch` sort-merge joins them on ImageName into
+`Outputs/{batch}/{batch}_Merged.txt`. Every file is externally sorted in runs
+of MERGE_RUN_ROWS lines, so memory stays bounded for any batch size. Stage
+columns are prefixed with the stage name (`Legal.APN_AIN`), an image missing
+from a stage gets empty cells, and when a stage has several rows for an
+image (a reprocessed document) the last one written wins.
+"""
+import heapq
+import os
+import tempfile
+from itertools import groupby
+from typing import Dict, Iterator, List, Tuple
+
+from config import OUTPUTS_DIR, PROPERTY_OUTPUT_DIR, MERGE_RUN_ROWS
+from journal import compact_output
+from parquet_export import close_exports
+
+KEY_COLUMNS = ["ImageName", "BatchName", "ImageHeaderID"]
+STAGES = ["APN", "Property", "Mailing", "Legal"]
+
+# Statuses that mean a document has left the pipeline
+DONE_STATUSES = ["legalpassed", "error"]
+
+# Every stage names a document's batch the same way, so their files and the backlog agree
+BATCH_FIELD = "cat_name"
+FALLBACK_BATCH_FIELD = "foldername"
+DEFAULT_BATCH_NAME = "06107-20241205-01"
+
+
+def batch_name_of(doc) -> str:
+    """Batch a queue document belongs to: its cat_name, else its foldername."""
+    return doc.get(BATCH_FIELD) or doc.get(FALLBACK_BATCH_FIELD) or DEFAULT_BATCH_NAME
+
+
+def stage_output_files(batch_name: str) -> Dict[str, str]:
+    """Pipe file of every stage for a batch."""
+    files = {stage: os.path.join(OUTPUTS_DIR, batch_name, f"{batch_name}_{stage}.txt") for stage in STAGES}
+    files["Property"] = os.path.join(PROPERTY_OUTPUT_DIR, batch_name, f"{batch_name}_Property.txt")
+    return files
+
+
+def _write_run(rows: List[Tuple[str, int, str]], directory: str) -> str:
+    rows.sort()
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, suffix=".run", delete=False) as f:
+        for image_name, seq, line in rows:
+            f.write(f"{image_name}\t{seq}\t{line}\n")
+    return f.name
+
+
+def _read_run(path: str) -> Iterator[Tuple[str, int, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for record in f:
+            image_name, seq, line = record.rstrip("\n").split("\t", 2)
+            yield image_name, int(seq), line
+
+
+def sorted_rows(path: str, run_rows: int = MERGE_RUN_ROWS) -> Tuple[List[str], Iterator[Tuple[str, List[str]]], List[str]]:
+    """Header and (image_name, cells) rows of a pipe file in ImageName order, one row per image.
+
+    :return: (columns, row iterator, temporary run files to delete afterwards)
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        columns = f.readline().rstrip("\r\n").split("|")
+        image_index = columns.index("ImageName")
+        runs, rows = [], []
+        for seq, line in enumerate(f):
+            line = line.rstrip("\r\n")
+            cells = line.split("|")
+            if len(cells) != len(columns):
+                continue
+            rows.append((cells[image_index], seq, line))
+            if len(rows) >= run_rows:
+                runs.append(_write_run(rows, os.path.dirname(path)))
+                rows = []
+        if rows:
+            runs.append(_write_run(rows, os.path.dirname(path)))
+
+    def latest_per_image():
+        merged = heapq.merge(*(_read_run(run) for run in runs))
+        for image_name, group in groupby(merged, key=lambda row: row[0]):
+            *_, (_, _, line) = group
+            yield image_name, line.split("|")
+
+    return columns, latest_per_image(), runs
+
+
+def _tag(rows: Iterator[Tuple[str, List[str]]], position: int) -> Iterator[Tuple[str, int, List[str]]]:
+    for image_name, cells in rows:
+        yield image_name, position, cells
+
+
+def merge_batch(batch_name: str, run_rows: int = MERGE_RUN_ROWS) -> str:
+    """Join the batch's stage files on ImageName into {batch}_Merged.txt.
+
+    :return: Path of the merged file, or None when no stage file exists
+    """
+    files = {stage: path for stage, path in stage_output_files(batch_name).items() if os.path.exists(path)}
+    if not files:
+        print(f"No stage outputs found for batch {batch_name}")
+        return None
+
+    streams, temp_files = [], []
+    header = list(KEY_COLUMNS)
+    try:
+        for position, (stage, path) in enumerate(files.items()):
+            columns, rows, runs = sorted_rows(path, run_rows)
+            temp_files += runs
+            value_columns = [i for i, column in enumerate(columns) if column not in KEY_COLUMNS]
+            header += [f"{stage}.{columns[i]}" for i in value_columns]
+            header_id_index = columns.index("ImageHeaderID") if "ImageHeaderID" in columns else None
+            tagged = _tag(rows, position)
+            streams.append((value_columns, header_id_index, tagged))
+
+        output_file = os.path.join(OUTPUTS_DIR, batch_name, f"{batch_name}_Merged.txt")
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        partial_file = output_file + ".partial"
+        images = 0
+        with open(partial_file, "w", encoding="utf-8") as out:
+            out.write("|".join(header) + "\n")
+            merged = heapq.merge(*(tagged for _, _, tagged in streams), key=lambda row: (row[0], row[1]))
+            for image_name, group in groupby(merged, key=lambda row: row[0]):
+                by_stage = {position: cells for _, position, cells in group}
+                key_cells = [image_name, batch_name, "1"]
+                values = []
+                for position, (value_columns, header_id_index, _) in enumerate(streams):
+                    cells = by_stage.get(position)
+                    if cells is None:
+                        values += [""] * len(value_columns)
+                        continue
+                    if header_id_index is not None:
+                        key_cells[2] = cells[header_id_index]
+                    values += [cells[i] for i in value_columns]
+                out.write("|".join(key_cells + values) + "\n")
+                images += 1
+        os.replace(partial_file, output_file)
+    finally:
+        for run in temp_files:
+            if os.path.exists(run):
+                os.remove(run)
+
+    print(f"Merged {len(files)} stage outputs for batch {batch_name} into {output_file} ({images} images)")
+    return output_file
+
+
+def batch_backlog(collection, batch_name: str) -> int:
+    """Documents of the batch still moving through the pipeline."""
+    return collection.count_documents({
+        "$or": [
+            {BATCH_FIELD: batch_name},
+            {BATCH_FIELD: {"$in": [None, ""]}, FALLBACK_BATCH_FIELD: batch_name}
+        ],
+        "status": {"$nin": DONE_STATUSES}
+    })
+
+
+def finalize_batches(collection, batch_names, writer=None, compact_stages=()) -> List[str]:
+    """Merge every batch in `batch_names` whose backlog has reached zero.
+
+    :param writer: OutputWriter that owns the files of `compact_stages`
+    :param compact_stages: Stages whose files this process writes; superseded
+        lines are dropped from them through `writer` before merging
+    :return: Paths of the merged files written
+    """
+    merged = []
+    for batch_name in sorted(set(batch_names)):
+        try:
+            if batch_backlog(collection, batch_name) > 0:
+                continue
+            # The batch is complete, so its Parquet parts get no more rows
+            close_exports([batch_name])
+            stage_files = stage_output_files(batch_name)
+            for stage in compact_stages:
+                if writer is not None and os.path.exists(stage_files[stage]):
+                    writer.rewrite(stage_files[stage], compact_output).result()
+            output_file = merge_batch(batch_name)
+            if output_file:
+                merged.append(output_file)
+        except Exception as e:
+            print(f"Error finalizing batch {batch_name}: {str(e)}")
+    return merged
@@ -0,0 +1,181 @@
+"""Adaptive (AIMD) concurrency control for Claude requests.
+
+A fixed worker count is wrong in both directions for a workload that is
+almost entirely waiting on the API: too few requests in flight on a small
+box, 429 storms on a large one. AIMDLimiter gates every `messages.create`
+call. While all its slots are busy, it adds one slot per window of fast,
+error-free responses; it halves the limit on 429/529/timeouts, at most once
+per cooldown period.
+
+`limit_client` wraps an Anthropic client so existing call sites keep calling
+`client.messages.create(...)` unchanged. The wrapped client's own retries
+are turned off: the limiter has to see every overload, and an SDK retry
+sleep would be measured as latency. The limiter retries overloaded calls
+itself, outside its slots, and also retries the transient failures the SDK
+would have (500/502, dropped connections) without lowering the limit.
+"""
+import os
+import random
+import threading
+import time
+
+CLAUDE_INITIAL_CONCURRENCY = int(os.getenv("CLAUDE_INITIAL_CONCURRENCY", "4"))
+CLAUDE_MIN_CONCURRENCY = int(os.getenv("CLAUDE_MIN_CONCURRENCY", "1"))
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "64"))
+CLAUDE_MAX_RETRIES = int(os.getenv("CLAUDE_MAX_RETRIES", "2"))
+
+# First retry delay after an overload, doubled on each further attempt (seconds)
+RETRY_BACKOFF = 1.0
+
+# Status codes treated as "back off": rate limited, overloaded, unavailable
+OVERLOAD_STATUS_CODES = {429, 503, 529}
+
+# Status codes retried without backing off: server error, bad gateway
+TRANSIENT_STATUS_CODES = {500, 502}
+
+
+def is_overload_error(error: Exception) -> bool:
+    """True for rate-limit, overload and timeout errors from the API client."""
+    if getattr(error, "status_code", None) in OVERLOAD_STATUS_CODES:
+        return True
+    return "Timeout" in type(error).__name__ or isinstance(error, TimeoutError)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """True for server errors and dropped connections, which say nothing about load."""
+    if getattr(error, "status_code", None) in TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ == "APIConnectionError" or isinstance(error, ConnectionError)
+
+
+class AIMDLimiter:
+    """Additive-increase / multiplicative-decrease limit on in-flight calls."""
+
+    def __init__(self, initial: int = CLAUDE_INITIAL_CONCURRENCY, min_limit: int = CLAUDE_MIN_CONCURRENCY,
+                 max_limit: int = CLAUDE_MAX_CONCURRENCY, decrease_factor: float = 0.5,
+                 latency_tolerance: float = 1.5, cooldown: float = 5.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._baseline_latency = None
+        self._latency_ewma = None
+        self._last_decrease = 0.0
+        self._successes = 0
+        self._overloads = 0
+
+    @property
+    def current_limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record_success(self, latency: float):
+        with self._condition:
+            self._successes += 1
+            self._latency_ewma = latency if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency
+            # Baseline follows the fastest responses seen and drifts up slowly
+            if self._baseline_latency is None or latency < self._baseline_latency:
+                self._baseline_latency = latency
+            else:
+                self._baseline_latency *= 1.01
+
+            # Only grow a limit that is actually in use; this call still holds its slot
+            saturated = self._in_flight >= int(self._limit)
+            if saturated and self._latency_ewma <= self._baseline_latency * self.latency_tolerance:
+                # +1 slot per `limit` successful calls
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+                self._condition.notify_all()
+
+    def record_overload(self):
+        with self._condition:
+            self._overloads += 1
+            now = time.time()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+            print(f"Claude overloaded, concurrency limit reduced to {self.current_limit}")
+
+    def call(self, fn, *args, max_retries: int = CLAUDE_MAX_RETRIES, **kwargs):
+        """Run `fn` inside a slot and feed its latency or failure back into the limit.
+
+        Overloaded and transient failures are retried up to `max_retries` times with
+        exponential backoff; only overloads lower the limit.
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire()
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if is_overload_error(e):
+                    self.record_overload()
+                elif not is_transient_error(e):
+                    raise
+                if attempt == max_retries:
+                    raise
+            else:
+                self.record_success(time.time() - start)
+                return result
+            finally:
+                self.release()
+            time.sleep(RETRY_BACKOFF * 2 ** attempt * (0.5 + random.random()))
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                "concurrency_limit": self.current_limit,
+                "in_flight": self._in_flight,
+                "successes": self._successes,
+                "overloads": self._overloads,
+                "latency_ewma": round(self._latency_ewma, 3) if self._latency_ewma else None
+            }
+
+
+class _LimitedMessages:
+    def __init__(self, messages, limiter: AIMDLimiter):
+        self._messages = messages
+        self._limiter = limiter
+
+    def create(self, **kwargs):
+        return self._limiter.call(self._messages.create, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._messages, name)
+
+
+class LimitedClient:
+    """Anthropic client proxy whose messages.create goes through a limiter."""
+
+    def __init__(self, client, limiter: AIMDLimiter):
+        self._client = client
+        self.messages = _LimitedMessages(client.messages, limiter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# Shared by every stage in the process so they back off together
+API_LIMITER = AIMDLimiter()
+
+
+def limit_client(client, limiter: AIMDLimiter = API_LIMITER) -> LimitedClient:
+    """Wrap `client`, with its own retries disabled, so its calls go through `limiter`."""
+    if hasattr(client, "with_options"):
+        client = client.with_options(max_retries=0)
+    return LimitedClient(client, limiter)
@@ -17,6 +17,24 @@ MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "admin"
 COLLECTION_NAME = "images"
 OUTPUT_COLLECTION = "output_legal"
+NEAR_DUP_COLLECTION = "near_duplicates"
+
+# Orchestrator Configuration
+ORCHESTRATOR_QUEUE_SIZE = int(os.getenv('ORCHESTRATOR_QUEUE_SIZE', '32'))
+ORCHESTRATOR_WORKERS = int(os.getenv('ORCHESTRATOR_WORKERS', '8'))
+ORCHESTRATOR_POLL_INTERVAL = float(os.getenv('ORCHESTRATOR_POLL_INTERVAL', '5'))
+
+# Streaming intake: Mongo cursor batch size and documents in flight
+INTAKE_BATCH_SIZE = int(os.getenv('INTAKE_BATCH_SIZE', '100'))
+INTAKE_WINDOW = int(os.getenv('INTAKE_WINDOW', '64'))
+
+# Legal results collected into one columnar ResultBatch before they are written
+RESULT_BATCH_SIZE = int(os.getenv('RESULT_BATCH_SIZE', '200'))
+
+# Batch finalization: stage output directories and rows per sorted run when merging
+OUTPUTS_DIR = "Outputs"
+PROPERTY_OUTPUT_DIR = os.path.join(os.getcwd(), "output", "processed")
+MERGE_RUN_ROWS = int(os.getenv('MERGE_RUN_ROWS', '50000'))
 
 if not all([AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, ANTHROPIC_API_KEY, MONGO_URI]):
     raise ValueError("Required credentials not found in environment variables")
@@ -65,6 +83,10 @@ DOCUMENT TYPE STANDARDIZATION:
    CM = CONDOMINIUM MAP
        Required: Map Book, Map Page
        Optional: Unit Numbers
+   
+   NC = NOTICE OF COMPLETION
+       Required: APN, Document Number
+       Optional: Lot Number, Tract Number
 
 2. Format Standards:
    Document Numbers:
@@ -135,7 +157,7 @@ Remember:
 - Cross-reference all identifiers
 - Better to mark N than accept incorrect format'''
 
-def get_extraction_prompt(extracted_text: str, field_instructions: str) -> str:
+def get_extraction_prompt(extracted_text: str, field_instructions: str, response_instructions: str) -> str:
     return f"""Analyze this legal document with these specific rules:
 
 DOCUMENT IDENTIFICATION:
@@ -195,11 +217,4 @@ EXTRACTION REQUIREMENTS:
 4. Document numbers must match recording info
 5. APNs must match legal description
 
-Return in JSON format:
-{{
-    "FIELD_NAME": {{
-        "value": "EXTRACTED_VALUE",
-        "confidence": 0-100,
-        "flags": ["EXTRACTION_NOTES"]
-    }}
-}}""" 
\ No newline at end of file
+{response_instructions}"""
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""Near-duplicate detection over OCR text with result reuse.
+
+Recorder batches repeat the same boilerplate cover sheets and near-identical
+re-recordings. Each processed document's normalized OCR text is reduced to a
+64-bit SimHash and stored in Mongo together with its extraction. A new
+document whose SimHash is within NEAR_DUP_MAX_DISTANCE bits of a stored one is
+linked to it. Form-identical documents for different parcels are near
+duplicates too, so what is reused depends on the document's identifiers
+(every token containing a digit: APN, lot, tract, map and document numbers):
+
+    same identifiers       a re-scan or re-recording; everything but the
+                           DOCUMENT_SPECIFIC_FIELDS is reused
+    different identifiers  only the FORM_FIELDS (wording-level fields that hold
+                           no parcel or legal-description identifier) are reused
+
+Lookups use four 16-bit bands: two hashes within 3 bits of each other always
+share at least one band exactly, so candidates come from one indexed query.
+"""
+import hashlib
+import re
+import time
+from typing import Dict, List, Optional
+
+NEAR_DUP_MAX_DISTANCE = 3
+SHINGLE_SIZE = 3
+BAND_BITS = 16
+BAND_COUNT = 64 // BAND_BITS
+
+# Fields that identify the recorded instrument itself and are never reused
+DOCUMENT_SPECIFIC_FIELDS = {
+    "legal": ["Plat_Document_Number", "CaseNo", "Legal_Extract_Complete_Flag"],
+    "apn": [],
+    "mailing": [],
+    "property": []
+}
+
+# Fields reused from a near-duplicate whose identifiers differ
+FORM_FIELDS = {
+    "legal": ["Meridian", "Fee_Easment", "Condo_Timeshare_Flag", "Parking_Space_Garage_Seperately_conveyed",
+              "Parking_Space_Garage_apartment", "Filler", "Timeshare_reserve_for_future",
+              "Timeshare_reserve_for_future1", "Timeshare_reserve_for_future2", "Timeshare_reserve_for_future3",
+              "Timeshare_Unit_Type", "Timeshare_Use_Period"],
+    "apn": [],
+    "mailing": [],
+    "property": []
+}
+
+_NON_ALNUM = re.compile(r"[^A-Z0-9]+")
+
+
+def normalize_text(text) -> str:
+    """Uppercase, drop punctuation and collapse whitespace."""
+    if isinstance(text, list):
+        text = " ".join(str(item) for item in text)
+    return _NON_ALNUM.sub(" ", str(text).upper()).strip()
+
+
+def simhash(text) -> int:
+    """64-bit SimHash over word shingles of the normalized text."""
+    words = normalize_text(text).split()
+    if len(words) < SHINGLE_SIZE:
+        shingles = [" ".join(words)] if words else []
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    result = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            result |= 1 << bit
+    return result
+
+
+def identifier_hash(text) -> str:
+    """Hash of the document's tokens that contain a digit, in order."""
+    tokens = [token for token in normalize_text(text).split() if any(char.isdigit() for char in token)]
+    return hashlib.blake2b(" ".join(tokens).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def band_keys(value: int) -> List[str]:
+    mask = (1 << BAND_BITS) - 1
+    return [f"{band}:{value >> (band * BAND_BITS) & mask:04x}" for band in range(BAND_COUNT)]
+
+
+class NearDuplicateIndex:
+    """SimHash index persisted in a Mongo collection."""
+
+    def __init__(self, collection, max_distance: int = NEAR_DUP_MAX_DISTANCE):
+        self.collection = collection
+        self.max_distance = max_distance
+        self.collection.create_index([("stage", 1), ("bands", 1)])
+
+    def find(self, stage: str, text) -> Optional[Dict]:
+        """Return the closest stored entry within max_distance, or None.
+
+        The entry's `same_identifiers` says whether both documents carry the same identifiers.
+        """
+        value = simhash(text)
+        best, best_distance = None, self.max_distance + 1
+        candidates = self.collection.find({"stage": stage, "bands": {"$in": band_keys(value)}})
+        for candidate in candidates:
+            distance = hamming_distance(value, int(candidate["simhash"], 16))
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+
+        if best is not None:
+            best["distance"] = best_distance
+            best["same_identifiers"] = best.get("identifiers") == identifier_hash(text)
+        return best
+
+    def add(self, stage: str, doc_id, text, processed_data: Dict, filename: str = None,
+            batch_name: str = None):
+        """Store a processed document so later near-duplicates can reuse it."""
+        value = simhash(text)
+        self.collection.update_one(
+            {"_id": f"{stage}:{doc_id}"},
+            {"$set": {
+                "stage": stage,
+                "doc_id": doc_id,
+                "simhash": f"{value:016x}",
+                "bands": band_keys(value),
+                "identifiers": identifier_hash(text),
+                "filename": filename,
+                "batch_name": batch_name,
+                "processed_data": processed_data,
+                "indexed_at": time.time()
+            }},
+            upsert=True
+        )
+
+
+def reusable_fields(stage: str, field_names: List[str], same_identifiers: bool = False) -> List[str]:
+    """Fields that can be copied from a near-duplicate for `stage`."""
+    if not same_identifiers:
+        form_fields = set(FORM_FIELDS.get(stage, []))
+        return [field for field in field_names if field in form_fields]
+    specific = set(DOCUMENT_SPECIFIC_FIELDS.get(stage, []))
+    return [field for field in field_names if field not in specific]
+
+
+def reuse_near_duplicate(stage: str, match: Dict, field_names: List[str], extract_fields) -> Dict:
+    """Build a stage result from a near-duplicate plus a partial extraction.
+
+    :param stage: Stage name used to pick the document-specific fields
+    :param match: Entry returned by NearDuplicateIndex.find
+    :param field_names: All fields of the stage, in output order
+    :param extract_fields: Callable extracting a list of fields for this document
+    :return: formatted_response with every field in field_names
+    """
+    prior = match.get("processed_data") or {}
+    reused = set(reusable_fields(stage, field_names, match.get("same_identifiers", False)))
+
+    processed_data = {}
+    for field in reused:
+        field_data = dict(prior.get(field) or {"value": "", "confidence": 0, "flags": []})
+        field_data["flags"] = list(field_data.get("flags") or []) + ["NEAR_DUPLICATE_REUSED"]
+        processed_data[field] = field_data
+
+    remaining = [field for field in field_names if field not in reused]
+    if remaining:
+        processed_data.update(extract_fields(remaining))
+
+    return {field: processed_data[field] for field in field_names}
@@ -2,10 +2,36 @@ import boto3
 from anthropic import Anthropic
 from PIL import Image
 import io
-import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 from config import *
 from field_definitions import FIELD_INSTRUCTIONS, FIELD_GROUPS
+from singleflight import coalesce_by_text
+from concurrency import limit_client
+from text_prep import estimate_tokens
+from journal import prompt_version
+from legal_chunking import LEGAL_CHUNK_TOKENS, LEGAL_CHUNK_WORKERS, chunk_pages, reduce_candidates
+from llm_schema import (build_compact_tool, compact_instructions, compile_compact_decoder,
+                        estimate_max_tokens, forced_tool_choice, get_tool_input)
+
+@functools.lru_cache(maxsize=32)
+def legal_extraction_plan(fields: tuple):
+    """Tool, decoder and max_tokens for extracting `fields` from FIELD_GROUPS."""
+    instructions = {field: FIELD_INSTRUCTIONS[field] for field in fields}
+    tool = build_compact_tool(
+        "record_legal_fields",
+        "Record the extracted legal description fields with confidence and flags.",
+        instructions
+    )
+    return tool, compile_compact_decoder(instructions, name="LegalResult"), estimate_max_tokens(instructions)
+
+LEGAL_TOOL, decode_legal_response, LEGAL_MAX_TOKENS = legal_extraction_plan(tuple(FIELD_GROUPS))
+LEGAL_MODEL = "claude-3-sonnet-20240229"
+
+# Journal key component: changes whenever the prompt, fields, tool or model change
+LEGAL_PROMPT_VERSION = prompt_version(
+    SYSTEM_PROMPT, get_extraction_prompt("", "", ""), FIELD_INSTRUCTIONS, LEGAL_TOOL, LEGAL_MODEL)
 
 class LegalDocumentProcessor:
     def __init__(self):
@@ -15,7 +41,7 @@ class LegalDocumentProcessor:
             aws_secret_access_key=AWS_SECRET_KEY,
             region_name=AWS_REGION
         )
-        self.anthropic = Anthropic(api_key=ANTHROPIC_API_KEY)
+        self.anthropic = limit_client(Anthropic(api_key=ANTHROPIC_API_KEY))
 
     def extract_text_with_textract(self, images: List[Image.Image]) -> Dict:
         """Process images with AWS Textract and return combined text."""
@@ -38,11 +64,46 @@ class LegalDocumentProcessor:
         
         return {"text": combined_text}
 
-    def post_process_with_llm(self, extracted_data: Dict) -> Dict:
-        # Add document structure hints
+    @coalesce_by_text("legal")
+    def post_process_with_llm(self, extracted_data: Dict, fields: List[str] = None) -> Dict:
+        """Extract the legal fields, or only `fields` when a subset is given.
+
+        Documents longer than LEGAL_CHUNK_TOKENS are split into page windows
+        that are extracted in parallel and merged by reduce_candidates.
+        """
+        fields = tuple(fields or FIELD_GROUPS)
         text = extracted_data.get('text', '')
-        structured_text = f"""DOCUMENT ANALYSIS REQUEST:
 
+        if estimate_tokens(text) <= LEGAL_CHUNK_TOKENS:
+            return self.extract_window(text, fields)
+
+        windows = chunk_pages(text)
+        print(f"Long document: extracting {len(windows)} windows in parallel")
+        with ThreadPoolExecutor(max_workers=LEGAL_CHUNK_WORKERS) as executor:
+            window_results = list(executor.map(
+                lambda item: self.extract_window(item[1], fields, item[0] + 1, len(windows)),
+                enumerate(windows)
+            ))
+        merged = reduce_candidates(window_results, list(fields))
+
+        # A failed window means the merge may be missing values; keep that visible
+        if any("LLM_PROCESSING_ERROR" in (result[field].get("flags") or [])
+               for result in window_results for field in fields):
+            for field_data in merged.values():
+                field_data["flags"].append("LLM_PROCESSING_ERROR")
+        return merged
+
+    def extract_window(self, text: str, fields: tuple, part: int = 1, part_count: int = 1) -> Dict:
+        """Run one extraction request over `text` for `fields`."""
+        tool, decode_response, max_tokens = legal_extraction_plan(fields)
+
+        # Add document structure hints
+        part_note = ""
+        if part_count > 1:
+            part_note = (f"\nThis is part {part} of {part_count} of a longer document. "
+                         "Extract only what appears in this part.\n")
+        structured_text = f"""DOCUMENT ANALYSIS REQUEST:
+{part_note}
 Document Content:
 {text}
 
@@ -56,51 +117,34 @@ Pay special attention to:
 
 """
         field_instructions_text = "\n".join([
-            f"- {field}:\n"
+            f"- [{index}] {field}:\n"
             f"  Description: {details['description']}\n"
             f"  Format: {details.get('format', 'No specific format')}\n"
             f"  Max Length: {details.get('max_length', 'Not specified')}\n"
             f"  Required Format Examples: {details.get('examples', 'N/A')}"
-            for field, details in FIELD_INSTRUCTIONS.items()
+            for index, (field, details) in enumerate((field, FIELD_INSTRUCTIONS[field]) for field in fields)
         ])
 
-        prompt = get_extraction_prompt(structured_text, field_instructions_text)
+        prompt = get_extraction_prompt(structured_text, field_instructions_text,
+                                       compact_instructions(tool))
         
         try:
             message = self.anthropic.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=4096,
+                model=LEGAL_MODEL,
+                max_tokens=max_tokens,
                 temperature=0.1,
                 top_p=0.9,
                 top_k=50,
                 system=SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": prompt}]
+                messages=[{"role": "user", "content": prompt}],
+                tools=[tool],
+                tool_choice=forced_tool_choice(tool)
             )
 
-            response_text = message.content[0].text
-            print(897,response_text)
-            start_index = response_text.find('{')
-            end_index = response_text.rfind('}') + 1
-            
-            if start_index == -1 or end_index == 0:
-                return {field: {"value": None, "confidence": 0, "flags": ["EXTRACTION_FAILED"]} 
-                        for field in FIELD_GROUPS}
-            
-            json_response = response_text[start_index:end_index]
-            parsed_response = json.loads(json_response)
-            
-            formatted_response = {}
-            for field in FIELD_GROUPS:
-                field_data = parsed_response.get(field, {})
-                formatted_response[field] = {
-                    "value": str(field_data.get("value", "")).upper() if field_data.get("value") else "",
-                    "confidence": field_data.get("confidence", 0),
-                    "flags": [str(flag).upper() for flag in field_data.get("flags", ["NO_FLAGS"])]
-                }
-            return formatted_response
+            return decode_response(get_tool_input(message, tool["name"]))
 
         except Exception as e:
             print(f"Error in LLM processing: {str(e)}")
             return {field: {"value": None, "confidence": 0, "flags": ["LLM_PROCESSING_ERROR"]}
-                    for field in FIELD_GROUPS} 
+                    for field in fields} 
             
\ No newline at end of file
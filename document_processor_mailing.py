@@ -8,6 +8,21 @@ import io
 from anthropic import Anthropic
 from pymongo import MongoClient
 import time
+from singleflight import coalesce_by_text
+from concurrency import limit_client
+from text_prep import prepare_document_text
+from output_writer import get_output_writer
+from row_format import ColumnPlan
+from parquet_export import export_result, close_expired_exports
+from batch_merge import batch_name_of
+from payload_store import PAYLOAD_COLLECTION, PayloadStore
+from schema_registry import SCHEMA_COLLECTION, SchemaRegistry, stage_output
+from raw_document import raw_collection
+from field_validation import FieldValidator
+from zip_reference import reconcile_address
+from document_type import document_type_of, route_for
+from llm_schema import (build_compact_tool, compact_instructions, compile_compact_decoder,
+                        estimate_max_tokens, forced_tool_choice, get_tool_input)
 
 # Load environment variables
 load_dotenv()
@@ -35,23 +50,21 @@ textract_client = boto3.client(
     region_name=REGION
 )
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+anthropic_client = limit_client(Anthropic(api_key=ANTHROPIC_API_KEY))
 
-# MongoDB setup with error handling
-try:
-    mongo_client = MongoClient(MONGO_URI)
-    # Test the connection
-    mongo_client.admin.command('ping')
-    print("Successfully connected to MongoDB")
-    
-    db = mongo_client.Documenttask
-    collection = db.imagesdemo_erl
-    
-except Exception as e:
-    print(f"Error connecting to MongoDB: {str(e)}")
-    print("Please check your MONGO_URI in .env file")
-    print("Current MONGO_URI:", MONGO_URI)
-    raise
+def connect_mongo() -> MongoClient:
+    """Connect the standalone service to MongoDB; the orchestrator passes its own collections in."""
+    try:
+        mongo_client = MongoClient(MONGO_URI)
+        # Test the connection
+        mongo_client.admin.command('ping')
+        print("Successfully connected to MongoDB")
+        return mongo_client
+    except Exception as e:
+        print(f"Error connecting to MongoDB: {str(e)}")
+        print("Please check your MONGO_URI in .env file")
+        print("Current MONGO_URI:", MONGO_URI)
+        raise
 
 # Define required fields at module level
 REQUIRED_FIELDS = [
@@ -61,35 +74,28 @@ REQUIRED_FIELDS = [
     "Carrier_Route", "Latitude", "Longitude", "Census_Tract_block"
 ]
 
+MAILING_TOOL = build_compact_tool(
+    "record_mailing_address",
+    "Record the parsed mailing address fields with confidence and flags.",
+    REQUIRED_FIELDS
+)
+decode_mailing_response = compile_compact_decoder(REQUIRED_FIELDS, missing_value="NONE", name="MailingResult")
+MAILING_MAX_TOKENS = estimate_max_tokens(REQUIRED_FIELDS)
+MAILING_VALIDATOR = FieldValidator(REQUIRED_FIELDS)
+
 def generate_header():
     """Generate header for mailing output file"""
     return "ImageName|BatchName|ImageHeaderID|Mailing_Address_Level|Care_Of|House_Number_Alpha|House_Alpha|Pre_Direction|Street_Name|Street_Suffix|Post_Direction|Unit_Designator|Unit_Number|City|State|Zip|Zip_4|Carrier_Route|Latitude|Longitude|Census_Tract_block|CL_Mailing_Address_Level|CL_Care_Of|CL_House_Number_Alpha|CL_House_Alpha|CL_Pre_Direction|CL_Street_Name|CL_Street_Suffix|CL_Post_Direction|CL_Unit_Designator|CL_Unit_Number|CL_City|CL_State|CL_Zip|CL_Zip_4|CL_Carrier_Route|CL_Latitude|CL_Longitude|CL_Census_Tract_block|ReferenceId|SourceId"
 
+# ReferenceId and SourceId are left empty
+MAILING_PLAN = ColumnPlan(generate_header(), REQUIRED_FIELDS, {"ReferenceId": "", "SourceId": ""},
+                          missing_value="NONE")
+
 def format_output(image_name: str, batch_name: str, image_header_id: str, processed_data: Dict) -> str:
     """Format output line with all fields"""
-    fields = [image_name, batch_name, image_header_id]
-    
-    # Add all data fields
-    data_fields = ["Mailing_Address_Level", "Care_Of", "House_Number_Alpha", "House_Alpha", 
-                  "Pre_Direction", "Street_Name", "Street_Suffix", "Post_Direction", 
-                  "Unit_Designator", "Unit_Number", "City", "State", "Zip", "Zip_4",
-                  "Carrier_Route", "Latitude", "Longitude", "Census_Tract_block"]
-    
-    # Add values
-    for field in data_fields:
-        value = processed_data.get(field, {}).get('value', 'NONE')
-        fields.append(str(value))
-    
-    # Add confidence levels
-    for field in data_fields:
-        confidence = processed_data.get(field, {}).get('confidence', 0)
-        fields.append("HIGH" if confidence >= 90 else "LOW")
-    
-    # Add empty ReferenceId and SourceId
-    fields.extend(["", ""])
-    
-    return "|".join(fields)
+    return MAILING_PLAN.format_row(image_name, batch_name, image_header_id, processed_data)
 
+@coalesce_by_text("mailing")
 def post_process_with_claude(extracted_data: Dict) -> Dict:
     """Process extracted text with Claude 3.5 Sonnet"""
     text = extracted_data["text"]
@@ -134,47 +140,24 @@ CRITICAL REQUIREMENTS:
    - Care_Of: Full C/O or ATTN line
    - Remove from other fields
 
-ALL VALUES MUST BE UPPERCASE. Use "NONE" for missing fields.
-Return a clean JSON object with value and confidence for each field."""
+ALL VALUES MUST BE UPPERCASE.
+{}"""
 
     try:
         message = anthropic_client.messages.create(
             model="claude-3-sonnet-20240229",
-            max_tokens=4096,
+            max_tokens=MAILING_MAX_TOKENS,
             temperature=0.1,
-            system="You are an expert address parser. Return clean, valid JSON with all required fields.",
+            system="You are an expert address parser. Record every required field with the provided tool.",
             messages=[{
                 "role": "user", 
-                "content": prompt.format(text)
-            }]
+                "content": prompt.format(text, compact_instructions(MAILING_TOOL))
+            }],
+            tools=[MAILING_TOOL],
+            tool_choice=forced_tool_choice(MAILING_TOOL)
         )
         
-        # Extract and clean JSON response
-        response_text = message.content[0].text
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        if json_start == -1 or json_end == 0:
-            raise ValueError("No valid JSON found in response")
-            
-        json_str = response_text[json_start:json_end]
-        parsed_data = json.loads(json_str)
-        
-        # Ensure all required fields are present
-        for field in REQUIRED_FIELDS:
-            if field not in parsed_data:
-                parsed_data[field] = {
-                    "value": "NONE",
-                    "confidence": 0,
-                    "flags": ["FIELD_NOT_FOUND"]
-                }
-            elif not isinstance(parsed_data[field], dict):
-                parsed_data[field] = {
-                    "value": str(parsed_data[field]).upper(),
-                    "confidence": 95,
-                    "flags": ["VALUE_NORMALIZED"]
-                }
-        
-        return parsed_data
+        return decode_mailing_response(get_tool_input(message, MAILING_TOOL["name"]))
         
     except Exception as e:
         print(f"Claude processing error: {str(e)}")
@@ -182,76 +165,85 @@ Return a clean JSON object with value and confidence for each field."""
                 for field in REQUIRED_FIELDS}
 
 def write_output_file(output_schema: str, output_line: str, batch_name: str):
-    """Write output to file with proper directory handling"""
-    try:
-        # Create output directory if it doesn't exist
-        output_dir = os.path.join("Outputs", batch_name)
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Define output file path
-        output_file = os.path.join(output_dir, f"{batch_name}_Mailing.txt")
-        
-        # Write header if file doesn't exist or is empty
-        write_header = False
-        if not os.path.exists(output_file):
-            write_header = True
-        else:
-            # Check if file is empty or missing header
-            with open(output_file, 'r', encoding='utf-8') as f:
-                first_line = f.readline().strip()
-                if not first_line or first_line != output_schema:
-                    write_header = True
-        
-        if write_header:
-            # Write header and output line
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(output_schema + "\n")
-                f.write(output_line + "\n")
-            print(f"Created new file with header: {output_file}")
-        else:
-            # Append only output line
-            with open(output_file, 'a', encoding='utf-8') as f:
-                f.write(output_line + "\n")
-            print(f"Appended to existing file: {output_file}")
-            
-    except Exception as e:
-        print(f"Error writing output file: {str(e)}")
-        raise
+    """Append a line to the batch's mailing output file; raises if it could not be written"""
+    output_file = os.path.join("Outputs", batch_name, f"{batch_name}_Mailing.txt")
+    get_output_writer().write(output_file, output_schema, output_line).result()
+
+def build_mailing_output(doc, processed_data: Dict) -> Dict:
+    """Format one document's mailing result: Mongo fields, output file and line."""
+    image_name = doc.get('filename', 'unknown.TIF')
+    batch_name = batch_name_of(doc)
+    MAILING_VALIDATOR.validate(processed_data)
+    reconcile_address(processed_data)
+    output_schema = generate_header()
+    output_line = format_output(image_name, batch_name, "1", processed_data)
+    
+    return {
+        "updates": {
+            "processed_data": processed_data,
+            "output_legal": stage_output(
+                output_schema, output_line,
+                processed_at=time.time(),
+                process_type="mailing",
+                metadata={
+                    "image_name": image_name,
+                    "batch_name": batch_name,
+                    "header_id": "1"
+                },
+                processing_details={
+                    "success": True,
+                    "error": None
+                }
+            )
+        },
+        "batch_name": batch_name,
+        "output_file": os.path.join("Outputs", batch_name, f"{batch_name}_Mailing.txt"),
+        "output_schema": output_schema,
+        "output_line": output_line,
+        "plan": MAILING_PLAN,
+        "row": (image_name, batch_name, "1", processed_data)
+    }
 
 def process_ocr_data():
     """Monitor MongoDB collection and process documents with legalpassed status"""
     print("Starting mailing address processing service...")
+    mongo_client = connect_mongo()
+    try:
+        run_mailing_service(mongo_client)
+    finally:
+        mongo_client.close()
+
+def run_mailing_service(mongo_client: MongoClient):
+    """Poll the standalone service's collection until interrupted."""
+    db = mongo_client.Documenttask
+    collection = db.imagesdemo_erl
+    payload_store = PayloadStore(db[PAYLOAD_COLLECTION])
     print(f"Connected to MongoDB database: {db.name}")
     print(f"Monitoring collection: {collection.name}")
+    SchemaRegistry(db[SCHEMA_COLLECTION]).register(generate_header(), "mailing")
     
     while True:
         try:
             query = {"status": "legalpassed"}
-            unprocessed_docs = collection.find(query)
+            unprocessed_docs = raw_collection(collection).find(query)
             count = collection.count_documents(query)
             print(f"\nFound {count} documents with legalpassed status")
             
             for doc in unprocessed_docs:
+                doc = payload_store.lazy(doc)
                 try:
                     # Debug document structure
                     print(f"\nProcessing document: {doc['_id']}")
                     print("Document fields:", list(doc.keys()))
                     
-                    # Try to get OCR text from different possible fields
-                    text_content = None
+                    # Merge the OCR text sources and strip boilerplate
+                    text_content, _ = prepare_document_text(doc)
                     
-                    # Check ocr_text field first
-                    if 'ocr_text' in doc:
-                        text_content = doc['ocr_text']
-                    # Fallback to ocr_output if needed
-                    elif 'ocr_output' in doc:
-                        ocr_output = doc['ocr_output']
-                        if isinstance(ocr_output, dict):
-                            text_content = ocr_output.get('text', '')
-                        elif isinstance(ocr_output, list):
-                            text_content = ' '.join(str(item) for item in ocr_output)
-                        else:
-                            text_content = str(ocr_output)
+                    document_type = document_type_of(doc, text_content)
+                    if "mailing" not in route_for(document_type).stages:
+                        print(f"Skipping mailing extraction for document type {document_type.code}")
+                        collection.update_one({"_id": doc['_id']}, {"$set": {"status": "mailingpassed"}})
+                        continue
                     
                     # Debug OCR content
                     print("OCR text type:", type(text_content))
@@ -263,38 +255,18 @@ def process_ocr_data():
                     processed_data = post_process_with_claude({"text": str(text_content)})
                     
                     # Debug Claude response
-                    print("Claude Response Sample:", json.dumps(processed_data, indent=2)[:200])
+                    print("Claude Response Sample:", json.dumps(processed_data, indent=2, default=dict)[:200])
                     
-                    image_name = doc.get('filename', 'unknown.TIF')
-                    batch_name = doc.get('cat_name', '06107-20241205-01')
-                    output_schema = generate_header()
-                    output_line = format_output(image_name, batch_name, "1", processed_data)
+                    result = build_mailing_output(doc, processed_data)
                     
                     # Write output to file
-                    write_output_file(output_schema, output_line, batch_name)
+                    write_output_file(result["output_schema"], result["output_line"], result["batch_name"])
+                    export_result(result)
                     
                     # Update MongoDB
                     collection.update_one(
                         {"_id": doc['_id']},
-                        {"$set": {
-                            "status": "mailingpassed",
-                            "processed_data": processed_data,
-                            "output_legal": {
-                                "schema": output_schema,
-                                "value": output_line,
-                                "processed_at": time.time(),
-                                "process_type": "mailing",
-                                "metadata": {
-                                    "image_name": image_name,
-                                    "batch_name": batch_name,
-                                    "header_id": "1"
-                                },
-                                "processing_details": {
-                                    "success": True,
-                                    "error": None
-                                }
-                            }
-                        }}
+                        payload_store.offload_update({"status": "mailingpassed", **result["updates"]})
                     )
                     
                     print(f"Successfully processed document {doc['_id']}")
@@ -310,6 +282,7 @@ def process_ocr_data():
                         }}
                     )
             
+            close_expired_exports()
             time.sleep(10)
             
         except Exception as e:
@@ -323,5 +296,3 @@ if __name__ == "__main__":
         print("\nStopping mailing address processing service...")
     except Exception as e:
         print(f"Fatal error: {str(e)}")
-    finally:
-        mongo_client.close() 
\ No newline at end of file
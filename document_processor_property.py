@@ -10,7 +10,13 @@ from anthropic import Anthropic
 import concurrent.futures
 import logging
 from datetime import datetime
-from property_processor import format_output, generate_header, FIELD_INSTRUCTIONS, FIELD_GROUPS
+from property_processor import format_output, generate_header, FIELD_INSTRUCTIONS, FIELD_GROUPS, PROPERTY_PLAN
+from singleflight import coalesce_by_text
+from concurrency import API_LIMITER, limit_client
+from output_writer import get_output_writer
+from llm_schema import (build_compact_tool, compact_instructions, compile_compact_decoder,
+                        estimate_max_tokens, forced_tool_choice, get_tool_input)
+from journal import OutputJournal, prompt_version
 
 # Configure logging
 logging.basicConfig(
@@ -38,18 +44,30 @@ textract_client = boto3.client(
     region_name=REGION
 )
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+anthropic_client = limit_client(Anthropic(api_key=ANTHROPIC_API_KEY))
 
 # System prompt and field instructions remain the same as in your code
 # ... (keep your existing FIELD_INSTRUCTIONS and FIELD_GROUPS)
 
+METADATA_TOOL = build_compact_tool(
+    "record_document_fields",
+    "Record the extracted document fields with confidence and flags.",
+    FIELD_INSTRUCTIONS
+)
+decode_metadata_response = compile_compact_decoder(FIELD_INSTRUCTIONS, name="MetadataResult")
+METADATA_MAX_TOKENS = estimate_max_tokens(FIELD_INSTRUCTIONS)
+METADATA_MODEL = "claude-3-haiku-20240307"
+METADATA_SYSTEM_PROMPT = "You are an expert in document analysis and metadata extraction for legal and real estate documents."
+METADATA_PROMPT_VERSION = prompt_version(METADATA_SYSTEM_PROMPT, FIELD_INSTRUCTIONS, METADATA_TOOL, METADATA_MODEL)
+
+@coalesce_by_text("metadata")
 def post_process_with_llm(extracted_data: Dict) -> Dict:
     field_instructions_text = "\n".join([
-        f"- {field}:\n"
+        f"- [{index}] {field}:\n"
         f"  Description: {details['description']}\n"
         f"  Format: {details.get('format', 'No specific format')}\n"
         f"  Max Length: {details.get('max_length', 'Not specified')}"
-        for field, details in FIELD_INSTRUCTIONS.items()
+        for index, (field, details) in enumerate(FIELD_INSTRUCTIONS.items())
     ])
 
     prompt = f"""Analyze the following document text and extract the specified fields. Here are the field specifications:
@@ -61,84 +79,78 @@ Document Text:
 
 EXTRACTION RULES:
 1. ALL VALUES MUST BE IN UPPERCASE
-2. If a field is not found, set its confidence to 0 and add appropriate flags
+2. If a field is not found, leave it out
 3. If a field is found but doesn't match the format specifications, flag it
 
-Return the analysis in JSON format with field_name, value, confidence (0-100), and flags."""
+{compact_instructions(METADATA_TOOL)}"""
 
     try:
         response = anthropic_client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=4096,
+            model=METADATA_MODEL,
+            max_tokens=METADATA_MAX_TOKENS,
             temperature=0.2,
-            system="You are an expert in document analysis and metadata extraction for legal and real estate documents.",
-            messages=[{"role": "user", "content": prompt}]
+            system=METADATA_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": prompt}],
+            tools=[METADATA_TOOL],
+            tool_choice=forced_tool_choice(METADATA_TOOL)
         )
 
-        # Parse the response
-        response_text = response.content[0].text
-        
-        # Extract JSON from response
-        start_index = response_text.find('{')
-        end_index = response_text.rfind('}') + 1
-        
-        if start_index == -1 or end_index == 0:
-            logging.error("No valid JSON found in response")
-            return {field: {"value": None, "confidence": 0, "flags": ["EXTRACTION_FAILED"]} for field in FIELD_GROUPS}
-        
         try:
-            json_response = response_text[start_index:end_index]
-            parsed_response = json.loads(json_response)
-            
-            formatted_response = {}
-            for field in FIELD_GROUPS:
-                field_data = parsed_response.get(field, {})
-                formatted_response[field] = {
-                    "value": str(field_data.get("value", "")).upper() if field_data.get("value") else "",
-                    "confidence": field_data.get("confidence", 0),
-                    "flags": [str(flag).upper() for flag in field_data.get("flags", ["NO_FLAGS"])]
-                }
-            return formatted_response
-            
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing JSON: {str(e)}")
-            return {field: {"value": None, "confidence": 0, "flags": ["JSON_PARSING_ERROR"]} for field in FIELD_GROUPS}
+            return decode_metadata_response(get_tool_input(response, METADATA_TOOL["name"]))
+        except ValueError as e:
+            logging.error(f"Error validating response: {str(e)}")
+            return {field: {"value": None, "confidence": 0, "flags": ["EXTRACTION_FAILED"]} for field in FIELD_GROUPS}
 
     except Exception as e:
         logging.error(f"Error calling Claude: {str(e)}")
         return {field: {"value": None, "confidence": 0, "flags": ["CLAUDE_API_ERROR"]} for field in FIELD_GROUPS}
 
-def process_batch(file_paths: List[str], output_file: str):
+def journal_id(file_path: str) -> str:
+    """Journal key of a document file: its batch folder and file name."""
+    return f"{os.path.basename(os.path.dirname(file_path))}/{os.path.basename(file_path)}"
+
+def process_batch(file_paths: List[str], output_file: str, journal: OutputJournal = None):
     """Process a batch of documents concurrently"""
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(process_documents, file_path): file_path for file_path in file_paths}
-        
-        with open(output_file, "a") as f:
-            for future in concurrent.futures.as_completed(futures):
-                file_path = futures[future]
-                try:
-                    result = future.result()
-                    image_name = os.path.basename(file_path)
-                    batch_name = os.path.basename(os.path.dirname(file_path))
-                    output_line = format_output(image_name, batch_name, "1", result)
-                    f.write(output_line + "\n")
-                    logging.info(f"Successfully processed {image_name}")
-                except Exception as e:
-                    logging.error(f"Error processing {file_path}: {str(e)}")
-                    error_output = f"{os.path.basename(file_path)}|{os.path.basename(os.path.dirname(file_path))}|1" + "|ERROR" * (len(FIELD_GROUPS) * 2)
-                    f.write(error_output + "\n")
+    writer = get_output_writer()
+    header = generate_header()
+
+    # Files journaled by an earlier run reuse their line instead of calling Claude again
+    pending = []
+    for file_path in file_paths:
+        entry = journal.get(journal_id(file_path)) if journal is not None else None
+        if entry is not None and entry["state"] == "done":
+            writer.write(output_file, header, entry["payload"]["output_line"])
+        else:
+            pending.append(file_path)
+    if len(pending) < len(file_paths):
+        logging.info(f"Skipped {len(file_paths) - len(pending)} documents already in the journal")
+
+    # Claude calls are gated by API_LIMITER, so the pool only needs enough threads to fill it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=API_LIMITER.max_limit) as executor:
+        futures = {executor.submit(process_documents, file_path): file_path for file_path in pending}
+        for future in concurrent.futures.as_completed(futures):
+            file_path = futures[future]
+            try:
+                result = future.result()
+                image_name = os.path.basename(file_path)
+                batch_name = os.path.basename(os.path.dirname(file_path))
+                output_line = format_output(image_name, batch_name, "1", result)
+                writer.write(output_file, header, output_line).result()
+                if journal is not None:
+                    journal.record(journal_id(file_path), "done", {"output_line": output_line})
+                logging.info(f"Successfully processed {image_name}")
+            except Exception as e:
+                logging.error(f"Error processing {file_path}: {str(e)}")
+                error_output = PROPERTY_PLAN.error_row(os.path.basename(file_path), os.path.basename(os.path.dirname(file_path)), "1")
+                writer.write(output_file, header, error_output)
 
 def process_documents(input_directory: str, output_directory: str, batch_size: int = 100):
     """Process all documents in batches"""
     os.makedirs(output_directory, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_file = os.path.join(output_directory, f"processed_documents_{timestamp}.txt")
+    journal = OutputJournal("metadata", METADATA_PROMPT_VERSION)
     
-    # Write header
-    with open(output_file, "w") as f:
-        f.write(generate_header() + "\n")
-
-
     # Get all document files
     files = [os.path.join(input_directory, f) for f in os.listdir(input_directory) 
              if f.lower().endswith(('.tif', '.tiff', '.pdf'))]
@@ -147,7 +159,9 @@ def process_documents(input_directory: str, output_directory: str, batch_size: i
     for i in range(0, len(files), batch_size):
         batch = files[i:i + batch_size]
         logging.info(f"Processing batch {i//batch_size + 1} of {len(files)//batch_size + 1}")
-        process_batch(batch, output_file)
+        process_batch(batch, output_file, journal)
+    get_output_writer().flush()
+    journal.close()
 
 # Keep your existing helper functions (convert_document_to_images, extract_text_with_textract, 
 # format_output, generate_header) as they are
@@ -0,0 +1,431 @@
+"""Document-type classification at intake and per-type stage routing.
+
+Every document used to walk every stage, so a Notice of Completion still
+went through the full 64-field legal extraction. The type is decided
+locally from the title area of the OCR text, where recorders print it:
+
+    rules   weighted title patterns per type (GRANT DEED, NOTICE OF COMPLETION, ...)
+    model   optional hashed bag-of-words linear model trained on reviewed
+            labels (`python document_type.py train`), used when no rule is sure
+
+A rule match only counts as the title when it sits in the first TITLE_CHARS
+of the text and is not a reference to another instrument ("under the Deed
+of Trust"). A document whose best match is not a title stays below
+DOCTYPE_MIN_CONFIDENCE.
+
+The codes are those of config.SYSTEM_PROMPT.
+The intake stage stores the classification on the document as
+`document_type` ({"Legal_Type", "confidence", "source"}); the legal result's
+Legal_Type takes the code too when SYSTEM_PROMPT defines it. ROUTES then give
+each type the fan-out stages it runs (APN always runs) and the legal fields
+worth asking Claude for. Fields a route leaves out are returned empty and
+flagged NOT_APPLICABLE. Below DOCTYPE_MIN_CONFIDENCE a document takes the
+full route.
+"""
+import csv
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from dedup_index import normalize_text
+from field_definitions import FIELD_GROUPS
+from result_types import FieldResult
+from text_prep import prepare_document_text
+
+DOCTYPE_MODEL_PATH = os.getenv("DOCTYPE_MODEL_PATH", os.path.join("reference", "doctype_model.json"))
+# Reviewed document types, one "ImageName,Legal_Type" row per image
+DOCTYPE_LABELS_PATH = os.getenv("DOCTYPE_LABELS_PATH", os.path.join("reference", "doctype_labels.csv"))
+DOCTYPE_MIN_CONFIDENCE = int(os.getenv("DOCTYPE_MIN_CONFIDENCE", "80"))
+
+# Recorders print the title in the first lines; later text quotes other instruments
+CLASSIFY_CHARS = 2000
+# Title matches start within this many normalized characters, after the recorder's header
+TITLE_CHARS = 800
+# Confidence ceiling when no rule match is a title, below DOCTYPE_MIN_CONFIDENCE
+REFERENCE_CONFIDENCE = 60
+# Words before a match that make it a reference to another instrument rather than a title
+REFERENCE_WORDS = ("THE", "SAID", "CERTAIN", "A", "AN", "UNDER", "SUCH", "PRIOR")
+
+NOT_APPLICABLE_FLAG = "NOT_APPLICABLE"
+CLASSIFIER_FLAG = "DOCUMENT_TYPE_CLASSIFIER"
+
+# Title patterns over normalize_text output (uppercase, punctuation -> space) and their weights
+DOCUMENT_TYPE_RULES = {
+    "DO": [(r"DEED OF TRUST", 3)],
+    "GD": [(r"GRANT DEED", 3), (r"INDIVIDUAL GRANT DEED|CORPORATION GRANT DEED", 4)],
+    "CL": [(r"CERTIFICATE OF LIEN", 3)],
+    "ML": [(r"MECHANIC ?S? LIEN", 3), (r"CLAIM OF (?:MECHANIC ?S? )?LIEN", 3)],
+    "RL": [(r"RELEASE OF (?:MECHANIC ?S? )?LIEN", 4), (r"LIEN RELEASE", 4), (r"(?:FULL )?RECONVEYANCE", 4)],
+    "AF": [(r"AFFIDAVIT", 2)],
+    "TD": [(r"TRUST DEED", 3)],
+    "QC": [(r"QUIT ?CLAIM DEED", 4)],
+    "SD": [(r"SUBDIVISION MAP", 3), (r"(?:FINAL|TRACT) MAP", 2)],
+    "CM": [(r"CONDOMINIUM (?:PLAN|MAP)", 4)],
+    "NC": [(r"NOTICE OF COMPLETION", 4)],
+}
+
+# Legal fields of the recorded instrument itself
+RECORDING_FIELDS = ["Legal_Extract_Level", "Legal_Type", "Plat_Document_Number", "CaseNo", "APN_AIN",
+                    "Legal_Extract_Complete_Flag"]
+LOT_FIELDS = ["Lot_Tract_Number", "LotNumber", "Block", "TractNumber", "UnitNumber", "Parcel"]
+MAP_FIELDS = ["Map_Book", "Map_Page_From", "Map_Page_Thru", "Map_Date", "Map_Name", "Map_Number",
+              "TractNumber", "PhaseValue", "Common_Area_Lot"]
+CONDO_PLAN_FIELDS = ["Condo_Timeshare_Flag", "Condo_Time_Share_Plan_Book", "Condo_Time_Share_Plan_Date",
+                     "Condo_Time_Share_Plan_Number", "Condo_Time_Share_Plan_Page_From",
+                     "Condo_Time_Share_Plan_Page_Thru", "Building", "UnitNumber"]
+
+FANOUT_STAGES = ("property", "mailing", "legal")
+
+
+class Route(NamedTuple):
+    stages: frozenset
+    legal_fields: Optional[tuple]  # None means every legal field
+
+
+def _route(stages: Iterable[str], legal_fields: Iterable[str] = None) -> Route:
+    if legal_fields is None:
+        return Route(frozenset(stages), None)
+    wanted = set(legal_fields)
+    return Route(frozenset(stages), tuple(field for field in FIELD_GROUPS if field in wanted))
+
+
+FULL_ROUTE = _route(FANOUT_STAGES)
+
+ROUTES = {
+    "DO": FULL_ROUTE,
+    "GD": FULL_ROUTE,
+    "TD": FULL_ROUTE,
+    "QC": FULL_ROUTE,
+    "CL": _route(FANOUT_STAGES, RECORDING_FIELDS + LOT_FIELDS),
+    "ML": _route(FANOUT_STAGES, RECORDING_FIELDS + LOT_FIELDS),
+    "RL": _route(FANOUT_STAGES, RECORDING_FIELDS + LOT_FIELDS),
+    "NC": _route(FANOUT_STAGES, RECORDING_FIELDS + LOT_FIELDS),
+    "AF": _route(FANOUT_STAGES, RECORDING_FIELDS),
+    # Maps describe many lots and have neither a mailing nor a single property address
+    "SD": _route(["legal"], RECORDING_FIELDS + MAP_FIELDS),
+    "CM": _route(["legal"], RECORDING_FIELDS + MAP_FIELDS + CONDO_PLAN_FIELDS),
+}
+
+
+class Classification(NamedTuple):
+    code: Optional[str]
+    confidence: int
+    source: str
+
+    @property
+    def confident(self) -> bool:
+        return self.code is not None and self.confidence >= DOCTYPE_MIN_CONFIDENCE
+
+    def to_dict(self) -> Dict:
+        return {"Legal_Type": self.code, "confidence": self.confidence, "source": self.source}
+
+    @classmethod
+    def from_dict(cls, data: Mapping) -> "Classification":
+        return cls(data.get("Legal_Type"), int(data.get("confidence") or 0), data.get("source") or "stored")
+
+
+UNKNOWN = Classification(None, 0, "none")
+
+
+def title_text(text) -> str:
+    """Normalized title area of a document's OCR text."""
+    if isinstance(text, list):
+        text = " ".join(str(item) for item in text)
+    return normalize_text(str(text or "")[:CLASSIFY_CHARS])
+
+
+class RuleClassifier:
+    def __init__(self, rules: Dict[str, List[Tuple[str, int]]] = DOCUMENT_TYPE_RULES):
+        self.rules = {code: [(re.compile(rf"\b(?:{pattern})\b"), weight) for pattern, weight in patterns]
+                      for code, patterns in rules.items()}
+
+    @staticmethod
+    def is_title(title: str, start: int) -> bool:
+        """Whether a match at `start` can be the document's title rather than a reference to another instrument."""
+        preceding = title[:start].split()
+        return start < TITLE_CHARS and not (preceding and preceding[-1] in REFERENCE_WORDS)
+
+    def scores(self, title: str) -> Dict[str, float]:
+        """Summed weights of each type's matching patterns, discounted by how far into the title area they matched.
+
+        A match inside a heavier one (MECHANIC S LIEN in RELEASE OF MECHANIC S LIEN) does not count.
+        """
+        return self._scores(title)[0]
+
+    def _scores(self, title: str) -> Tuple[Dict[str, float], set]:
+        """Scores and the codes with at least one title match."""
+        matches = []
+        for code, patterns in self.rules.items():
+            for pattern, weight in patterns:
+                match = pattern.search(title)
+                if match:
+                    matches.append((weight, match.start(), match.end(), code))
+
+        scores = {}
+        titled = set()
+        taken = []
+        for weight, start, end, code in sorted(matches, key=lambda m: (-m[0], m[1])):
+            if any(start >= outer_start and end <= outer_end for outer_start, outer_end in taken):
+                continue
+            taken.append((start, end))
+            score = weight * (1 - 0.5 * start / max(1, len(title)))
+            scores[code] = scores.get(code, 0) + score
+            if self.is_title(title, start):
+                titled.add(code)
+        return scores, titled
+
+    def classify(self, title: str) -> Classification:
+        scores, titled = self._scores(title)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if not ranked:
+            return UNKNOWN
+        best_code, best = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0
+        # An uncontested title is near certain; a contested one is as sure as its margin
+        confidence = round(60 + 35 * (best - runner_up) / best)
+        if best_code not in titled:
+            # The type is only mentioned, e.g. the deed of trust a reconveyance releases
+            confidence = min(confidence, REFERENCE_CONFIDENCE)
+        return Classification(best_code, confidence, "rules")
+
+
+# Hashed feature space of the linear model
+FEATURE_BUCKETS = 1 << 18
+
+
+def features(title: str) -> List[int]:
+    """Hashed word unigrams and bigrams of a normalized title area."""
+    words = title.split()
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return sorted({zlib.crc32(gram.encode("utf-8")) % FEATURE_BUCKETS for gram in grams})
+
+
+class LinearModel:
+    """Multiclass linear model over hashed features; weights are sparse per class."""
+
+    def __init__(self, weights: Dict[str, Dict[int, float]] = None):
+        self.weights = weights or {}
+
+    def scores(self, feature_ids: List[int]) -> Dict[str, float]:
+        return {code: sum(weights.get(feature, 0.0) for feature in feature_ids)
+                for code, weights in self.weights.items()}
+
+    def classify(self, title: str) -> Classification:
+        scores = self.scores(features(title))
+        if not scores:
+            return UNKNOWN
+        top = max(scores.values())
+        total = sum(math.exp(score - top) for score in scores.values())
+        code = max(scores, key=scores.get)
+        return Classification(code, round(100 / total), "model")
+
+    @classmethod
+    def train(cls, examples: List[Tuple[str, str]], epochs: int = 10) -> "LinearModel":
+        """Averaged perceptron over (title, code) examples."""
+        codes = sorted({code for _, code in examples})
+        weights = {code: defaultdict(float) for code in codes}
+        totals = {code: defaultdict(float) for code in codes}
+        encoded = [(features(title), code) for title, code in examples]
+        step = 1
+        for _ in range(epochs):
+            for feature_ids, code in encoded:
+                scores = {c: sum(weights[c][f] for f in feature_ids) for c in codes}
+                predicted = max(scores, key=scores.get)
+                if predicted != code:
+                    for feature in feature_ids:
+                        weights[code][feature] += 1
+                        weights[predicted][feature] -= 1
+                        totals[code][feature] += step
+                        totals[predicted][feature] -= step
+                step += 1
+        # Averaged weights: w - (sum of step-weighted updates) / steps
+        averaged = {code: {feature: weight - totals[code][feature] / step
+                           for feature, weight in weights[code].items()
+                           if weight - totals[code][feature] / step}
+                    for code in codes}
+        return cls(averaged)
+
+    def save(self, path: str = DOCTYPE_MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        partial = path + ".partial"
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump({"buckets": FEATURE_BUCKETS,
+                       "weights": {code: {str(feature): round(weight, 4) for feature, weight in weights.items()}
+                                   for code, weights in self.weights.items()}}, f)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: str = DOCTYPE_MODEL_PATH) -> "LinearModel":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("buckets") != FEATURE_BUCKETS:
+            raise ValueError(f"Document type model {path} uses a different feature space")
+        return cls({code: {int(feature): weight for feature, weight in weights.items()}
+                    for code, weights in data["weights"].items()})
+
+
+class DocumentClassifier:
+    """Rules first; the model only decides documents the rules are unsure about."""
+
+    def __init__(self, model: LinearModel = None, rules: RuleClassifier = None):
+        self.rules = rules or RuleClassifier()
+        self.model = model
+
+    def classify(self, text) -> Classification:
+        title = title_text(text)
+        result = self.rules.classify(title)
+        if result.confident or self.model is None:
+            return result
+        predicted = self.model.classify(title)
+        return predicted if predicted.confidence > result.confidence else result
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier() -> DocumentClassifier:
+    """Process-wide classifier, with the trained model when DOCTYPE_MODEL_PATH exists."""
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                model = None
+                if os.path.exists(DOCTYPE_MODEL_PATH):
+                    try:
+                        model = LinearModel.load(DOCTYPE_MODEL_PATH)
+                    except Exception as e:
+                        print(f"Error loading document type model: {str(e)}")
+                _classifier = DocumentClassifier(model)
+    return _classifier
+
+
+def classify_document(text) -> Classification:
+    return get_classifier().classify(text)
+
+
+def document_type_of(doc, text=None) -> Classification:
+    """Classification stored on a document at intake, or a fresh one from `text`."""
+    stored = doc.get("document_type")
+    if stored:
+        return Classification.from_dict(stored)
+    if text is None:
+        text, _ = prepare_document_text(doc)
+    return classify_document(text)
+
+
+def route_for(classification: Classification) -> Route:
+    if not classification.confident:
+        return FULL_ROUTE
+    return ROUTES.get(classification.code, FULL_ROUTE)
+
+
+def legal_fields_for(classification: Classification, tags_legal_type: bool = False) -> List[str]:
+    """Legal fields to ask Claude for.
+
+    :param tags_legal_type: The classification supplies Legal_Type, so it is not asked for
+    """
+    fields = route_for(classification).legal_fields or FIELD_GROUPS
+    if tags_legal_type and classification.confident:
+        return [field for field in fields if field != "Legal_Type"]
+    return list(fields)
+
+
+def complete_result(partial: Mapping, field_names: List[str], missing_value: str = "") -> Dict:
+    """Stage result over every field; fields outside the extracted subset are NOT_APPLICABLE."""
+    return {field: partial[field] if field in partial
+            else FieldResult(missing_value, 0, [NOT_APPLICABLE_FLAG])
+            for field in field_names}
+
+
+def tag_legal_type(processed_data: Mapping, classification: Classification):
+    """Set Legal_Type from a confident classification, in place."""
+    if classification.confident and "Legal_Type" in processed_data:
+        processed_data["Legal_Type"] = FieldResult(classification.code, classification.confidence,
+                                                   [CLASSIFIER_FLAG])
+
+
+def read_labels(path: str = DOCTYPE_LABELS_PATH) -> Dict[str, str]:
+    """ImageName -> code from a reviewed labels file; rows with unknown codes are skipped."""
+    labels = {}
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            code = (row.get("Legal_Type") or "").strip().upper()
+            if code in ROUTES and row.get("ImageName"):
+                labels[row["ImageName"].strip()] = code
+    return labels
+
+
+def training_examples(collection, output_collection, labels_path: str = DOCTYPE_LABELS_PATH,
+                      min_confidence: int = 90, limit: int = 0, payload_store=None) -> List[Tuple[str, str]]:
+    """(title, code) pairs from reviewed labels, then from Claude's own past Legal_Type reads.
+
+    Legal_Type values set by this classifier or copied from another document
+    are left out, so the model never learns from its own output.
+    :param payload_store: Store holding the OCR of slimmed queue documents
+    """
+    examples = []
+    labelled = set()
+
+    def find_document(query):
+        doc = collection.find_one(query)
+        return payload_store.lazy(doc) if doc is not None and payload_store is not None else doc
+
+    if labels_path and os.path.exists(labels_path):
+        for image_name, code in read_labels(labels_path).items():
+            doc = find_document({"filename": image_name})
+            if doc is None:
+                continue
+            text, _ = prepare_document_text(doc)
+            examples.append((title_text(text), code))
+            labelled.add(image_name)
+
+    query = {"processed_data.Legal_Type.value": {"$in": sorted(ROUTES)},
+             "processed_data.Legal_Type.confidence": {"$gte": min_confidence},
+             "processed_data.Legal_Type.flags": {"$nin": [CLASSIFIER_FLAG, "NEAR_DUPLICATE_REUSED"]},
+             "filename": {"$nin": sorted(labelled)}}
+    for record in output_collection.find(query, {"original_id": 1, "processed_data.Legal_Type": 1}).limit(limit):
+        doc = find_document({"_id": record["original_id"]})
+        if doc is None:
+            continue
+        text, _ = prepare_document_text(doc)
+        examples.append((title_text(text), record["processed_data"]["Legal_Type"]["value"]))
+    return examples
+
+
+def train_model(collection, output_collection, labels_path: str = DOCTYPE_LABELS_PATH,
+                path: str = DOCTYPE_MODEL_PATH, payload_store=None) -> int:
+    """Train the linear model on reviewed labels and past results and save it.
+
+    :return: Number of training examples
+    """
+    examples = training_examples(collection, output_collection, labels_path, payload_store=payload_store)
+    if not examples:
+        print("No labelled documents to train the document type model on")
+        return 0
+    model = LinearModel.train(examples)
+    model.save(path)
+    correct = sum(1 for title, code in examples if model.classify(title).code == code)
+    print(f"Trained document type model on {len(examples)} documents "
+          f"({correct / len(examples):.1%} training accuracy), saved to {path}")
+    return len(examples)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "train":
+        from pymongo import MongoClient
+        from config import MONGO_URI, DB_NAME, COLLECTION_NAME, OUTPUT_COLLECTION
+        from payload_store import PAYLOAD_COLLECTION, PayloadStore
+
+        db = MongoClient(MONGO_URI)[DB_NAME]
+        train_model(db[COLLECTION_NAME], db[OUTPUT_COLLECTION], *sys.argv[2:4],
+                    payload_store=PayloadStore(db[PAYLOAD_COLLECTION]))
+    else:
+        print(classify_document(open(sys.argv[1], encoding="utf-8").read()).to_dict())
@@ -0,0 +1,151 @@
+"""Validation of extracted values against the stages' field definitions.
+
+FIELD_INSTRUCTIONS gives every field a max_length and a format, but nothing
+checked them, so a 12-character Block_ID or a Zip with letters in it went
+straight to the output files. A FieldValidator compiles each field's
+constraints once: its max length, and a precompiled pattern. The pattern
+comes from the format text (Integer, Date, Y/N, a list of codes, ...) or,
+for fields whose format does not pin the value down, from FIELD_PATTERNS.
+A stage whose prompt defines more codes than a field's format lists (the
+legal prompt's GD, QC, ... for Legal_Type) passes a `code_list_pattern` of
+both as an override.
+
+`validate_batch` checks a list of stage results column by column and
+checks each distinct value of a field only once. A violation adds
+EXCEEDS_MAX_LENGTH or INVALID_FORMAT to the entry's flags. It also caps the
+entry's confidence at VIOLATION_CONFIDENCE, so its CL_ column is labelled
+LOW. Validating a result twice changes nothing further.
+"""
+import re
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Union
+
+TOO_LONG_FLAG = "EXCEEDS_MAX_LENGTH"
+FORMAT_FLAG = "INVALID_FORMAT"
+
+# Confidence cap for a value that breaks its field's constraints (below HIGH_CONFIDENCE)
+VIOLATION_CONFIDENCE = 50
+
+# Values meaning the field was not found; they are not checked
+MISSING_VALUES = ("", "NONE")
+
+# Patterns for the format texts used in the stages' FIELD_INSTRUCTIONS
+FORMAT_PATTERNS = {
+    "integer": r"\d+",
+    "numeric": r"\d[\d,]*(?:\.\d+)?",
+    "date": r"\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2}",
+    "y/n": r"[YN]",
+    "c or blank": r"C?",
+    "single character 'a'": r"A",
+    "integer or alphanumeric optionally including hypens": r"[A-Z0-9]+(?:-[A-Z0-9]+)*",
+}
+
+# Fields checked by value rather than by their (free text) format
+FIELD_PATTERNS = {
+    "Zip": r"\d{5}(?:-?\d{4})?",
+    "Zip_4": r"\d{4}",
+    "State": r"[A-Z]{2}",
+}
+
+# A format that lists the allowed codes, e.g. "MP, BMP, SE, RS"
+_CODE_LIST = re.compile(r"[A-Z]+(?:, [A-Z]+)+")
+
+# A code definition line in a system prompt, e.g. "   GD = GRANT DEED"
+_PROMPT_CODE = re.compile(r"^\s*([A-Z]{2,3}) = [A-Z]", re.MULTILINE)
+
+
+def format_codes(format_text) -> List[str]:
+    """Codes listed by a code-list format text, or [] when it is not one."""
+    format_text = str(format_text or "").strip()
+    return format_text.split(", ") if _CODE_LIST.fullmatch(format_text) else []
+
+
+def prompt_codes(prompt: str) -> List[str]:
+    """Codes a system prompt defines as "XX = NAME" lines, in prompt order."""
+    return list(dict.fromkeys(_PROMPT_CODE.findall(prompt)))
+
+
+def code_list_pattern(codes: Iterable[str]) -> str:
+    """Pattern for one or more of `codes`, separated by spaces, commas or slashes."""
+    codes = "|".join(sorted(set(codes), key=len, reverse=True))
+    return rf"(?:{codes})(?:[ ,/]+(?:{codes}))*"
+
+
+def format_pattern(format_text) -> Optional[str]:
+    """Pattern for a FIELD_INSTRUCTIONS format text, or None when it is free text."""
+    format_text = str(format_text or "").strip()
+    if format_text.lower() in FORMAT_PATTERNS:
+        return FORMAT_PATTERNS[format_text.lower()]
+    codes = format_codes(format_text)
+    return code_list_pattern(codes) if codes else None
+
+
+def merge_flags(flags: Iterable[str], violations: Iterable[str]) -> List[str]:
+    """`flags` plus any new `violations`; NO_FLAGS is dropped once there is a real flag."""
+    merged = [flag for flag in flags or [] if flag != "NO_FLAGS"]
+    return merged + [flag for flag in violations if flag not in merged]
+
+
+class FieldValidator:
+    """Compiled constraints of one stage's fields.
+
+    :param fields: FIELD_INSTRUCTIONS style dict, or a list of field names
+        (only FIELD_PATTERNS then apply)
+    :param patterns: Extra field -> pattern overrides
+    """
+
+    def __init__(self, fields: Union[Dict, List], patterns: Dict[str, str] = None):
+        if not isinstance(fields, dict):
+            fields = {field: {} for field in fields}
+        patterns = {**FIELD_PATTERNS, **(patterns or {})}
+
+        self.rules = {}
+        for field, details in fields.items():
+            max_length = details.get("max_length")
+            pattern = patterns.get(field) or format_pattern(details.get("format"))
+            if max_length or pattern:
+                self.rules[field] = (max_length, re.compile(pattern) if pattern else None)
+
+    def checker(self, field: str) -> Optional[Callable[[str], tuple]]:
+        """Function returning the violations of a value of `field`; it remembers each value's verdict."""
+        if field not in self.rules:
+            return None
+        max_length, pattern = self.rules[field]
+        verdicts = {}
+
+        def check(value: str) -> tuple:
+            verdict = verdicts.get(value)
+            if verdict is None:
+                violations = []
+                if max_length and len(value) > max_length:
+                    violations.append(TOO_LONG_FLAG)
+                if pattern is not None and not pattern.fullmatch(value):
+                    violations.append(FORMAT_FLAG)
+                verdict = verdicts[value] = tuple(violations)
+            return verdict
+
+        return check
+
+    def validate_batch(self, results: List[Mapping]) -> int:
+        """Check stage results (field -> {value, confidence, flags}) in place, one field at a time.
+
+        :return: Number of entries that broke a constraint
+        """
+        violations = 0
+        for field in self.rules:
+            check = self.checker(field)
+            for result in results:
+                entry = result.get(field) if result is not None else None
+                if entry is None or entry.get("value") is None:
+                    continue
+                value = str(entry.get("value"))
+                if value in MISSING_VALUES:
+                    continue
+                found = check(value)
+                if found:
+                    entry["flags"] = merge_flags(entry.get("flags"), found)
+                    entry["confidence"] = min(entry.get("confidence") or 0, VIOLATION_CONFIDENCE)
+                    violations += 1
+        return violations
+
+    def validate(self, result: Mapping) -> int:
+        return self.validate_batch([result])
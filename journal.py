@@ -0,0 +1,175 @@
+"""Write-ahead journal that makes stage outputs and status updates idempotent.
+
+Each record is keyed by (stage, document id or filename, prompt version) and
+moves through three states:
+
+    result   the extraction is known; enough is stored to finish without Claude
+    written  the output line has reached the pipe file
+    done     Mongo (or whatever the stage updates) has been updated
+
+Records are appended to `{JOURNAL_DIR}/{stage}.jsonl` and fsynced before the
+step they describe, so after a crash a stage looks its documents up in O(1)
+and only redoes the steps that had not completed. A new prompt version is a
+new key, so changing the prompt reprocesses everything once.
+
+`compact_output` rewrites a pipe file keeping only the last line per
+ImageName, which removes lines duplicated by a crash between the write and
+the journal record.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections.abc import Mapping
+from typing import Dict, Optional, Tuple
+
+try:
+    from bson import json_util
+except ImportError:  # pymongo not installed, ObjectIds are journaled as strings
+    json_util = None
+
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+
+# Rewrite a journal on open when it holds this many times more records than keys
+JOURNAL_COMPACT_RATIO = 3
+
+STATES = ("result", "written", "done")
+
+
+def prompt_version(*parts) -> str:
+    """Short hash of everything that shapes a stage's output (prompt, tool, model)."""
+    payload = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=6).hexdigest()
+
+
+def _default(value):
+    # Result structs are Mappings; anything else falls back to its string form
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+def _dumps(record: Dict) -> str:
+    if json_util is not None:
+        return json_util.dumps(record)
+    return json.dumps(record, default=_default)
+
+
+def _loads(line: str) -> Dict:
+    if json_util is not None:
+        return json_util.loads(line)
+    return json.loads(line)
+
+
+class OutputJournal:
+    """Latest record per key, loaded from and appended to one stage's journal file."""
+
+    def __init__(self, stage: str, version: str, directory: str = JOURNAL_DIR):
+        self.stage = stage
+        self.version = version
+        self.path = os.path.join(directory, f"{stage}.jsonl")
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        records = self._load()
+        if records > JOURNAL_COMPACT_RATIO * max(1, len(self._entries)):
+            self.compact()
+        self._file = open(self.path, "a", encoding="utf-8")
+        if self._file.tell() > 0 and not self._ends_with_newline():
+            # Terminate a torn last line so the next record starts cleanly
+            self._file.write("\n")
+        print(f"Journal {self.path}: {len(self._entries)} entries, version {version}")
+
+    def _load(self) -> int:
+        records = 0
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = _loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-append
+                    continue
+                self._entries[(record["id"], record["v"])] = record
+                records += 1
+        return records
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def key(self, doc_id) -> Tuple[str, str]:
+        return str(doc_id), self.version
+
+    def get(self, doc_id) -> Optional[Dict]:
+        """Latest record for a document under the current prompt version."""
+        return self._entries.get(self.key(doc_id))
+
+    def state(self, doc_id) -> Optional[str]:
+        entry = self.get(doc_id)
+        return entry["state"] if entry else None
+
+    def record(self, doc_id, state: str, payload: Dict = None):
+        """Durably record that `doc_id` reached `state`; `payload` replaces any earlier one."""
+        if state not in STATES:
+            raise ValueError(f"Unknown journal state: {state}")
+        doc_key, version = self.key(doc_id)
+        entry = {"id": doc_key, "v": version, "state": state}
+        if payload is not None:
+            entry["payload"] = payload
+        line = _dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries[(doc_key, version)] = entry
+
+    def compact(self):
+        """Rewrite the journal with only the latest record per key of the current version."""
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items() if key[1] == self.version}
+            partial = self.path + ".partial"
+            with open(partial, "w", encoding="utf-8") as f:
+                for entry in self._entries.values():
+                    f.write(_dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            reopen = getattr(self, "_file", None) is not None
+            if reopen:
+                self._file.close()
+            os.replace(partial, self.path)
+            if reopen:
+                self._file = open(self.path, "a", encoding="utf-8")
+        print(f"Compacted journal {self.path} to {len(self._entries)} records")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def compact_output(path: str, key_column: str = "ImageName") -> int:
+    """Rewrite a pipe file keeping the last line per `key_column`, in original order.
+
+    :return: Number of superseded lines dropped
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        header = f.readline()
+        key_index = header.rstrip("\r\n").split("|").index(key_column)
+        last_line = {}
+        for number, line in enumerate(f):
+            last_line[line.split("|", key_index + 1)[key_index]] = number
+
+    keep = set(last_line.values())
+    dropped = 0
+    partial = path + ".partial"
+    with open(path, "r", encoding="utf-8") as src, open(partial, "w", encoding="utf-8") as dst:
+        dst.write(src.readline())
+        for number, line in enumerate(src):
+            if number in keep:
+                dst.write(line)
+            else:
+                dropped += 1
+    os.replace(partial, path)
+    print(f"Compacted {path}: dropped {dropped} superseded lines")
+    return dropped
@@ -0,0 +1,177 @@
+"""Chunked map-reduce helpers for long legal documents.
+
+Subdivision maps and CC&Rs run to dozens of pages. Instead of one oversized
+prompt, the `=== PAGE n ===` text is split into token-budgeted windows, each
+window is extracted on its own, and the per-window candidates are reduced
+into one 64-field `formatted_response` with deterministic merge rules.
+"""
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from text_prep import estimate_tokens
+
+LEGAL_CHUNK_TOKENS = int(os.getenv("LEGAL_CHUNK_TOKENS", "6000"))
+LEGAL_CHUNK_WORKERS = int(os.getenv("LEGAL_CHUNK_WORKERS", "4"))
+
+# Fields where several distinct values mean the document covers several parcels
+MULTI_PARCEL_FIELDS = ["APN_AIN", "Parcel", "Map_Book", "Map_Number", "TractNumber"]
+
+# Fields required for Legal_Extract_Complete_Flag = Y (see get_extraction_prompt)
+COMPLETE_FLAG_FIELDS = ["Legal_Type", "Legal_Extract_Level", "Plat_Document_Number", "APN_AIN"]
+
+# Confidence used when windows disagree on a single-valued field
+CONFLICT_CONFIDENCE = 70
+
+# Confidence of a value the merge derives instead of taking it from a window
+DERIVED_CONFIDENCE = 80
+DERIVED_FLAG = "DERIVED_FROM_CHUNKS"
+
+_PAGE_MARKER = re.compile(r"=== PAGE (\d+) ===")
+
+
+def split_pages(text: str) -> List[Tuple[int, str]]:
+    """Split Textract output on its page markers; unmarked text is page 1."""
+    parts = _PAGE_MARKER.split(text)
+    if len(parts) == 1:
+        return [(1, text.strip())]
+
+    pages = []
+    if parts[0].strip():
+        pages.append((1, parts[0].strip()))
+    for number, page_text in zip(parts[1::2], parts[2::2]):
+        pages.append((int(number), page_text.strip()))
+    return pages
+
+
+def _split_long_page(page_text: str, budget_tokens: int) -> List[str]:
+    words = page_text.split()
+    pieces, current, current_tokens = [], [], 0
+    for word in words:
+        word_tokens = estimate_tokens(word) + 1
+        if current and current_tokens + word_tokens > budget_tokens:
+            pieces.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += word_tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def chunk_pages(text: str, budget_tokens: int = LEGAL_CHUNK_TOKENS) -> List[str]:
+    """Pack whole pages into windows of at most `budget_tokens` tokens.
+
+    Pages are never reordered; a page larger than the budget is split on word
+    boundaries into several windows of its own.
+    """
+    windows, current, current_tokens = [], [], 0
+    for number, page_text in split_pages(text):
+        page_block = f"=== PAGE {number} ===\n{page_text}"
+        page_tokens = estimate_tokens(page_block)
+
+        if page_tokens > budget_tokens:
+            if current:
+                windows.append("\n".join(current))
+                current, current_tokens = [], 0
+            for piece in _split_long_page(page_text, budget_tokens):
+                windows.append(f"=== PAGE {number} ===\n{piece}")
+            continue
+
+        if current and current_tokens + page_tokens > budget_tokens:
+            windows.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(page_block)
+        current_tokens += page_tokens
+
+    if current:
+        windows.append("\n".join(current))
+    return windows
+
+
+def _as_int(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _pick_best(candidates: List[Dict]) -> Dict:
+    """Highest confidence wins; ties go to the earliest window."""
+    return max(enumerate(candidates), key=lambda item: (item[1]["confidence"], -item[0]))[1]
+
+
+def reduce_candidates(window_results: List[Dict], fields: List[str]) -> Dict:
+    """Merge per-window extractions into one formatted_response.
+
+    Rules:
+    - single-valued fields take the highest-confidence value; disagreeing
+      windows cap the confidence and add CONFLICTING_VALUES
+    - Map_Page_From / Map_Page_Thru take the lowest / highest page number
+    - several distinct values in MULTI_PARCEL_FIELDS set Legal_Extract_Level
+      to M and list the other values as ALSO:<value> flags
+    - Legal_Extract_Complete_Flag is recomputed from the merged fields
+    - a value the rules change or supply gets DERIVED_CONFIDENCE and DERIVED_FROM_CHUNKS
+    """
+    candidates = defaultdict(list)
+    for result in window_results:
+        for field in fields:
+            field_data = result.get(field) or {}
+            value = field_data.get("value")
+            if value:
+                candidates[field].append({
+                    "value": str(value),
+                    "confidence": field_data.get("confidence", 0),
+                    "flags": list(field_data.get("flags") or [])
+                })
+
+    merged = {}
+    for field in fields:
+        found = candidates.get(field, [])
+        if not found:
+            merged[field] = {"value": "", "confidence": 0, "flags": ["FIELD_NOT_FOUND"]}
+            continue
+
+        best = dict(_pick_best(found))
+        distinct = list(dict.fromkeys(candidate["value"] for candidate in found))
+
+        if field in ("Map_Page_From", "Map_Page_Thru"):
+            numbered = [c for c in found if _as_int(c["value"]) is not None]
+            if numbered:
+                pick = min if field == "Map_Page_From" else max
+                best = dict(pick(numbered, key=lambda c: _as_int(c["value"])))
+        elif len(distinct) > 1:
+            others = [value for value in distinct if value != best["value"]]
+            if field in MULTI_PARCEL_FIELDS:
+                best["flags"] = best["flags"] + ["MULTIPLE_VALUES"] + [f"ALSO:{value}" for value in others]
+            else:
+                best["confidence"] = min(best["confidence"], CONFLICT_CONFIDENCE)
+                best["flags"] = best["flags"] + ["CONFLICTING_VALUES"]
+
+        best["flags"] = best["flags"] + ["CHUNK_MERGED"]
+        merged[field] = best
+
+    if "Legal_Extract_Level" in merged:
+        multi_parcel = any(
+            len({c["value"] for c in candidates.get(field, [])}) > 1 for field in MULTI_PARCEL_FIELDS
+        )
+        levels = {c["value"] for c in candidates.get("Legal_Extract_Level", [])}
+        if multi_parcel or "M" in levels:
+            _set_derived(merged["Legal_Extract_Level"], "M")
+
+    if "Legal_Extract_Complete_Flag" in merged and all(field in merged for field in COMPLETE_FLAG_FIELDS):
+        complete = all(merged.get(field, {}).get("value") for field in COMPLETE_FLAG_FIELDS)
+        _set_derived(merged["Legal_Extract_Complete_Flag"], "Y" if complete else "N")
+
+    return merged
+
+
+def _set_derived(entry: Dict, value: str):
+    """Give a merged entry a value derived by the merge rules, with matching confidence and flags."""
+    if entry["value"] == value and "FIELD_NOT_FOUND" not in entry["flags"]:
+        return
+    entry["value"] = value
+    entry["confidence"] = DERIVED_CONFIDENCE
+    flags = [flag for flag in entry["flags"] if flag not in ("FIELD_NOT_FOUND", "NO_FLAGS", DERIVED_FLAG)]
+    entry["flags"] = flags + [DERIVED_FLAG] + ([] if "CHUNK_MERGED" in flags else ["CHUNK_MERGED"])
@@ -0,0 +1,212 @@
+"""Tool schemas and response validation for the Claude extraction stages.
+
+Every stage describes its output fields (FIELD_INSTRUCTIONS, the mailing
+REQUIRED_FIELDS, the APN fields). The helpers here compile those field
+definitions into a tool definition that Claude is forced to call, and into a
+decoder that turns the tool input into the `formatted_response` shape the
+rest of the pipeline expects.
+
+Stages use the compact wire format: the tool input is
+`{"f": [[field_index, "VALUE", "H", "FLAG", ...], ...]}` with the index taken
+from the stage's field order, empty fields omitted and confidence sent as a
+one letter code. The tool's field legend carries each field's max length.
+`compile_compact_decoder` expands the input into a StageResult (see
+result_types), which reads like `formatted_response`; field_validation then
+checks the values against the same definitions.
+"""
+from typing import Callable, Dict, List, Union
+
+from result_types import FieldResult, StageResult, compile_stage_result
+
+try:
+    import msgspec
+except ImportError:  # msgspec is optional, the pure Python checks are used instead
+    msgspec = None
+
+# Confidence codes used by the compact format and the score each expands to
+CONFIDENCE_CODES = {"H": 95, "M": 80, "L": 50}
+
+# Output token budget used by estimate_max_tokens
+ENTRY_OVERHEAD_TOKENS = 10
+DEFAULT_VALUE_TOKENS = 16
+MAX_VALUE_TOKENS = 64
+RESPONSE_OVERHEAD_TOKENS = 64
+
+
+def _as_field_dict(fields: Union[Dict, List]) -> Dict:
+    """Accept either a FIELD_INSTRUCTIONS style dict or a plain list of field names."""
+    if isinstance(fields, dict):
+        return fields
+    return {field: {} for field in fields}
+
+
+def build_compact_tool(name: str, description: str, fields: Union[Dict, List]) -> Dict:
+    """Build a tool definition for the compact positional format."""
+    legend = ", ".join(
+        f"{index}={field}" + (f" (max {details['max_length']} chars)" if details.get("max_length") else "")
+        for index, (field, details) in enumerate(_as_field_dict(fields).items())
+    )
+    return {
+        "name": name,
+        "description": (
+            f"{description} Send one entry per field found as "
+            "[field_index, VALUE, confidence_code, optional flags...]. "
+            "Omit fields that are not present. Confidence codes: "
+            "H (90+), M (70-89), L (below 70). "
+            f"Field indexes: {legend}."
+        ),
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "f": {
+                    "type": "array",
+                    "items": {
+                        "type": "array",
+                        "items": {"type": ["integer", "string"]},
+                        "minItems": 3
+                    }
+                }
+            },
+            "required": ["f"]
+        }
+    }
+
+
+def build_batch_compact_tool(name: str, description: str, fields: Union[Dict, List]) -> Dict:
+    """Build a compact-format tool that carries results for several documents."""
+    tool = build_compact_tool(name, description, fields)
+    entry_schema = tool["input_schema"]
+    entry_schema["properties"]["doc"] = {"type": "integer", "minimum": 0}
+    entry_schema["required"] = ["doc", "f"]
+    tool["description"] += " Send one item in d per document, with doc set to its document number."
+    tool["input_schema"] = {
+        "type": "object",
+        "properties": {"d": {"type": "array", "items": entry_schema}},
+        "required": ["d"]
+    }
+    return tool
+
+
+def compact_instructions(tool: Dict) -> str:
+    """Prompt text describing the compact format for `tool`."""
+    return (
+        f"Record the result with the {tool['name']} tool. For every field you find, "
+        "send [field_index, VALUE, confidence_code] followed by any flags. "
+        "Leave out fields that are not in the document. "
+        "Confidence codes: H = HIGH (90+), M = MEDIUM (70-89), L = LOW (below 70)."
+    )
+
+
+def estimate_max_tokens(fields: Union[Dict, List]) -> int:
+    """Derive a max_tokens budget for a compact response over `fields`."""
+    total = RESPONSE_OVERHEAD_TOKENS
+    for details in _as_field_dict(fields).values():
+        max_length = details.get("max_length")
+        value_tokens = -(-max_length // 3) if max_length else DEFAULT_VALUE_TOKENS
+        total += ENTRY_OVERHEAD_TOKENS + min(value_tokens, MAX_VALUE_TOKENS)
+    return min(4096, total)
+
+
+def forced_tool_choice(tool: Dict) -> Dict:
+    """Force Claude to answer through the given tool."""
+    return {"type": "tool", "name": tool["name"]}
+
+
+def get_tool_input(message, tool_name: str) -> Dict:
+    """Return the input Claude passed to `tool_name`, or raise ValueError."""
+    for block in message.content:
+        if getattr(block, "type", None) == "tool_use" and block.name == tool_name:
+            return block.input
+    raise ValueError(f"No {tool_name} tool call found in response")
+
+
+if msgspec is not None:
+    class _CompactPayload(msgspec.Struct):
+        f: List[List[Union[int, str, None]]] = []
+
+
+def compile_compact_decoder(fields: Union[Dict, List], missing_value: str = "",
+                            default_flags: List[str] = None,
+                            name: str = "StageResult") -> Callable[[Dict], StageResult]:
+    """Compile a decoder from the compact format to a StageResult.
+
+    :param fields: Field definitions or field names, in index order
+    :param missing_value: Value used for omitted fields
+    :param default_flags: Flags used when an entry carries none
+    :param name: Class name of the stage's result type
+    :return: Function raising ValueError on a structurally invalid payload
+    """
+    field_names = tuple(_as_field_dict(fields))
+    field_count = len(field_names)
+    default_flags = list(default_flags or ["NO_FLAGS"])
+    result_type = compile_stage_result(name, field_names)
+
+    def rows_from(payload: Dict) -> List:
+        if msgspec is not None:
+            try:
+                return msgspec.convert(payload, _CompactPayload, strict=False).f
+            except msgspec.ValidationError as e:
+                raise ValueError(f"Invalid compact payload: {e}") from e
+        if not isinstance(payload, dict) or not isinstance(payload.get("f", []), list):
+            raise ValueError("Invalid compact payload: expected {\"f\": [...]}")
+        return payload.get("f", [])
+
+    def decode(payload: Dict) -> StageResult:
+        entries = [None] * field_count
+        for row in rows_from(payload):
+            if not isinstance(row, list) or len(row) < 3:
+                raise ValueError(f"Invalid compact payload: bad entry {row!r}")
+            try:
+                index = int(row[0])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid compact payload: bad field index {row[0]!r}")
+            if not 0 <= index < field_count:
+                raise ValueError(f"Invalid compact payload: field index {index} out of range")
+
+            value = row[1]
+            code = str(row[2]).upper()[:1]
+            flags = [str(flag).upper() for flag in row[3:]]
+            entries[index] = FieldResult(
+                str(value).upper() if value not in (None, "") else missing_value,
+                CONFIDENCE_CODES.get(code, 0),
+                flags or list(default_flags)
+            )
+
+        for index, entry in enumerate(entries):
+            if entry is None:
+                entries[index] = FieldResult.missing(missing_value)
+        return result_type(entries)
+
+    return decode
+
+
+def compile_batch_decoder(fields: Union[Dict, List], missing_value: str = "",
+                          default_flags: List[str] = None,
+                          name: str = "StageResult") -> Callable[[Dict, int], List[StageResult]]:
+    """Compile a decoder for `build_batch_compact_tool` payloads.
+
+    The returned function takes the payload and the number of documents sent
+    and returns one StageResult per document, in request order.
+    Documents the model skipped come back as None, so the caller can retry them.
+    """
+    decode = compile_compact_decoder(fields, missing_value, default_flags, name)
+
+    def decode_batch(payload: Dict, doc_count: int) -> List[StageResult]:
+        if not isinstance(payload, dict) or not isinstance(payload.get("d"), list):
+            raise ValueError("Invalid batch payload: expected {\"d\": [...]}")
+
+        results = [None] * doc_count
+        for entry in payload["d"]:
+            if not isinstance(entry, dict):
+                raise ValueError(f"Invalid batch payload: bad entry {entry!r}")
+            try:
+                doc_index = int(entry.get("doc"))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid batch payload: bad document number {entry.get('doc')!r}")
+            if not 0 <= doc_index < doc_count:
+                raise ValueError(f"Invalid batch payload: document number {doc_index} out of range")
+            results[doc_index] = decode(entry)
+
+        return results
+
+    return decode_batch
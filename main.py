@@ -1,8 +1,19 @@
-import os
 import time
 from pymongo import MongoClient
-from document_processor import LegalDocumentProcessor
-from utils import convert_document_to_images, format_output, generate_header, process_document_batch
+from document_processor import LegalDocumentProcessor, LEGAL_PROMPT_VERSION
+from utils import generate_header, process_document_stream, LEGAL_PLAN
+from field_definitions import FIELD_GROUPS
+from result_batch import ResultBatch
+from dedup_index import NearDuplicateIndex
+from parcel_cache import PARCEL_COLLECTION, ParcelCache
+from concurrency import API_LIMITER
+from output_writer import get_output_writer
+from parquet_export import export_result, close_expired_exports
+from batch_merge import finalize_batches
+from journal import OutputJournal
+from payload_store import PAYLOAD_COLLECTION, PayloadStore
+from schema_registry import SCHEMA_COLLECTION, SchemaRegistry
+from raw_document import raw_collection
 from config import *
 
 def process_legal_documents():
@@ -13,61 +24,108 @@ def process_legal_documents():
     db = mongo_client[DB_NAME]
     collection = db[COLLECTION_NAME]
     output_collection = db[OUTPUT_COLLECTION]
+    dedup_index = NearDuplicateIndex(db[NEAR_DUP_COLLECTION])
+    parcel_cache = ParcelCache(db[PARCEL_COLLECTION])
+    payload_store = PayloadStore(db[PAYLOAD_COLLECTION])
     
     processor = LegalDocumentProcessor()
     
+    legal_header = generate_header()
+    legal_schema_version = SchemaRegistry(db[SCHEMA_COLLECTION]).register(legal_header, "legal")
+    journal = OutputJournal("legal", LEGAL_PROMPT_VERSION)
+    
     while True:
         try:
             query = {"status": "mailingpassed"}
-            unprocessed_docs = list(collection.find(query))
-            count = len(unprocessed_docs)
-            
-            if count == 0:
-                print("Waiting for new documents...")
-                time.sleep(10)
-                continue
+            cursor = raw_collection(collection).find(query, batch_size=INTAKE_BATCH_SIZE)
+            writer = get_output_writer()
+            batches = set()
             
-            print(f"Processing {count} documents in parallel...")
+            pending = ResultBatch(FIELD_GROUPS)
             
-            # Initialize output file
-            if unprocessed_docs:
-                batch_name = unprocessed_docs[0].get('cat_name', '06107-20241205-01')
-                output_file = f"Outputs/{batch_name}/{batch_name}_Legal.txt"
-                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            def write_batch(results):
+                """Append a ResultBatch to its batch files and record it in MongoDB.
+
+                Each step is journaled per document, so results replayed after a
+                crash only redo the steps that had not completed.
+                """
+                if not len(results):
+                    return
+                unwritten = {index for index in range(len(results))
+                             if journal.state(results.doc_ids[index]) == "result"}
+                written = []
+                for batch_name, indices in results.by_batch().items():
+                    batches.add(batch_name)
+                    indices = [index for index in indices if index in unwritten]
+                    if indices:
+                        output_file = f"Outputs/{batch_name}/{batch_name}_Legal.txt"
+                        block = LEGAL_PLAN.format_rows(results.rows(indices))
+                        written.append((output_file, indices, writer.write(output_file, legal_header, block)))
+                
+                # Wait for the lines to reach the files before marking the documents done
+                # Raises if a block could not be written, leaving its documents unmarked
+                for output_file, indices, done in written:
+                    done.result()
+                    for index in indices:
+                        export_result({"output_file": output_file, "plan": LEGAL_PLAN, "row": results.row_key(index)})
+                        journal.record(results.doc_ids[index], "written", results.payload(index, LEGAL_PLAN))
                 
-                if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-                    with open(output_file, "w") as f:
-                        f.write(generate_header() + "\n")
+                # Bulk upserts keyed on the source document, so a replay does not duplicate them
+                results.write_to_mongo(collection, output_collection, LEGAL_PLAN, payload_store=payload_store,
+                                       processed_at=time.time(), schema_version=legal_schema_version)
+                for doc_id in results.doc_ids:
+                    journal.record(doc_id, "done")
+                
+                stats = results.statistics()
+                sparse = sorted(stats, key=lambda field: stats[field]["filled"])[:3]
+                print(f"Wrote {len(results)} results; least filled: "
+                      + ", ".join(f"{field} {stats[field]['filled']:.0%}" for field in sparse))
+            
+            def add_result(result):
+                """Journal a result and collect it; a full ResultBatch is written out."""
+                nonlocal pending
+                doc_id = result["doc_id"]
+                if journal.state(doc_id) is None:
+                    journal.record(doc_id, "result", {field: result[field] for field in
+                                   ("output_line", "processed_data", "image_name", "batch_name", "near_duplicate_of")})
+                pending.append(result)
+                if len(pending) >= RESULT_BATCH_SIZE:
+                    results, pending = pending, ResultBatch(FIELD_GROUPS)
+                    write_batch(results)
+            
+            def unjournaled(docs):
+                """Yield documents that need Claude; finish journaled ones from their stored result."""
+                for doc in docs:
+                    entry = journal.get(doc["_id"])
+                    if entry is None:
+                        yield payload_store.lazy(doc)
+                    elif entry["state"] == "done":
+                        collection.update_one({"_id": doc["_id"]}, {"$set": {"status": "legalpassed"}})
+                    else:
+                        print(f"Resuming document {doc['_id']} from the journal ({entry['state']})")
+                        add_result({**entry["payload"], "doc_id": doc["_id"]})
+            
+            # Stream documents through a bounded in-flight window
+            try:
+                count = process_document_stream(unjournaled(cursor), processor, add_result,
+                                                INTAKE_WINDOW, dedup_index, parcel_cache)
+            finally:
+                cursor.close()
+            write_batch(pending)
             
-            # Process documents in parallel
-            results = process_document_batch(unprocessed_docs, processor, batch_name)
+            close_expired_exports()
+            if batches:
+                # Batches whose last document just finished get their merged file
+                writer.flush()
+                finalize_batches(collection, batches, writer, compact_stages=("Legal",))
             
-            # Bulk write results
-            with open(output_file, "a") as f:
-                for result in results:
-                    f.write(result["output_line"] + "\n")
-                    
-                    # Update MongoDB
-                    output_collection.insert_one({
-                        "original_id": result["doc_id"],
-                        "filename": result["image_name"],
-                        "batch_name": result["batch_name"],
-                        "processed_at": time.time(),
-                        "output": result["output_line"],
-                        "processed_data": result["processed_data"],
-                        "status": "legalpassed"
-                    })
-                    
-                    collection.update_one(
-                        {"_id": result["doc_id"]},
-                        {"$set": {
-                            "status": "legalpassed",
-                            "processed": True,
-                            "processed_data": result["processed_data"]
-                        }}
-                    )
+            if count == 0:
+                print("Waiting for new documents...")
+                time.sleep(10)
+                continue
             
-            print(f"Successfully processed {len(results)} documents")
+            print(f"Processed {count} documents")
+            print(f"Claude concurrency: {API_LIMITER.metrics()}")
             
         except Exception as e:
             print(f"Error in main processing loop: {str(e)}")
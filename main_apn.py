@@ -1,7 +1,6 @@
 import os
 from dotenv import load_dotenv
 import boto3
-import json
 from typing import List, Dict
 from PIL import Image
 import io
@@ -9,6 +8,22 @@ from anthropic import Anthropic
 from pymongo import MongoClient
 import time
 import re
+import threading
+from singleflight import coalesce_by_text
+from concurrency import limit_client
+from text_prep import prepare_document_text
+from output_writer import get_output_writer
+from row_format import ColumnPlan
+from parquet_export import export_result, close_expired_exports
+from batch_merge import batch_name_of
+from payload_store import PAYLOAD_COLLECTION, PayloadStore
+from schema_registry import SCHEMA_COLLECTION, SchemaRegistry, stage_output
+from raw_document import raw_collection
+from field_validation import FieldValidator
+from document_type import Classification, classify_document
+from llm_schema import (build_batch_compact_tool, build_compact_tool, compact_instructions,
+                        compile_batch_decoder, compile_compact_decoder, estimate_max_tokens,
+                        forced_tool_choice, get_tool_input)
 
 load_dotenv()
 
@@ -27,7 +42,7 @@ textract_client = boto3.client(
     region_name=REGION
 )
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY) 
+anthropic_client = limit_client(Anthropic(api_key=ANTHROPIC_API_KEY))
 
 FIELD_INSTRUCTIONS = {
     "APN_Level": {
@@ -48,6 +63,33 @@ FIELD_INSTRUCTIONS = {
 
 FIELD_GROUPS = list(FIELD_INSTRUCTIONS.keys())
 
+APN_TOOL = build_compact_tool(
+    "record_apn_fields",
+    "Record the extracted APN fields with confidence and flags.",
+    FIELD_INSTRUCTIONS
+)
+decode_apn_response = compile_compact_decoder(FIELD_INSTRUCTIONS, name="APNResult")
+APN_VALIDATOR = FieldValidator(FIELD_INSTRUCTIONS)
+APN_MAX_TOKENS = estimate_max_tokens(FIELD_INSTRUCTIONS)
+
+APN_BATCH_TOOL = build_batch_compact_tool(
+    "record_apn_batch",
+    "Record the extracted APN fields for each document with confidence and flags.",
+    FIELD_INSTRUCTIONS
+)
+decode_apn_batch_response = compile_batch_decoder(FIELD_INSTRUCTIONS, name="APNResult")
+
+# Micro-batching: documents per request and how long the oldest may wait (seconds)
+APN_BATCH_SIZE = int(os.getenv('APN_BATCH_SIZE', '8'))
+APN_BATCH_WINDOW = float(os.getenv('APN_BATCH_WINDOW', '2.0'))
+
+# Characters of context kept around each APN marker or APN-shaped number when packing a batch
+APN_CONTEXT_CHARS = 300
+APN_HEADER_CHARS = 600
+APN_MARKER_PATTERN = re.compile(r"A\.?\s?P\.?\s?N|PARCEL|\bPIN\b|ASSESSOR|ASSESSMENT", re.IGNORECASE)
+# The APN formats of the prompt; the prompt asks for these even without a label
+APN_VALUE_PATTERN = re.compile(r"\b(?:\d{3}-\d{3}-\d{3}(?:-\d{3})?|\d{4}-\d{7}-\d{2}|\d{10})\b")
+
 system_prompt = '''You are an expert APN (Assessor's Parcel Number) extraction system. Your primary task is to identify and extract APN information from real estate documents with extremely high accuracy.
 
 Key Requirements:
@@ -73,25 +115,12 @@ def generate_header():
     # Return the exact header format with pipe separators
     return "ImageName|BatchName|ImageHeaderID|APN_Level|APN_AIN|CL_APN_Level|CL_APN_AIN"
 
+APN_PLAN = ColumnPlan(generate_header(), FIELD_GROUPS)
+
 def format_output(image_name: str, batch_name: str, image_header_id: str, extracted_data: Dict) -> str:
-    # Initialize list to store all fields
-    output_fields = [image_name, batch_name, image_header_id]
-    
-    # Add APN_Level and APN_AIN values
-    for field in FIELD_GROUPS:
-        field_data = extracted_data.get(field, {})
-        value = field_data.get("value", "") if isinstance(field_data, dict) else ""
-        value = str(value) if value is not None else ""
-        output_fields.append(value)
-        
-        confidence = field_data.get("confidence", 0) if isinstance(field_data, dict) else 0
-        confidence_label = "HIGH" if confidence >= 90 else "LOW"
-        output_fields.append(confidence_label)
-        
-        output_fields.extend(["", ""])  # Add empty Confidence Scores (CS_)
-    
-    return "|".join(output_fields)
+    return APN_PLAN.format_row(image_name, batch_name, image_header_id, extracted_data)
 
+@coalesce_by_text("apn")
 def post_process_with_llm(extracted_data: Dict) -> Dict:
     prompt = f"""Analyze this document text and extract APN information with high accuracy.
 
@@ -114,21 +143,9 @@ CRITICAL REQUIREMENTS:
     - Only use LOW confidence if truly uncertain
 
 Document Text to Analyze:
-{extracted_data.get('text', '')}
-
-RESPOND IN THIS EXACT FORMAT:
-{{
-    "APN_Level": {{
-        "value": "A",
-        "confidence": 95,
-        "flags": ["STANDARD_APN_LEVEL"]
-    }},
-    "APN_AIN": {{
-        "value": "EXTRACTED_NUMBER",
-        "confidence": 95,
-        "flags": ["MATCHES_APN_PATTERN"]
-    }}
-}}
+{relevant_apn_text(extracted_data.get('text', ''))}
+
+{compact_instructions(APN_TOOL)}
 
 IMPORTANT: 
 - ALL VALUES MUST BE UPPERCASE
@@ -139,42 +156,158 @@ IMPORTANT:
     try:
         response = anthropic_client.messages.create(
             model="claude-3-sonnet-20240229",
-            max_tokens=4096,
+            max_tokens=APN_MAX_TOKENS,
             temperature=0.2,
             system=system_prompt,
             messages=[
                 {"role": "user", "content": prompt}
-            ]
+            ],
+            tools=[APN_TOOL],
+            tool_choice=forced_tool_choice(APN_TOOL)
         )
-        response_text = response.content[0].text
+        return decode_apn_response(get_tool_input(response, APN_TOOL["name"]))
 
-        start_index = response_text.find('{')
-        end_index = response_text.rfind('}') + 1
-
-        if start_index == -1 or end_index == 0:
-            print("Error: No valid JSON found in response")
-            return {field: {"value": None, "confidence": 0, "flags": ["EXTRACTION_FAILED"]} for field in FIELD_GROUPS}
-
-        try:
-            json_response = response_text[start_index:end_index]
-            parsed_response = json.loads(json_response)
-
-            formatted_response = {}
-            for field in FIELD_GROUPS:
-                field_data = parsed_response.get(field, {})
-                formatted_response[field] = {
-                    "value": str(field_data.get("value", "")).upper() if field_data.get("value") else "",
-                    "confidence": field_data.get("confidence", 0),
-                    "flags": [str(flag).upper() for flag in field_data.get("flags", ["NO_FLAGS"])]
-                }
-            return formatted_response
-
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON: {str(e)}")
-            
+    except ValueError as e:
+        print(f"Error validating APN response: {str(e)}")
+        return {field: {"value": None, "confidence": 0, "flags": ["EXTRACTION_FAILED"]} for field in FIELD_GROUPS}
     except Exception as e:
         print(f"Error calling Claude API: {str(e)}")
-        return {field: {"value": None, "confidence": 0, "flags": ["CLAUDE_API_ERROR"]} for field in FIELD_GROUPS} 
+        return {field: {"value": None, "confidence": 0, "flags": ["CLAUDE_API_ERROR"]} for field in FIELD_GROUPS}
+
+def relevant_apn_text(text: str) -> str:
+    """Keep the document header plus the text around APN/parcel markers and APN-shaped numbers.
+
+    Both the single and the batched request send this, so a document's APN
+    does not depend on the size of the batch it landed in.
+    """
+    spans = [(0, APN_HEADER_CHARS)]
+    matches = list(APN_MARKER_PATTERN.finditer(text)) + list(APN_VALUE_PATTERN.finditer(text))
+    for match in matches:
+        spans.append((max(0, match.start() - APN_CONTEXT_CHARS), match.end() + APN_CONTEXT_CHARS))
+
+    spans.sort()
+    merged = [list(spans[0])]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return " ... ".join(text[start:end] for start, end in merged)
+
+def post_process_batch_with_llm(texts: List[str]) -> List[Dict]:
+    """Extract APN fields for several documents with a single Claude request.
+
+    Documents the model left out of its answer come back as None.
+    """
+    documents_text = "\n\n".join(
+        f"=== DOCUMENT {index} ===\n{relevant_apn_text(text)}\n=== END DOCUMENT {index} ==="
+        for index, text in enumerate(texts)
+    )
+    prompt = f"""Extract APN information from each of the {len(texts)} documents below.
+Each document is delimited by === DOCUMENT n === and === END DOCUMENT n ===.
+Treat every document independently and never carry values between documents.
+
+RULES:
+1. APN_Level should ALWAYS be "A" with HIGH confidence unless explicitly different
+2. APN_AIN patterns: XXX-XXX-XXX-XXX, XXXXXXXXXX, XXXX-XXXXXXX-XX
+3. Look near "APN:", "Parcel:", "PIN:", "Assessment Number:" and in headers
+4. ALL VALUES MUST BE UPPERCASE
+
+{documents_text}
+
+{compact_instructions(APN_BATCH_TOOL)} Send one item per document with doc set to its document number."""
+
+    response = anthropic_client.messages.create(
+        model="claude-3-sonnet-20240229",
+        max_tokens=min(4096, APN_MAX_TOKENS * len(texts)),
+        temperature=0.2,
+        system=system_prompt,
+        messages=[{"role": "user", "content": prompt}],
+        tools=[APN_BATCH_TOOL],
+        tool_choice=forced_tool_choice(APN_BATCH_TOOL)
+    )
+    if getattr(response, "stop_reason", None) == "max_tokens":
+        # A cut-off answer may have dropped or truncated the last documents
+        raise ValueError("Batch APN response hit max_tokens")
+    return decode_apn_batch_response(get_tool_input(response, APN_BATCH_TOOL["name"]), len(texts))
+
+class APNMicroBatcher:
+    """Collect documents and extract their APNs K at a time.
+
+    A batch is sent when it holds `max_size` documents or, from a timer, when
+    its oldest document has waited `max_wait` seconds, so latency stays
+    bounded when the backlog is small. `on_result(doc, processed_data)` is
+    called for every document, from the adding thread or the timer thread.
+    """
+
+    def __init__(self, on_result, max_size: int = APN_BATCH_SIZE, max_wait: float = APN_BATCH_WINDOW):
+        self.on_result = on_result
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # Held while a batch is out, so flush() returns only after earlier timer sends finished
+        self._send_lock = threading.Lock()
+
+    def add(self, doc, text: str):
+        """Queue a document; sends the batch when it is full."""
+        with self._lock:
+            self.pending.append((doc, text))
+            if len(self.pending) == 1:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            batch = self._take() if len(self.pending) >= self.max_size else []
+        self._send(batch)
+
+    def flush(self):
+        """Send the pending documents now."""
+        with self._lock:
+            batch = self._take()
+        self._send(batch)
+
+    def _take(self) -> List:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        return batch
+
+    def _send(self, batch: List):
+        """Extract a batch and demultiplex the answers by document."""
+        with self._send_lock:
+            if not batch:
+                return
+            docs = [doc for doc, _ in batch]
+            texts = [text for _, text in batch]
+            for doc, processed_data in zip(docs, extract_apn_batch(texts)):
+                self.on_result(doc, processed_data)
+
+def extract_apn_batch(texts: List[str]) -> List[Dict]:
+    """Extract APN fields for `texts`, one batched request with per-document fallback."""
+    if len(texts) == 1:
+        results = [post_process_with_llm({"text": texts[0]})]
+        APN_VALIDATOR.validate_batch(results)
+        return results
+
+    try:
+        results = post_process_batch_with_llm(texts)
+    except Exception as e:
+        # Fall back to one request per document rather than failing the whole batch
+        print(f"Batch APN extraction failed, retrying documents individually: {e}")
+        results = [None] * len(texts)
+
+    skipped = [index for index, result in enumerate(results) if result is None]
+    if 0 < len(skipped) < len(texts):
+        print(f"Batch APN answer left out {len(skipped)} documents, retrying them individually")
+    for index in skipped:
+        results[index] = post_process_with_llm({"text": texts[index]})
+
+    violations = APN_VALIDATOR.validate_batch(results)
+    print(f"Extracted APNs for {len(texts)} documents in one batch ({violations} invalid values)")
+    return results
 
 def process_images(image_directory: str, output_file: str):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
@@ -200,9 +333,7 @@ def process_images(image_directory: str, output_file: str):
                 except Exception as e:
                     print(f"Error processing {image_name}: {str(e)}")
                     # Create error output line with pipe separators
-                    error_fields = [image_name, os.path.basename(image_directory), "1"]
-                    error_fields.extend(["ERROR"] * 6)  # For the remaining 6 fields
-                    f.write("|".join(error_fields) + "\n")
+                    f.write(APN_PLAN.error_row(image_name, os.path.basename(image_directory), "1") + "\n")
 
 def process_document(file_path: str) -> Dict:
     """Process a document file and extract text using Textract and Claude."""
@@ -255,6 +386,79 @@ def convert_document_to_images(file_path: str) -> List[Image.Image]:
                 break
     return images
 
+def build_apn_output(doc, processed_data: Dict, document_type: Classification = None) -> Dict:
+    """Format one document's APN result: Mongo fields, output file and line.
+
+    :param document_type: Intake classification, stored with the APN result for the later stages
+    """
+    image_name = doc.get('filename', 'unknown.TIF')
+    batch_name = batch_name_of(doc)
+    image_header_id = "1"
+
+    output_schema = generate_header()
+    output_line = format_output(image_name, batch_name, image_header_id, processed_data)
+
+    updates = {
+        "processeddata": processed_data,
+        "apnoutput": stage_output(output_schema, output_line, processedat=time.time())
+    }
+    if document_type is not None:
+        updates["document_type"] = document_type.to_dict()
+
+    return {
+        "updates": updates,
+        "output_file": f"Outputs/{batch_name}/{batch_name}_APN.txt",
+        "output_schema": output_schema,
+        "output_line": output_line,
+        "plan": APN_PLAN,
+        "row": (image_name, batch_name, image_header_id, processed_data)
+    }
+
+def save_apn_result(collection, doc, processed_data: Dict, payload_store: PayloadStore = None,
+                    document_type: Classification = None):
+    """Write one document's APN result to Mongo and the batch output file."""
+    try:
+        result = build_apn_output(doc, processed_data, document_type)
+        output_schema = result["output_schema"]
+        output_line = result["output_line"]
+
+        # Print formatted output
+        print("\nProcessed Output:")
+        print("-" * 80)
+        print(f"Schema:  {output_schema}")
+        print(f"Values:  {output_line}")
+        print("-" * 80)
+
+        # Save to output file; the status is only updated once the line is written
+        get_output_writer().write(result["output_file"], output_schema, output_line).result()
+        export_result(result)
+
+        # Update MongoDB; stage payloads go to the payload store when one is given
+        updates = {"status": "apnpassed", **result["updates"]}
+        collection.update_one(
+            {"_id": doc['_id']},
+            payload_store.offload_update(updates) if payload_store else {"$set": updates}
+        )
+
+        print(f"Successfully processed document {doc['_id']}")
+
+    except Exception as e:
+        mark_apn_failed(collection, doc, e)
+
+def mark_apn_failed(collection, doc, error: Exception):
+    print(f"Error processing document {doc['_id']}: {error}")
+    collection.update_one(
+        {"_id": doc['_id']},
+        {"$set": {
+            "status": "apnfailed",
+            "apnerror": str(error),
+            "apnoutput": {
+                "error": str(error),
+                "processedat": time.time()
+            }
+        }}
+    )
+
 # MongoDB Configuration
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "admin"
@@ -270,6 +474,8 @@ def process_ocr_data():
         client = MongoClient(MONGO_URI)
         database = client[DB_NAME]
         collection = database[COLLECTION_NAME]
+        payload_store = PayloadStore(database[PAYLOAD_COLLECTION])
+        SchemaRegistry(database[SCHEMA_COLLECTION]).register(generate_header(), "apn")
         print(f"Connected to MongoDB database: {DB_NAME}")
         print(f"Monitoring collection: {COLLECTION_NAME}")
     except Exception as e:
@@ -280,7 +486,7 @@ def process_ocr_data():
         try:
             # Query for documents to process
             query = {"status": "ocrpassed", "apnpassed": {"$exists": False}}
-            unprocessed_docs = collection.find(query)
+            unprocessed_docs = raw_collection(collection).find(query)
             count = collection.count_documents(query)
             print(f"\nFound {count} unprocessed documents with OCR passed")
 
@@ -289,78 +495,26 @@ def process_ocr_data():
                 time.sleep(10)
                 continue
 
-            # Process each document
+            # Feed documents through the micro-batcher; the document type is decided here, at intake
+            document_types = {}
+            batcher = APNMicroBatcher(lambda done_doc, processed_data: save_apn_result(
+                collection, done_doc, processed_data, payload_store, document_types.pop(done_doc['_id'], None)))
             for doc in unprocessed_docs:
-                try:
-                    print(f"\nProcessing document ID: {doc['_id']}")
-                    print(f"Document fields: {list(doc.keys())}")
-
-                    # Extract text from OCR output
-                    ocr_output = doc.get('ocr_text', None)
-                    if not ocr_output:
-                        print(f"Warning: No ocr_text field found in document {doc['_id']}")
-                        continue
-                    
-                    print(f"OCR output type: {type(ocr_output)}")
-
-                    # Process with Claude (ensure post_process_with_llm is defined elsewhere)
-                    extracted_data = {"text": str(ocr_output)}
-                    processed_data = post_process_with_llm(extracted_data)  # Ensure this function exists
-                    
-                    # Prepare output
-                    image_name = doc.get('filename', 'unknown.TIF')
-                    batch_name = doc.get('foldername', 'default_batch')
-                    image_header_id = "1"
-                    
-                    output_schema = generate_header()  # Ensure this function exists
-                    output_line = format_output(image_name, batch_name, image_header_id, processed_data)
-
-                    # Print formatted output
-                    print("\nProcessed Output:")
-                    print("-" * 80)
-                    print(f"Schema:  {output_schema}")
-                    print(f"Values:  {output_line}")
-                    print("-" * 80)
-
-                    # Update MongoDB
-                    collection.update_one(
-                        {"_id": doc['_id']},
-                        {"$set": {
-                            "status": "apnpassed",
-                            "processeddata": processed_data,
-                            "apnoutput": {
-                                "schema": output_schema,
-                                "value": output_line,
-                                "processedat": time.time()
-                            }
-                        }}
-                    )
-                    
-                    # Save to output file
-                    output_file = f"Outputs/{batch_name}/{batch_name}_APN.txt"
-                    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-                    # Write to file
-                    with open(output_file, "a") as f:
-                        if os.path.getsize(output_file) == 0:  # File is empty
-                            f.write(output_schema + "\n")  # Write header
-                        f.write(output_line + "\n")  # Append data
-
-                    print(f"Successfully processed document {doc['_id']}")
+                doc = payload_store.lazy(doc)
+                print(f"\nQueueing document ID: {doc['_id']}")
 
-                except Exception as e:
-                    print(f"Error processing document {doc['_id']}: {e}")
-                    collection.update_one(
-                        {"_id": doc['_id']},
-                        {"$set": {
-                            "status": "apnfailed",
-                            "apnerror": str(e),
-                            "apnoutput": {
-                                "error": str(e),
-                                "processedat": time.time()
-                            }
-                        }}
-                    )
+                # Extract text from OCR output
+                ocr_output = doc.get('ocr_text', None)
+                if not ocr_output:
+                    print(f"Warning: No ocr_text field found in document {doc['_id']}")
+                    continue
+
+                text, _ = prepare_document_text(doc)
+                document_types[doc['_id']] = classify_document(text)
+                batcher.add(doc, text)
+
+            batcher.flush()
+            close_expired_exports()
 
             time.sleep(10)
 
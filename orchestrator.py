@@ -0,0 +1,312 @@
+"""Single-process pipeline running all stages as one asyncio DAG.
+
+The standalone services hand documents to each other through Mongo status
+strings, paying a write, a poll interval and a full re-read per hop. In
+orchestrator mode a document is read once and flows through bounded
+in-memory queues:
+
+    intake -> APN (micro-batched) -> property | mailing | legal -> checkpoint
+
+Property, mailing and legal run concurrently per document. Mongo is only
+written at the checkpoint, with one update holding every stage's fields.
+The checkpoint is journaled like the legal service's results, so a document
+whose lines reached the files before a crash is finished from the journal
+instead of being extracted and written again.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+from config import (MONGO_URI, DB_NAME, COLLECTION_NAME, OUTPUT_COLLECTION, NEAR_DUP_COLLECTION,
+                    ORCHESTRATOR_QUEUE_SIZE, ORCHESTRATOR_WORKERS, ORCHESTRATOR_POLL_INTERVAL)
+import main_apn
+import property_processor
+import document_processor_mailing
+from document_processor import LegalDocumentProcessor, LEGAL_PROMPT_VERSION
+from dedup_index import NearDuplicateIndex
+from parcel_cache import PARCEL_COLLECTION, ParcelCache, parcel_key
+from document_type import classify_document, route_for
+from text_prep import prepare_document_text
+from output_writer import get_output_writer
+from parquet_export import export_result, close_expired_exports
+from batch_merge import STAGES, finalize_batches
+from payload_store import PAYLOAD_COLLECTION, PayloadStore
+from schema_registry import SCHEMA_COLLECTION, SchemaRegistry, schema_version
+from raw_document import raw_collection
+from journal import OutputJournal, prompt_version
+from utils import LEGAL_PLAN, process_single_document, generate_header as generate_legal_header
+
+INTAKE_STATUS = "ocrpassed"
+FINAL_STATUS = "legalpassed"
+ERROR_STATUS = "error"
+
+# Stage order matches the service chain, so legal's processed_data wins as before
+STAGE_PLANS = {
+    "apn": main_apn.APN_PLAN,
+    "property": property_processor.PROPERTY_PLAN,
+    "mailing": document_processor_mailing.MAILING_PLAN,
+    "legal": LEGAL_PLAN
+}
+
+# Journal key version: a change to any stage's prompt or tool reprocesses documents once
+ORCHESTRATOR_VERSION = prompt_version(LEGAL_PROMPT_VERSION, main_apn.system_prompt, main_apn.APN_TOOL,
+                                      property_processor.PROPERTY_TOOL, document_processor_mailing.MAILING_TOOL)
+
+
+class PipelineOrchestrator:
+    def __init__(self, collection, output_collection, dedup_index=None, payload_store=None, parcel_cache=None,
+                 queue_size: int = ORCHESTRATOR_QUEUE_SIZE, workers: int = ORCHESTRATOR_WORKERS,
+                 journal: OutputJournal = None):
+        self.collection = collection
+        self.output_collection = output_collection
+        self.dedup_index = dedup_index
+        self.payload_store = payload_store
+        self.parcel_cache = parcel_cache
+        self.queue_size = queue_size
+        self.workers = workers
+
+        self.apn_queue = asyncio.Queue(maxsize=queue_size)
+        self.fanout_queue = asyncio.Queue(maxsize=queue_size)
+        self.checkpoint_queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = set()
+        self.finished_batches = set()
+
+        self.legal_processor = LegalDocumentProcessor()
+        self.legal_header = generate_legal_header()
+        self.writer = get_output_writer()
+        self.journal = journal or OutputJournal("orchestrator", ORCHESTRATOR_VERSION)
+
+    async def intake(self):
+        """Read new documents a page at a time; queue puts block when stages fall behind."""
+        while True:
+            query = {"status": INTAKE_STATUS, "_id": {"$nin": list(self.in_flight)}}
+            docs = await asyncio.to_thread(
+                lambda: list(raw_collection(self.collection).find(query).limit(self.queue_size)))
+
+            if not docs:
+                if not self.in_flight:
+                    await asyncio.to_thread(self.finish_idle)
+                await asyncio.sleep(ORCHESTRATOR_POLL_INTERVAL)
+                continue
+
+            for doc in docs:
+                entry = self.journal.get(doc["_id"])
+                if entry is not None:
+                    await asyncio.to_thread(self.resume, doc["_id"], entry)
+                    continue
+                if self.payload_store is not None:
+                    doc = self.payload_store.lazy(doc)
+                self.in_flight.add(doc["_id"])
+                # Offloaded OCR fields are fetched here, off the event loop
+                text, _ = await asyncio.to_thread(prepare_document_text, doc)
+                await self.apn_queue.put({"doc": doc, "text": text, "document_type": classify_document(text),
+                                          "results": {}, "errors": {}})
+
+    def finish_idle(self):
+        """Close expired Parquet parts and merge batches with no documents left in the pipeline."""
+        close_expired_exports()
+        if self.finished_batches:
+            self.writer.flush()
+            finalize_batches(self.collection, self.finished_batches, self.writer, compact_stages=STAGES)
+            self.finished_batches.clear()
+
+    async def apn_stage(self):
+        """Collect up to APN_BATCH_SIZE documents within APN_BATCH_WINDOW and extract them together."""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.apn_queue.get()]
+            deadline = loop.time() + main_apn.APN_BATCH_WINDOW
+            while len(items) < main_apn.APN_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.apn_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await asyncio.to_thread(main_apn.extract_apn_batch, [item["text"] for item in items])
+                for item, processed_data in zip(items, results):
+                    item["results"]["apn"] = main_apn.build_apn_output(item["doc"], processed_data,
+                                                                      item["document_type"])
+            except Exception as e:
+                for item in items:
+                    item["errors"]["apn"] = str(e)
+
+            for item in items:
+                await self.fanout_queue.put(item)
+
+    def run_property(self, doc, text: str, apn: str, document_type):
+        processed_data = property_processor.extract_property(doc, text, self.parcel_cache, apn)
+        return property_processor.build_property_output(doc, processed_data)
+
+    def run_mailing(self, doc, text: str, apn: str, document_type):
+        processed_data = document_processor_mailing.post_process_with_claude({"text": text})
+        return document_processor_mailing.build_mailing_output(doc, processed_data)
+
+    def run_legal(self, doc, text: str, apn: str, document_type):
+        result = process_single_document(doc, self.legal_processor, self.dedup_index, self.parcel_cache, apn,
+                                         document_type)
+        batch_name = result["batch_name"]
+        return {
+            "updates": {
+                "processed": True,
+                "processed_data": result["processed_data"]
+            },
+            "legal_record": result,
+            "output_file": f"Outputs/{batch_name}/{batch_name}_Legal.txt",
+            "output_schema": self.legal_header,
+            "output_line": result["output_line"],
+            "plan": result["plan"],
+            "row": result["row"]
+        }
+
+    async def fanout_stage(self):
+        """Run the stages that only depend on intake and APN concurrently for one document.
+
+        Only the stages routed for the document's type run; the others write no line.
+        """
+        all_stages = {"property": self.run_property, "mailing": self.run_mailing, "legal": self.run_legal}
+        while True:
+            item = await self.fanout_queue.get()
+            if not item["errors"]:
+                # The APN result keys the parcel cache for the property and legal stages
+                apn = parcel_key(item["results"]["apn"]["updates"]["processeddata"])
+                document_type = item["document_type"]
+                routed = route_for(document_type).stages
+                stages = {name: run for name, run in all_stages.items() if name in routed}
+                outcomes = await asyncio.gather(
+                    *(asyncio.to_thread(run, item["doc"], item["text"], apn, document_type)
+                      for run in stages.values()),
+                    return_exceptions=True
+                )
+                for name, outcome in zip(stages, outcomes):
+                    if isinstance(outcome, Exception):
+                        item["errors"][name] = str(outcome)
+                    else:
+                        item["results"][name] = outcome
+            await self.checkpoint_queue.put(item)
+
+    def checkpoint_payload(self, item) -> dict:
+        """Everything needed to finish a document without its stages: lines, rows and Mongo fields."""
+        doc = item["doc"]
+        stages = {}
+        updates = {}
+        for name in STAGE_PLANS:
+            result = item["results"].get(name)
+            if result is None:
+                continue
+            stages[name] = {key: result[key] for key in ("output_file", "output_schema", "output_line", "row")}
+            updates.update(result["updates"])
+
+        legal_record = None
+        if item["errors"]:
+            updates.update({"status": ERROR_STATUS, "error_message": item["errors"]})
+        else:
+            updates["status"] = FINAL_STATUS
+            record = item["results"]["legal"]["legal_record"]
+            legal_record = {
+                "original_id": doc["_id"],
+                "filename": record["image_name"],
+                "batch_name": record["batch_name"],
+                "output": record["output_line"],
+                "schema_version": schema_version(self.legal_header),
+                "processed_data": record["processed_data"],
+                "near_duplicate_of": record["near_duplicate_of"],
+                "status": FINAL_STATUS
+            }
+        return {"stages": stages, "updates": updates, "legal_record": legal_record}
+
+    def checkpoint(self, item):
+        """Write every stage's output line and one Mongo update for the document."""
+        doc_id = item["doc"]["_id"]
+        payload = self.checkpoint_payload(item)
+        if self.journal.state(doc_id) is None:
+            self.journal.record(doc_id, "result", payload)
+        self.finish(doc_id, payload)
+
+    def finish(self, doc_id, payload: dict):
+        """Complete the journaled steps of a checkpoint that have not happened yet."""
+        if self.journal.state(doc_id) == "result":
+            written = [self.writer.write(stage["output_file"], stage["output_schema"], stage["output_line"])
+                       for stage in payload["stages"].values()]
+            # Lines must reach the files before the status says the document is done; a failed write raises
+            for done in written:
+                done.result()
+            for name, stage in payload["stages"].items():
+                export_result({**stage, "plan": STAGE_PLANS[name]})
+            self.journal.record(doc_id, "written", payload)
+
+        legal_record = payload["legal_record"]
+        if legal_record is not None:
+            # Keyed on the source document so a replay does not duplicate it
+            self.output_collection.update_one({"original_id": doc_id}, {"$set": {
+                **legal_record, "processed_at": time.time()}}, upsert=True)
+
+        updates = payload["updates"]
+        self.collection.update_one({"_id": doc_id}, self.payload_store.offload_update(updates)
+                                   if self.payload_store is not None else {"$set": updates})
+        self.journal.record(doc_id, "done", payload)
+
+    def resume(self, doc_id, entry: dict):
+        """Finish a document found in the journal without running its stages again."""
+        payload = entry["payload"]
+        if entry["state"] == "done":
+            self.collection.update_one({"_id": doc_id}, {"$set": {"status": payload["updates"]["status"]}})
+            return
+        print(f"Resuming document {doc_id} from the journal ({entry['state']})")
+        try:
+            self.finish(doc_id, payload)
+            if payload["legal_record"] is not None:
+                self.finished_batches.add(payload["legal_record"]["batch_name"])
+        except Exception as e:
+            print(f"Error resuming document {doc_id}: {str(e)}")
+
+    async def checkpoint_stage(self):
+        while True:
+            item = await self.checkpoint_queue.get()
+            try:
+                await asyncio.to_thread(self.checkpoint, item)
+                if item["errors"]:
+                    print(f"Document {item['doc']['_id']} failed: {item['errors']}")
+                else:
+                    self.finished_batches.add(item["results"]["legal"]["legal_record"]["batch_name"])
+                    print(f"Document {item['doc']['_id']} completed all stages")
+            except Exception as e:
+                print(f"Error checkpointing document {item['doc']['_id']}: {str(e)}")
+            finally:
+                self.in_flight.discard(item["doc"]["_id"])
+
+    async def run(self):
+        # Each fan-out worker can hold three stage threads at once
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.workers * 3 + 4))
+        tasks = [asyncio.create_task(self.intake()), asyncio.create_task(self.apn_stage()),
+                 asyncio.create_task(self.checkpoint_stage())]
+        tasks += [asyncio.create_task(self.fanout_stage()) for _ in range(self.workers)]
+        await asyncio.gather(*tasks)
+
+
+def run_orchestrator():
+    print("Starting pipeline orchestrator...")
+    mongo_client = MongoClient(MONGO_URI)
+    db = mongo_client[DB_NAME]
+    registry = SchemaRegistry(db[SCHEMA_COLLECTION])
+    registry.register(main_apn.generate_header(), "apn")
+    registry.register(property_processor.generate_header(), "property")
+    registry.register(document_processor_mailing.generate_header(), "mailing")
+    registry.register(generate_legal_header(), "legal")
+    orchestrator = PipelineOrchestrator(
+        db[COLLECTION_NAME], db[OUTPUT_COLLECTION], NearDuplicateIndex(db[NEAR_DUP_COLLECTION]),
+        PayloadStore(db[PAYLOAD_COLLECTION]), ParcelCache(db[PARCEL_COLLECTION]))
+    asyncio.run(orchestrator.run())
+
+
+if __name__ == "__main__":
+    try:
+        run_orchestrator()
+    except KeyboardInterrupt:
+        print("\nStopping pipeline orchestrator...")
@@ -0,0 +1,287 @@
+"""Memory-mapped sidecar index over a pipe-delimited output file.
+
+`{file}.idx` is an open-addressing hash table from ImageName to the byte
+offset and length of the image's current row, so one row can be read from
+a file of any size without scanning it. Writing a new row for an image
+supersedes the old one: the old row becomes dead bytes in the data file,
+and `compact` rewrites the file with only the live rows.
+
+Layout: a 48-byte header (magic, version, slot count, used slots, live
+rows, dead bytes, indexed data size) followed by 24-byte slots (key hash,
+offset, length, state). The indexed data size lets `open` detect an index
+that is out of step with its data file (a crash, or a file rewritten by
+something else) and rebuild it from the data.
+
+Keys are 64-bit blake2b hashes of the ImageName. Lookups check the row they
+read, and writers trust the hash.
+"""
+import hashlib
+import mmap
+import os
+import struct
+from typing import Iterator, Optional, Tuple
+
+MAGIC = b"OIDX"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sIQQQQQ")
+SLOT = struct.Struct("<QQII")
+
+EMPTY, LIVE, DELETED = 0, 1, 2
+MIN_SLOTS = 1024
+MAX_LOAD = 0.7
+
+# Bytes written per row terminator, as the text-mode output files translate "\n"
+LINE_END_BYTES = len(os.linesep.encode("utf-8"))
+
+
+def key_hash(image_name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(image_name.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def row_key(line: str) -> str:
+    """ImageName of a row; it is the first column of every stage's output."""
+    return line.split("|", 1)[0]
+
+
+class OutputIndex:
+    def __init__(self, data_path: str, slot_count: int = MIN_SLOTS, readonly: bool = False):
+        self.data_path = data_path
+        self.path = data_path + ".idx"
+        self.readonly = readonly
+        self._file = None
+        self._map = None
+
+        if not os.path.exists(self.path) and not readonly:
+            self._create(self.path, slot_count)
+        self._map_file()
+
+    @classmethod
+    def open(cls, data_path: str) -> "OutputIndex":
+        """Open the index of `data_path`, rebuilding it when missing or stale."""
+        index = cls(data_path)
+        data_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        if index.data_size != data_size:
+            index.rebuild()
+        return index
+
+    @staticmethod
+    def _create(path: str, slot_count: int):
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, slot_count, 0, 0, 0, 0))
+            f.truncate(HEADER.size + slot_count * SLOT.size)
+
+    def _map_file(self):
+        self.close()
+        self._file = open(self.path, "rb" if self.readonly else "r+b")
+        access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+        magic, version, *_ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Not an output index: {self.path}")
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        if self._map is not None and not self.readonly:
+            self._map.flush()
+
+    # Header fields
+    def _header(self) -> list:
+        return list(HEADER.unpack_from(self._map, 0))
+
+    def _set_header(self, **values):
+        fields = self._header()
+        names = ["magic", "version", "slot_count", "used", "live", "dead_bytes", "data_size"]
+        for name, value in values.items():
+            fields[names.index(name)] = value
+        HEADER.pack_into(self._map, 0, *fields)
+
+    @property
+    def slot_count(self) -> int:
+        return self._header()[2]
+
+    @property
+    def live(self) -> int:
+        return self._header()[4]
+
+    @property
+    def dead_bytes(self) -> int:
+        return self._header()[5]
+
+    @property
+    def data_size(self) -> int:
+        return self._header()[6]
+
+    def _slot(self, i: int) -> Tuple[int, int, int, int]:
+        return SLOT.unpack_from(self._map, HEADER.size + i * SLOT.size)
+
+    def _set_slot(self, i: int, *values):
+        SLOT.pack_into(self._map, HEADER.size + i * SLOT.size, *values)
+
+    def _probe(self, hashed: int) -> Iterator[int]:
+        slot_count = self.slot_count
+        start = hashed % slot_count
+        for step in range(slot_count):
+            yield (start + step) % slot_count
+
+    # Writer side
+    def put(self, image_name: str, offset: int, length: int, data_size: int):
+        """Point `image_name` at a new row; a previous row for it becomes dead."""
+        hashed = key_hash(image_name)
+        _, _, slot_count, used, live, dead_bytes, _ = self._header()
+        reuse = None
+        for i in self._probe(hashed):
+            slot_hash, _, slot_length, state = self._slot(i)
+            if state == EMPTY:
+                target = reuse if reuse is not None else i
+                self._set_slot(target, hashed, offset, length, LIVE)
+                self._set_header(used=used + (reuse is None), live=live + 1, data_size=data_size)
+                break
+            if state == DELETED and reuse is None:
+                reuse = i
+            elif state == LIVE and slot_hash == hashed:
+                self._set_slot(i, hashed, offset, length, LIVE)
+                self._set_header(dead_bytes=dead_bytes + slot_length, data_size=data_size)
+                break
+
+        if self._header()[3] > slot_count * MAX_LOAD:
+            self._resize(slot_count * 2)
+
+    def tombstone(self, image_name: str) -> bool:
+        """Mark an image's row dead without writing a replacement."""
+        hashed = key_hash(image_name)
+        for i in self._probe(hashed):
+            slot_hash, offset, length, state = self._slot(i)
+            if state == EMPTY:
+                return False
+            if state == LIVE and slot_hash == hashed:
+                self._set_slot(i, slot_hash, offset, length, DELETED)
+                self._set_header(live=self.live - 1, dead_bytes=self.dead_bytes + length)
+                return True
+        return False
+
+    def set_data_size(self, data_size: int):
+        self._set_header(data_size=data_size)
+
+    def live_rows(self) -> Iterator[Tuple[int, int]]:
+        """(offset, length) of every live row, in file order."""
+        rows = []
+        for i in range(self.slot_count):
+            _, offset, length, state = self._slot(i)
+            if state == LIVE:
+                rows.append((offset, length))
+        return iter(sorted(rows))
+
+    def _resize(self, slot_count: int):
+        rows = [self._slot(i) for i in range(self.slot_count)]
+        dead_bytes, data_size = self.dead_bytes, self.data_size
+        partial = self.path + ".partial"
+        self._create(partial, slot_count)
+        self.close()
+        os.replace(partial, self.path)
+        self._map_file()
+
+        live = 0
+        for hashed, offset, length, state in rows:
+            if state != LIVE:
+                continue
+            for i in self._probe(hashed):
+                if self._slot(i)[3] == EMPTY:
+                    self._set_slot(i, hashed, offset, length, LIVE)
+                    live += 1
+                    break
+        self._set_header(used=live, live=live, dead_bytes=dead_bytes, data_size=data_size)
+
+    def rebuild(self):
+        """Re-index the data file from scratch; later rows for an image supersede earlier ones."""
+        rows = []
+        data_size = 0
+        if os.path.exists(self.data_path):
+            with open(self.data_path, "rb") as f:
+                f.readline()
+                offset = f.tell()
+                for line in f:
+                    rows.append((line.split(b"|", 1)[0].decode("utf-8"), offset, len(line)))
+                    offset += len(line)
+                data_size = offset
+
+        slot_count = MIN_SLOTS
+        while slot_count * MAX_LOAD < 2 * len(rows):
+            slot_count *= 2
+        partial = self.path + ".partial"
+        self._create(partial, slot_count)
+        self.close()
+        os.replace(partial, self.path)
+        self._map_file()
+        for image_name, offset, length in rows:
+            self.put(image_name, offset, length, data_size)
+        self.set_data_size(data_size)
+
+    # Reader side
+    def locate(self, image_name: str) -> Optional[Tuple[int, int]]:
+        hashed = key_hash(image_name)
+        for i in self._probe(hashed):
+            slot_hash, offset, length, state = self._slot(i)
+            if state == EMPTY:
+                return None
+            if state == LIVE and slot_hash == hashed:
+                return offset, length
+        return None
+
+    def compact(self) -> int:
+        """Rewrite the data file with only its header and live rows, then re-index it.
+
+        The caller must have closed any handle appending to the data file.
+        :return: Bytes reclaimed
+        """
+        before = os.path.getsize(self.data_path)
+        partial = self.data_path + ".partial"
+        with open(self.data_path, "rb") as src, open(partial, "wb") as dst:
+            dst.write(src.readline())
+            for offset, length in self.live_rows():
+                src.seek(offset)
+                dst.write(src.read(length))
+        os.replace(partial, self.data_path)
+        self.rebuild()
+        reclaimed = before - os.path.getsize(self.data_path)
+        print(f"Compacted {self.data_path}: reclaimed {reclaimed} bytes")
+        return reclaimed
+
+
+def lookup(data_path: str, image_name: str) -> Optional[str]:
+    """Current row for `image_name` in a pipe file, read through its index.
+
+    A file written before indexing was enabled has no index yet; one is built
+    from the data file on first lookup.
+    """
+    if not os.path.exists(data_path):
+        return None
+    if os.path.exists(data_path + ".idx"):
+        index = OutputIndex(data_path, readonly=True)
+    else:
+        index = OutputIndex.open(data_path)
+    try:
+        located = index.locate(image_name)
+    finally:
+        index.close()
+    if located is None:
+        return None
+
+    offset, length = located
+    with open(data_path, "rb") as f:
+        f.seek(offset)
+        line = f.read(length).decode("utf-8").rstrip("\r\n")
+    return line if row_key(line) == image_name else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    row = lookup(sys.argv[1], sys.argv[2])
+    print(row if row is not None else f"{sys.argv[2]} not found in {sys.argv[1]}")
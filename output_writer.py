@@ -0,0 +1,243 @@
+"""Single-writer append service for the per-batch pipe-delimited output files.
+
+Stages used to reopen their output file for every document, re-read the
+first line to check the header, and could interleave lines when several
+threads wrote at once. OutputWriter serializes every write through one queue
+and one writer thread, which keeps a buffered handle per file, remembers in
+memory whether the header has been written, fsyncs on an interval and closes
+idle handles least-recently-used first.
+
+With OUTPUT_INDEX enabled the writer also maintains each file's
+output_index sidecar as it appends. When the queue is idle it compacts files
+whose superseded rows exceed OUTPUT_COMPACT_RATIO of their size.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from output_index import LINE_END_BYTES, OutputIndex, row_key
+
+OUTPUT_FSYNC_INTERVAL = float(os.getenv("OUTPUT_FSYNC_INTERVAL", "2.0"))
+OUTPUT_IDLE_TIMEOUT = float(os.getenv("OUTPUT_IDLE_TIMEOUT", "60"))
+OUTPUT_MAX_OPEN_FILES = int(os.getenv("OUTPUT_MAX_OPEN_FILES", "32"))
+OUTPUT_INDEX = os.getenv("OUTPUT_INDEX", "true").lower() == "true"
+OUTPUT_COMPACT_RATIO = float(os.getenv("OUTPUT_COMPACT_RATIO", "0.5"))
+
+_STOP = object()
+
+
+class _Handle:
+    def __init__(self, f, offset: int, index: OutputIndex = None):
+        self.file = f
+        self.offset = offset
+        self.index = index
+        self.last_used = time.time()
+        self.dirty = False
+
+
+class _Rewrite:
+    def __init__(self, path: str, fn):
+        self.path = path
+        self.fn = fn
+        self.future = Future()
+
+
+class OutputWriter:
+    def __init__(self, fsync_interval: float = OUTPUT_FSYNC_INTERVAL,
+                 idle_timeout: float = OUTPUT_IDLE_TIMEOUT, max_open_files: int = OUTPUT_MAX_OPEN_FILES):
+        self.fsync_interval = fsync_interval
+        self.idle_timeout = idle_timeout
+        self.max_open_files = max_open_files
+
+        self._queue = queue.Queue()
+        self._handles = OrderedDict()
+        self._header_written = set()
+        self._last_sync = time.time()
+        self._thread = threading.Thread(target=self._run, name="output-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path: str, header: str, line: str) -> Future:
+        """Queue `line` for `path`; the header is written first if the file is new or empty.
+
+        :return: Future resolved once the line has been flushed to the OS, or failed with the
+            write error; check it before recording the line as written
+        """
+        done = Future()
+        self._queue.put((path, header, line, done))
+        return done
+
+    def rewrite(self, path: str, fn) -> Future:
+        """Run `fn(path)` on the writer thread with the file closed, e.g. to compact it.
+
+        Lines queued before the call are written first; later ones go to the rewritten file.
+        """
+        rewrite = _Rewrite(path, fn)
+        self._queue.put(rewrite)
+        return rewrite.future
+
+    def flush(self):
+        """Block until every queued line has been written and flushed."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _open(self, path: str) -> _Handle:
+        handle = self._handles.get(path)
+        if handle is not None:
+            self._handles.move_to_end(path)
+            return handle
+
+        while len(self._handles) >= self.max_open_files:
+            _, oldest = self._handles.popitem(last=False)
+            self._close_handle(oldest)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        f = open(path, "a", encoding="utf-8")
+        index = OutputIndex.open(path) if OUTPUT_INDEX else None
+        handle = self._handles[path] = _Handle(f, os.path.getsize(path), index)
+        if handle.offset > 0:
+            self._header_written.add(path)
+        return handle
+
+    def _close_handle(self, handle: _Handle):
+        handle.file.flush()
+        if handle.dirty:
+            os.fsync(handle.file.fileno())
+        handle.file.close()
+        if handle.index is not None:
+            handle.index.flush()
+            handle.index.close()
+
+    def _append(self, handle: _Handle, text: str) -> int:
+        handle.file.write(text + "\n")
+        length = len(text.encode("utf-8")) + LINE_END_BYTES
+        handle.offset += length
+        return length
+
+    def _write(self, path: str, header: str, line: str):
+        handle = self._open(path)
+        if path not in self._header_written:
+            self._append(handle, header)
+            self._header_written.add(path)
+            print(f"Created new file with header: {path}")
+        for row in line.split("\n"):
+            offset = handle.offset
+            length = self._append(handle, row)
+            if handle.index is not None:
+                handle.index.put(row_key(row), offset, length, handle.offset)
+        handle.last_used = time.time()
+        handle.dirty = True
+
+    def _rewrite(self, rewrite: "_Rewrite"):
+        handle = self._handles.pop(rewrite.path, None)
+        if handle is not None:
+            self._close_handle(handle)
+        # Reopening checks the rewritten file for a header again and re-indexes it
+        self._header_written.discard(rewrite.path)
+        try:
+            rewrite.future.set_result(rewrite.fn(rewrite.path))
+        except Exception as e:
+            rewrite.future.set_exception(e)
+        if os.path.exists(rewrite.path + ".idx"):
+            os.remove(rewrite.path + ".idx")
+
+    def _compact_dead_rows(self):
+        """Rewrite open files whose superseded rows exceed OUTPUT_COMPACT_RATIO of the file."""
+        for path, handle in list(self._handles.items()):
+            index = handle.index
+            if index is None or index.dead_bytes <= OUTPUT_COMPACT_RATIO * max(1, handle.offset):
+                continue
+            del self._handles[path]
+            self._close_handle(handle)
+            try:
+                compacting = OutputIndex.open(path)
+                compacting.compact()
+                compacting.close()
+            except Exception as e:
+                print(f"Error compacting output file {path}: {str(e)}")
+
+    def _maintain(self):
+        now = time.time()
+        if now - self._last_sync >= self.fsync_interval:
+            for handle in self._handles.values():
+                if handle.dirty:
+                    handle.file.flush()
+                    os.fsync(handle.file.fileno())
+                    if handle.index is not None:
+                        handle.index.flush()
+                    handle.dirty = False
+            self._last_sync = now
+
+        for path in [p for p, h in self._handles.items() if now - h.last_used >= self.idle_timeout]:
+            self._close_handle(self._handles.pop(path))
+
+    def _flush_pending(self, pending: list):
+        error = None
+        for handle in self._handles.values():
+            try:
+                handle.file.flush()
+            except Exception as e:
+                error = e
+        for done in pending:
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+        pending.clear()
+
+    def _run(self):
+        # Futures of lines written but not yet flushed; resolved when the queue drains
+        pending = []
+        while True:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                self._maintain()
+                self._compact_dead_rows()
+                continue
+
+            if item is _STOP:
+                self._flush_pending(pending)
+                for handle in self._handles.values():
+                    self._close_handle(handle)
+                self._handles.clear()
+                self._queue.task_done()
+                return
+
+            if isinstance(item, _Rewrite):
+                self._flush_pending(pending)
+                self._rewrite(item)
+                self._queue.task_done()
+                continue
+
+            path, header, line, done = item
+            try:
+                self._write(path, header, line)
+                pending.append(done)
+            except Exception as e:
+                print(f"Error writing output file {path}: {str(e)}")
+                done.set_exception(e)
+            if self._queue.empty() or len(pending) >= 256:
+                self._flush_pending(pending)
+            self._queue.task_done()
+            self._maintain()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_output_writer() -> OutputWriter:
+    """Process-wide writer, started on first use and closed at exit."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = OutputWriter()
+            atexit.register(_writer.close)
+        return _writer
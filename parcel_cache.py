@@ -0,0 +1,154 @@
+"""Cross-batch cache of property and legal fields keyed by parcel number.
+
+Deeds, releases and liens for the same parcel keep coming back in later
+batches, and each one paid for a fresh property (and legal) extraction.
+After the APN stage, a document's APN_AIN identifies its parcel. The
+parcels collection keeps, per normalized APN and stage, a snapshot of the
+last trustworthy extraction:
+
+    {"_id": "1234567890", "property": {"fields": {...}, "doc_id": ..., "updated_at": ..., "conflicted": false}}
+
+Legal snapshots hold only LEGAL_PARCEL_FIELDS, the fields that describe the
+land itself (APN, lot, block, tract, map and survey references); the
+document type, its completeness and any interest conveyed are extracted
+for every document.
+
+A snapshot is stored only when every value it found has at least
+PARCEL_MIN_CONFIDENCE. A stage reuses it while it is younger than
+PARCEL_MAX_AGE_DAYS. When two successive snapshots of a parcel disagree,
+the entry is marked conflicted, and documents of that parcel go to Claude
+until two successive extractions agree again.
+"""
+import os
+import re
+import time
+from typing import Callable, Dict, List, Mapping, Optional
+
+from pymongo import ReturnDocument
+
+from result_types import FieldResult
+from field_validation import MISSING_VALUES
+
+PARCEL_COLLECTION = os.getenv("PARCEL_COLLECTION", "parcels")
+PARCEL_MAX_AGE_DAYS = float(os.getenv("PARCEL_MAX_AGE_DAYS", "365"))
+PARCEL_MIN_CONFIDENCE = 90
+
+# Shorter APNs are too likely to be a misread fragment to key a cache on
+MIN_APN_LENGTH = 6
+
+CACHE_FLAG = "PARCEL_CACHE"
+
+# Legal fields shared by every document of a parcel
+LEGAL_PARCEL_FIELDS = [
+    "APN_AIN", "APN_Section", "Parcel", "Sub_Parcel",
+    "LotNumber", "Lot_Tract_Number", "Block", "TractNumber", "PhaseValue", "Common_Area_Lot",
+    "Map_Book", "Map_Page_From", "Map_Page_Thru", "Map_Date", "Map_Name", "Map_Number", "Plat_Document_Number",
+    "Meridian", "SectionNumber", "Township", "Range", "Quarters", "Government_TractNO", "Government_LotNO",
+    "Arb", "Arb_Tract", "Building", "UnitNumber",
+    "Condo_Time_Share_Plan_Book", "Condo_Time_Share_Plan_Date", "Condo_Time_Share_Plan_Number",
+    "Condo_Time_Share_Plan_Page_From", "Condo_Time_Share_Plan_Page_Thru",
+]
+
+_NON_ALNUM = re.compile(r"[^A-Z0-9]+")
+
+
+def normalize_apn(value) -> Optional[str]:
+    """APN with separators removed (XXX-XXX-XXX and XXXXXXXXX are the same parcel), or None."""
+    if value is None:
+        return None
+    apn = _NON_ALNUM.sub("", str(value).upper())
+    return apn if len(apn) >= MIN_APN_LENGTH and apn != "NONE" else None
+
+
+def parcel_key(apn_data: Mapping) -> Optional[str]:
+    """Normalized APN of an APN stage result, when it was read with high confidence."""
+    entry = (apn_data or {}).get("APN_AIN")
+    if entry is None or (entry.get("confidence") or 0) < PARCEL_MIN_CONFIDENCE:
+        return None
+    return normalize_apn(entry.get("value"))
+
+
+def _is_found(entry) -> bool:
+    return entry is not None and str(entry.get("value") or "") not in MISSING_VALUES
+
+
+class ParcelCache:
+    """Parcel snapshots persisted in a Mongo collection."""
+
+    def __init__(self, collection, max_age_days: float = PARCEL_MAX_AGE_DAYS,
+                 min_confidence: int = PARCEL_MIN_CONFIDENCE):
+        self.collection = collection
+        self.max_age = max_age_days * 86400
+        self.min_confidence = min_confidence
+
+    def get(self, apn: str, stage: str) -> Optional[Dict]:
+        """Fresh, unconflicted snapshot fields of `stage` for a parcel, or None."""
+        if not apn:
+            return None
+        entry = self.collection.find_one({"_id": apn}, {stage: 1})
+        snapshot = (entry or {}).get(stage)
+        if not snapshot or snapshot.get("conflicted"):
+            return None
+        if time.time() - snapshot.get("updated_at", 0) > self.max_age:
+            return None
+        return snapshot["fields"]
+
+    def put(self, apn: str, stage: str, processed_data: Mapping, fields: List[str], doc_id=None,
+            required: List[str] = ()) -> bool:
+        """Store `fields` of a stage result as the parcel's snapshot when it is trustworthy.
+
+        :param required: Fields that must have been found for the snapshot to be useful
+        :return: True when the snapshot was stored
+        """
+        if not apn:
+            return False
+        entries = {field: processed_data.get(field) for field in fields}
+        found = {field: entry for field, entry in entries.items() if _is_found(entry)}
+        if any((entry.get("confidence") or 0) < self.min_confidence for entry in found.values()):
+            return False
+        if any(field not in found for field in required):
+            return False
+        if any(CACHE_FLAG in (entry.get("flags") or []) for entry in found.values()):
+            # Already served from this cache; storing it again would mask conflicts
+            return False
+
+        snapshot_fields = {
+            field: {"value": str(entry["value"]), "confidence": entry["confidence"]} if field in found
+            else {"value": "", "confidence": 0}
+            for field, entry in entries.items()
+        }
+        # One pipeline update compares with the stored snapshot and replaces it, so
+        # two documents of a parcel finishing together cannot both miss a conflict
+        previous_fields = f"${stage}.fields"
+        differs = [{"$ne": [f"{previous_fields}.{field}.value", {"$literal": snapshot_fields[field]["value"]}]}
+                   for field in fields]
+        stored = self.collection.find_one_and_update({"_id": apn}, [{"$set": {stage: {
+            "fields": {"$literal": snapshot_fields},
+            "doc_id": {"$literal": doc_id},
+            "updated_at": time.time(),
+            "conflicted": {"$and": [{"$ne": [{"$type": previous_fields}, "missing"]}, {"$or": differs}]}
+        }}}], projection={f"{stage}.conflicted": 1}, upsert=True, return_document=ReturnDocument.AFTER)
+        conflicted = stored[stage]["conflicted"]
+        if conflicted:
+            print(f"Parcel {apn}: {stage} fields differ from the previous extraction, cache disabled until they agree")
+        return True
+
+
+def reuse_parcel(cached: Dict, field_names: List[str], missing_value: str = "",
+                 extract_fields: Callable[[List[str]], Mapping] = None) -> Dict:
+    """Build a stage result from a parcel snapshot; fields it lacks are extracted or left missing."""
+    processed_data = {}
+    for field in field_names:
+        if field in cached:
+            value = cached[field]["value"]
+            if value:
+                processed_data[field] = FieldResult(value, cached[field]["confidence"], [CACHE_FLAG])
+            else:
+                processed_data[field] = FieldResult(missing_value, 0, ["FIELD_NOT_FOUND", CACHE_FLAG])
+
+    remaining = [field for field in field_names if field not in processed_data]
+    if remaining:
+        extracted = extract_fields(remaining) if extract_fields is not None else {}
+        for field in remaining:
+            processed_data[field] = extracted.get(field) or FieldResult.missing(missing_value)
+    return {field: processed_data[field] for field in field_names}
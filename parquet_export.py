@@ -0,0 +1,293 @@
+"""Columnar Parquet export of stage results, written next to the pipe files.
+
+The pipe files store everything as text, including HIGH/LOW confidence
+labels, so consumers re-parse every row. With PARQUET_EXPORT enabled each
+stage result is also written to a Parquet part file beside its pipe file
+(`Outputs/{batch}/{batch}_Legal.txt` -> `{batch}_Legal-<start ms>-<part>.parquet`):
+
+    image_name, batch_name, image_header_id   dictionary-encoded strings
+    <field>                                    dictionary-encoded string
+    <field>_confidence                         uint8, the numeric score
+    <field>_flags                              list<string>
+    <constant columns>                         e.g. IsFromModel, XrefRemarks
+
+Rows are buffered and written as a row group every PARQUET_ROW_GROUP_SIZE
+documents. A part file is closed when its batch is finalized, once it holds
+PARQUET_PART_ROWS rows, or once it has been open PARQUET_PART_AGE seconds, so
+parts stay large however often a stage polls. A batch's part files together
+form one Parquet dataset. `convert_pipe_file` turns an
+existing pipe file into the same layout.
+
+pyarrow is optional; without it the export is skipped with a warning.
+"""
+import atexit
+import itertools
+import os
+import threading
+import time
+from typing import Dict, List
+
+from result_types import FieldResult, StageResult
+from row_format import KEY_COLUMNS, CONFIDENCE_PREFIX, ColumnPlan
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, results are then only written to the pipe files
+    pa = None
+    pq = None
+
+PARQUET_EXPORT = os.getenv("PARQUET_EXPORT", "false").lower() == "true"
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP_SIZE", "1000"))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+# A part file is closed after this many rows or seconds, whichever comes first
+PARQUET_PART_ROWS = int(os.getenv("PARQUET_PART_ROWS", "100000"))
+PARQUET_PART_AGE = float(os.getenv("PARQUET_PART_AGE", "3600"))
+
+# Scores used for the labels of converted pipe files (the H and L codes of the compact format)
+LABEL_CONFIDENCE = {"HIGH": 95, "LOW": 50}
+
+KEY_FIELDS = ["image_name", "batch_name", "image_header_id"]
+
+
+def stage_schema(fields: List[str], constant_columns: List[str] = ()):
+    """Arrow schema for one stage's results."""
+    text = pa.dictionary(pa.int32(), pa.string())
+    columns = [pa.field(name, text) for name in KEY_FIELDS]
+    for field in fields:
+        columns += [
+            pa.field(field, text),
+            pa.field(f"{field}_confidence", pa.uint8()),
+            pa.field(f"{field}_flags", pa.list_(pa.string()))
+        ]
+    columns += [pa.field(name, text) for name in constant_columns]
+    return pa.schema(columns)
+
+
+def _confidence(entry) -> int:
+    if isinstance(entry, FieldResult):
+        confidence = entry.confidence
+    else:
+        confidence = entry.get("confidence", 0) if isinstance(entry, dict) else 0
+    return max(0, min(100, int(confidence or 0)))
+
+
+def _value(entry):
+    if isinstance(entry, FieldResult):
+        value = entry.value
+    else:
+        value = entry.get("value") if isinstance(entry, dict) else None
+    return None if value in (None, "") else str(value)
+
+
+def _flags(entry) -> List[str]:
+    if isinstance(entry, FieldResult):
+        return list(entry.flags or [])
+    return list(entry.get("flags") or []) if isinstance(entry, dict) else []
+
+
+class StagePartWriter:
+    """Buffers one stage's rows and writes them to a Parquet file a row group at a time."""
+
+    def __init__(self, path: str, fields: List[str], constants: Dict[str, str],
+                 row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        self.path = path
+        self.fields = list(fields)
+        self._field_tuple = tuple(self.fields)
+        self.constants = dict(constants)
+        self.row_group_size = row_group_size
+        self.schema = stage_schema(self.fields, list(self.constants))
+        self._columns = {name: [] for name in self.schema.names}
+        self._rows = 0
+        self._writer = None
+        self.rows_written = 0
+        self.opened_at = time.time()
+
+    def expired(self, max_rows: int = PARQUET_PART_ROWS, max_age: float = PARQUET_PART_AGE) -> bool:
+        """Whether the part has reached its row or age limit."""
+        return self.rows_written >= max_rows or time.time() - self.opened_at >= max_age
+
+    def add(self, image_name: str, batch_name: str, image_header_id: str, data: Dict):
+        columns = self._columns
+        columns["image_name"].append(image_name)
+        columns["batch_name"].append(batch_name)
+        columns["image_header_id"].append(image_header_id)
+        if isinstance(data, StageResult) and data.fields == self._field_tuple:
+            entries = data.entries
+        else:
+            entries = [data.get(field) for field in self.fields]
+        for field, entry in zip(self.fields, entries):
+            columns[field].append(_value(entry))
+            columns[f"{field}_confidence"].append(_confidence(entry))
+            columns[f"{field}_flags"].append(_flags(entry))
+        for name, value in self.constants.items():
+            columns[name].append(value)
+
+        self._rows += 1
+        self.rows_written += 1
+        if self._rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._writer = pq.ParquetWriter(self.path, self.schema, compression=PARQUET_COMPRESSION)
+        table = pa.Table.from_pydict(self._columns, schema=self.schema)
+        self._writer.write_table(table)
+        self._columns = {name: [] for name in self.schema.names}
+        self._rows = 0
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class ResultExporter:
+    """Routes stage results to one open part file per pipe file."""
+
+    def __init__(self, row_group_size: int = PARQUET_ROW_GROUP_SIZE, part_rows: int = PARQUET_PART_ROWS,
+                 part_age: float = PARQUET_PART_AGE):
+        self.row_group_size = row_group_size
+        self.part_rows = part_rows
+        self.part_age = part_age
+        self._parts = {}
+        self._part_batches = {}
+        self._part_numbers = itertools.count()
+        self._lock = threading.Lock()
+
+    def part_path(self, output_file: str) -> str:
+        stem, _ = os.path.splitext(output_file)
+        # The counter keeps a part rotated within the same millisecond from reusing a name
+        return f"{stem}-{int(time.time() * 1000)}-{next(self._part_numbers)}.parquet"
+
+    def export(self, output_file: str, plan: ColumnPlan, image_name: str, batch_name: str,
+               image_header_id: str, data: Dict):
+        with self._lock:
+            part = self._parts.get(output_file)
+            if part is None:
+                part = self._parts[output_file] = StagePartWriter(
+                    self.part_path(output_file), plan.fields, plan.constants, self.row_group_size)
+                self._part_batches[output_file] = batch_name
+            part.add(image_name, batch_name, image_header_id, data)
+            if part.rows_written >= self.part_rows:
+                self._close_part(output_file)
+
+    def _close_part(self, output_file: str):
+        part = self._parts.pop(output_file)
+        self._part_batches.pop(output_file, None)
+        try:
+            part.close()
+            print(f"Wrote Parquet export: {part.path}")
+        except Exception as e:
+            print(f"Error writing Parquet export for {output_file}: {str(e)}")
+
+    def close(self, batch_names=None):
+        """Write buffered rows and close the part files of `batch_names`, or every part file."""
+        with self._lock:
+            for output_file in list(self._parts):
+                if batch_names is None or self._part_batches.get(output_file) in batch_names:
+                    self._close_part(output_file)
+
+    def close_expired(self):
+        """Close the part files that have reached their row or age limit."""
+        with self._lock:
+            for output_file in list(self._parts):
+                if self._parts[output_file].expired(self.part_rows, self.part_age):
+                    self._close_part(output_file)
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_result_exporter():
+    """Process-wide exporter, or None when PARQUET_EXPORT is off or pyarrow is missing."""
+    global _exporter, PARQUET_EXPORT
+    with _exporter_lock:
+        if _exporter is None and PARQUET_EXPORT:
+            if pa is None:
+                print("PARQUET_EXPORT is enabled but pyarrow is not installed; skipping Parquet export")
+                PARQUET_EXPORT = False
+                return None
+            _exporter = ResultExporter()
+            atexit.register(_exporter.close)
+        return _exporter
+
+
+def export_result(result: Dict):
+    """Export a stage result built by one of the build_*_output helpers.
+
+    The pipe file is the record of truth, so a failed export is logged and never
+    stops the caller from marking the document written.
+    """
+    exporter = get_result_exporter()
+    if exporter is None:
+        return
+    try:
+        exporter.export(result["output_file"], result["plan"], *result["row"])
+    except Exception as e:
+        print(f"Error exporting {result['output_file']} to Parquet: {str(e)}")
+
+
+def close_exports(batch_names=None):
+    """Close the part files of finalized batches, or every open part file."""
+    if _exporter is not None:
+        _exporter.close(set(batch_names) if batch_names is not None else None)
+
+
+def close_expired_exports():
+    """Close part files past their row or age limit; called from the stages' poll loops."""
+    if _exporter is not None:
+        _exporter.close_expired()
+
+
+def convert_pipe_file(path: str, output_path: str = None, row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> str:
+    """Convert an existing pipe file to the export layout, streaming a row group at a time.
+
+    Fields are the columns that have a CL_ column; HIGH/LOW labels become
+    LABEL_CONFIDENCE scores and flags are empty, as the pipe files carry none.
+    :return: Path of the Parquet file
+    """
+    if pq is None:
+        raise ImportError("pyarrow is required to convert pipe files to Parquet")
+
+    output_path = output_path or os.path.splitext(path)[0] + ".parquet"
+    with open(path, "r", encoding="utf-8") as f:
+        columns = f.readline().rstrip("\r\n").split("|")
+        fields = [c for c in columns if c not in KEY_COLUMNS and CONFIDENCE_PREFIX + c in columns]
+        confidence_columns = {CONFIDENCE_PREFIX + field for field in fields}
+        others = [c for c in columns if c not in KEY_COLUMNS and c not in fields and c not in confidence_columns]
+
+        part = StagePartWriter(output_path, fields, {name: "" for name in others}, row_group_size)
+        index = {name: i for i, name in enumerate(columns)}
+        rows = 0
+        for line in f:
+            cells = line.rstrip("\r\n").split("|")
+            if len(cells) != len(columns):
+                print(f"Skipping malformed line {rows + 2} of {path}")
+                continue
+            data = {
+                field: {
+                    "value": cells[index[field]],
+                    "confidence": LABEL_CONFIDENCE.get(cells[index[CONFIDENCE_PREFIX + field]], 0)
+                }
+                for field in fields
+            }
+            part.constants = {name: cells[index[name]] for name in others}
+            part.add(cells[index["ImageName"]], cells[index["BatchName"]], cells[index["ImageHeaderID"]], data)
+            rows += 1
+        part.close()
+
+    print(f"Converted {rows} rows from {path} to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    import sys
+
+    for pipe_file in sys.argv[1:]:
+        convert_pipe_file(pipe_file)
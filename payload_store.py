@@ -0,0 +1,208 @@
+"""Compressed, content-addressed storage for bulky document fields.
+
+Queue documents carry the OCR text up to three times (`ocr_text`,
+`ocr_full_text`, `json_data`) and collect every stage's payload
+(`processed_data`, `propertydata`, `output_legal`, ...). Since every service
+polls the collection by status, all of that sits in the working set.
+
+PayloadStore moves those fields to a side collection. Each value is
+BSON-encoded and compressed with zstd, or zlib when zstandard is not
+installed. It is stored once under the hash of its content, so repeated
+text is shared. The queue document keeps only `payload_refs.<field>: <hash>`.
+
+Wrapping a queue document in LazyDocument (`store.lazy(doc)`) fetches an
+offloaded field the first time a stage reads it. Documents that were never
+slimmed behave exactly as before.
+"""
+import hashlib
+import itertools
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Iterable
+
+import bson
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, zlib is used instead
+    zstandard = None
+
+PAYLOAD_COLLECTION = os.getenv("PAYLOAD_COLLECTION", "payloads")
+PAYLOAD_CACHE_SIZE = int(os.getenv("PAYLOAD_CACHE_SIZE", "256"))
+PAYLOAD_ZSTD_LEVEL = 6
+
+# OCR inputs, written once before the pipeline starts
+OCR_FIELDS = ["ocr_text", "ocr_full_text", "json_data", "ocr_output"]
+
+# Stage results, written as each stage finishes
+STAGE_FIELDS = ["processed_data", "processeddata", "propertydata", "output_property",
+                "propertyoutput", "output_legal", "apnoutput"]
+
+OFFLOAD_FIELDS = OCR_FIELDS + STAGE_FIELDS
+
+
+def _compress(data: bytes):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=PAYLOAD_ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, 6)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd payloads")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class PayloadStore:
+    def __init__(self, collection, cache_size: int = PAYLOAD_CACHE_SIZE):
+        self.collection = collection
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value) -> str:
+        """Store `value` once per distinct content and return its hash."""
+        raw = bson.encode({"v": value})
+        digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        codec, data = _compress(raw)
+        self.collection.update_one(
+            {"_id": digest},
+            {"$setOnInsert": {"codec": codec, "data": bson.Binary(data), "size": len(raw),
+                              "created_at": time.time()}},
+            upsert=True
+        )
+        self._remember(digest, value)
+        return digest
+
+    def get(self, digest: str):
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+
+        stored = self.collection.find_one({"_id": digest})
+        if stored is None:
+            raise KeyError(f"Payload {digest} not found")
+        value = bson.decode(_decompress(stored["codec"], stored["data"]))["v"]
+        self._remember(digest, value)
+        return value
+
+    def _remember(self, digest: str, value):
+        with self._lock:
+            self._cache[digest] = value
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def lazy(self, doc: Dict) -> "LazyDocument":
+        return LazyDocument(doc, self)
+
+    def offload_update(self, updates: Dict, fields: Iterable[str] = STAGE_FIELDS) -> Dict:
+        """Turn a `$set` dict into an update that stores `fields` here and references them.
+
+        :return: Update document for `update_one`
+        """
+        offloaded = set(fields)
+        set_fields, unset_fields = {}, {}
+        for field, value in updates.items():
+            if field in offloaded and value is not None:
+                set_fields[f"payload_refs.{field}"] = self.put(value)
+                unset_fields[field] = ""
+            else:
+                set_fields[field] = value
+        update = {"$set": set_fields}
+        if unset_fields:
+            update["$unset"] = unset_fields
+        return update
+
+    def slim_document(self, collection, doc: Dict, fields: Iterable[str] = OFFLOAD_FIELDS) -> bool:
+        """Move a queue document's bulky fields here; returns False when it had none."""
+        updates = {field: doc[field] for field in fields if doc.get(field) is not None}
+        if not updates:
+            return False
+        collection.update_one({"_id": doc["_id"]}, self.offload_update(updates, updates.keys()))
+        return True
+
+
+class LazyDocument(MutableMapping):
+    """Queue document whose offloaded fields are fetched from the store on first access.
+
+    Reads and writes do not copy the wrapped document, so a LazyBSONDocument
+    underneath still decodes only the fields a stage reads.
+    """
+
+    def __init__(self, doc: Mapping, store: PayloadStore):
+        self._doc = doc
+        self._store = store
+        self._refs = doc.get("payload_refs") or {}
+        self._values = {}
+        self._removed = set()
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key in self._removed:
+            raise KeyError(key)
+        if key in self._doc:
+            return self._doc[key]
+        if key in self._refs:
+            value = self._store.get(self._refs[key])
+            self._values[key] = value
+            return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._removed.discard(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._removed.add(key)
+
+    def __contains__(self, key):
+        if key in self._removed:
+            return key in self._values
+        return key in self._values or key in self._doc or key in self._refs
+
+    def __iter__(self):
+        seen = set()
+        for key in itertools.chain(self._doc, self._refs, self._values):
+            if key not in seen and key in self:
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def slim_collection(collection, store: PayloadStore, query: Dict = None, batch_size: int = 500) -> int:
+    """Offload the bulky fields of every matching queue document.
+
+    :return: Number of documents slimmed
+    """
+    query = dict(query or {})
+    query["$or"] = [{field: {"$exists": True}} for field in OFFLOAD_FIELDS]
+    slimmed = 0
+    for doc in collection.find(query, batch_size=batch_size):
+        if store.slim_document(collection, doc):
+            slimmed += 1
+            if slimmed % 1000 == 0:
+                print(f"Slimmed {slimmed} documents")
+    print(f"Slimmed {slimmed} documents in {collection.name}")
+    return slimmed
+
+
+if __name__ == "__main__":
+    from pymongo import MongoClient
+    from config import MONGO_URI, DB_NAME, COLLECTION_NAME
+
+    db = MongoClient(MONGO_URI)[DB_NAME]
+    slim_collection(db[COLLECTION_NAME], PayloadStore(db[PAYLOAD_COLLECTION]))
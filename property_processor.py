@@ -8,6 +8,23 @@ import io
 from anthropic import Anthropic
 from pymongo import MongoClient
 import time
+from singleflight import coalesce_by_text
+from concurrency import limit_client
+from text_prep import prepare_document_text
+from output_writer import get_output_writer
+from row_format import ColumnPlan
+from parquet_export import export_result, close_expired_exports
+from batch_merge import batch_name_of
+from config import PROPERTY_OUTPUT_DIR
+from payload_store import PAYLOAD_COLLECTION, PayloadStore
+from schema_registry import SCHEMA_COLLECTION, SchemaRegistry, stage_output
+from raw_document import raw_collection
+from field_validation import FieldValidator
+from zip_reference import reconcile_address
+from parcel_cache import PARCEL_COLLECTION, ParcelCache, parcel_key, reuse_parcel
+from document_type import document_type_of, route_for
+from llm_schema import (build_compact_tool, compact_instructions, compile_compact_decoder,
+                        estimate_max_tokens, forced_tool_choice, get_tool_input)
 
 # Load environment variables
 load_dotenv()
@@ -19,7 +36,7 @@ REGION = os.getenv('AWS_REGION')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 MONGO_URI = os.getenv('MONGO_URI')
 
-if not all([ACCESS_KEY, SECRET_KEY, REGION, ANTHROPIC_API_KEY, MONGO_URI]):
+if not all([ACCESS_KEY, SECRET_KEY, REGION, ANTHROPIC_API_KEY]):
     raise ValueError("Required credentials not found in environment variables")
 
 textract_client = boto3.client(
@@ -29,7 +46,7 @@ textract_client = boto3.client(
     region_name=REGION
 )
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+anthropic_client = limit_client(Anthropic(api_key=ANTHROPIC_API_KEY))
 
 # Update the FIELD_INSTRUCTIONS dictionary to match exact schema order
 FIELD_INSTRUCTIONS = {
@@ -151,18 +168,24 @@ FIELD_INSTRUCTIONS = {
 
 FIELD_GROUPS = list(FIELD_INSTRUCTIONS.keys())
 
-# MongoDB configuration
+PROPERTY_TOOL = build_compact_tool(
+    "record_property_address",
+    "Record the extracted property address fields with confidence and flags.",
+    FIELD_INSTRUCTIONS
+)
+decode_property_response = compile_compact_decoder(FIELD_INSTRUCTIONS, missing_value="NONE", name="PropertyResult")
+PROPERTY_VALIDATOR = FieldValidator(FIELD_INSTRUCTIONS)
+PROPERTY_MAX_TOKENS = estimate_max_tokens(FIELD_INSTRUCTIONS)
+
+# A property result is only worth caching for its parcel when these were found
+ADDRESS_KEY_FIELDS = ["House_Number", "Street_Name", "City", "State"]
+
+# MongoDB configuration of the standalone service; the orchestrator passes its own collections in
 DB_NAME = "Documenttask"
 COLLECTION_NAME = "imagesdemo_erl"
 
-# Initialize MongoDB client
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-collection = db[COLLECTION_NAME]
-
 # Add these constants at the top of the file
 INPUT_DIR = os.path.join(os.getcwd(), "input", "documents")
-OUTPUT_DIR = os.path.join(os.getcwd(), "output", "processed")
 
 def generate_header():
     """Generate header matching exact schema structure"""
@@ -176,46 +199,15 @@ def generate_header():
             "CL_Carrier_Route|CL_Latitude|CL_Longitude|CL_Census_Tract_block|CL_House_Number_|"
             "IsFromModel|XrefRemarks")
 
+# CL_ columns follow the header's order, which differs from the field order
+PROPERTY_PLAN = ColumnPlan(generate_header(), FIELD_GROUPS, {"IsFromModel": "N", "XrefRemarks": "NONE"},
+                           missing_value="NONE", upper=True)
+
 def format_output(image_name: str, batch_name: str, image_header_id: str, extracted_data: Dict) -> str:
     """Format output line matching exact schema structure"""
-    # Base fields
-    output_fields = [image_name, batch_name, image_header_id]
-    
-    # Data fields in correct order
-    field_order = [
-        "Property_Address_Level", "Block_ID", "House_Number", "House_Number_Alpha",
-        "Pre_Direction", "Street_Name", "Street_Suffix", "Post_Direction",
-        "Unit_Designator", "Unit_Number", "City", "State", "Zip", "Zip_4",
-        "Carrier_Route", "Latitude", "Longitude", "Census_Tract_block", "House_Number_"
-    ]
-    
-    # Add field values in correct order
-    for field in field_order:
-        field_data = extracted_data.get(field, {})
-        value = field_data.get("value", "") if isinstance(field_data, dict) else ""
-        value = str(value).upper() if value else "NONE"
-        output_fields.append(value)
-    
-    # Confidence levels in correct order
-    confidence_order = [
-        "Property_Address_Level", "Block_ID", "House_Number", "House_Number_Alpha",
-        "Pre_Direction", "Street_Name", "Street_Suffix", "Post_Direction",
-        "Unit_Designator", "Unit_Number", "City", "State", "Zip", "Zip_4",
-        "Carrier_Route", "Latitude", "Longitude", "Census_Tract_block", "House_Number_"
-    ]
-    
-    # Add confidence levels
-    for field in confidence_order:
-        field_data = extracted_data.get(field, {})
-        confidence = field_data.get("confidence", 0) if isinstance(field_data, dict) else 0
-        confidence_label = "HIGH"  # Default to HIGH as shown in example
-        output_fields.append(confidence_label)
-    
-    # Add IsFromModel and XrefRemarks
-    output_fields.extend(["N", "NONE"])
-    
-    return "|".join(output_fields)
+    return PROPERTY_PLAN.format_row(image_name, batch_name, image_header_id, extracted_data)
 
+@coalesce_by_text("property")
 def post_process_with_llm(extracted_data: Dict, retry_count=0) -> Dict:
     """Process extracted text with Claude with retry mechanism"""
     
@@ -249,78 +241,46 @@ Even partial matches are valid:
 TEXT TO ANALYZE:
 {text}
 
-RESPONSE FORMAT:
-{{
-    "House_Number": {{ "value": "EXTRACTED_NUMBER", "confidence": 90 }},
-    "Street_Name": {{ "value": "STREET_NAME", "confidence": 90 }},
-    "Street_Suffix": {{ "value": "STREET_TYPE", "confidence": 90 }},
-    "City": {{ "value": "CITY_NAME", "confidence": 90 }},
-    "State": {{ "value": "ST", "confidence": 90 }},
-    "Zip": {{ "value": "ZIP_CODE", "confidence": 90 }}
-}}
+{response_instructions}
 
 IMPORTANT:
 - ALL text must be UPPERCASE
 - Use "NONE" only if absolutely nothing is found
 - Include partial matches rather than using "NONE"
-- Look for address components anywhere in the text""".format(text=ocr_text)
+- Look for address components anywhere in the text""".format(text=ocr_text, response_instructions=compact_instructions(PROPERTY_TOOL))
 
     try:
         response = anthropic_client.messages.create(
             model="claude-3-sonnet-20240229",
-            max_tokens=4096,
+            max_tokens=PROPERTY_MAX_TOKENS,
             temperature=0.1,
             system="You are an address extraction expert. Find ANY possible address information, even partial matches.",
-            messages=[{"role": "user", "content": prompt}]
+            messages=[{"role": "user", "content": prompt}],
+            tools=[PROPERTY_TOOL],
+            tool_choice=forced_tool_choice(PROPERTY_TOOL)
         )
         
-        # Print Claude's response for debugging
+        try:
+            formatted_response = decode_property_response(
+                get_tool_input(response, PROPERTY_TOOL["name"]))
+        except ValueError as e:
+            print(f"Response validation error: {str(e)}")
+            if retry_count < 2:
+                return post_process_with_llm(extracted_data, retry_count + 1)
+            return {field: {"value": "NONE", "confidence": 90} for field in FIELD_GROUPS}
+        
         print("\nClaude Response:")
         print("-" * 80)
-        print(response.content[0].text)
+        print(json.dumps(formatted_response, default=dict)[:500])  # Print first 500 chars of response
         print("-" * 80)
-
-        response_text = response.content[0].text
-        print("\nClaude Response:")
-        print(response_text[:500])  # Print first 500 chars of response
         
-        # Parse JSON response
-        start_index = response_text.find('{')
-        end_index = response_text.rfind('}') + 1
-        
-        if start_index == -1 or end_index == 0:
-            if retry_count < 2:  # Retry up to 2 times
-                print(f"Retry attempt {retry_count + 1}")
-                return post_process_with_llm(extracted_data, retry_count + 1)
-            return {field: {"value": "NONE", "confidence": 90} for field in FIELD_GROUPS}
-            
-        try:
-            json_response = response_text[start_index:end_index]
-            parsed_response = json.loads(json_response)
-            
-            # Format response
-            formatted_response = {}
-            for field in FIELD_GROUPS:
-                field_data = parsed_response.get(field, {})
-                value = field_data.get("value", "")
-                formatted_response[field] = {
-                    "value": str(value).upper() if value else "NONE",
-                    "confidence": field_data.get("confidence", 90)
-                }
-            
-            # Validate response
-            if all(formatted_response[field]["value"] == "NONE" for field in ["House_Number", "Street_Name", "City", "State"]):
-                if retry_count < 2:
-                    print("No address components found, retrying...")
-                    return post_process_with_llm(extracted_data, retry_count + 1)
-            
-            return formatted_response
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON Parse Error: {str(e)}")
+        # Validate response
+        if all(formatted_response[field]["value"] == "NONE" for field in ADDRESS_KEY_FIELDS):
             if retry_count < 2:
+                print("No address components found, retrying...")
                 return post_process_with_llm(extracted_data, retry_count + 1)
-            return {field: {"value": "NONE", "confidence": 90} for field in FIELD_GROUPS}
+        
+        return formatted_response
 
     except Exception as e:
         print(f"Claude API Error: {str(e)}")
@@ -353,21 +313,81 @@ def get_field_rules(field: str) -> str:
     }
     return rules.get(field, "No specific rules")
 
+def extract_property(doc, text: str, parcel_cache: ParcelCache = None, apn: str = None) -> Dict:
+    """Property fields of a document: its parcel's cached address when there is one, else Claude.
+
+    :param parcel_cache: Cache of the caller's database; without one every document goes to Claude
+    :param apn: Normalized APN of the document; read from its APN stage result when not given
+    """
+    if parcel_cache is not None and apn is None:
+        apn = parcel_key(doc.get("processeddata"))
+    cached = parcel_cache.get(apn, "property") if parcel_cache is not None else None
+    if cached is not None:
+        print(f"Reusing the cached property address of parcel {apn}")
+        return reuse_parcel(cached, FIELD_GROUPS, missing_value="NONE")
+
+    processed_data = post_process_with_llm({"text": text})
+    PROPERTY_VALIDATOR.validate(processed_data)
+    reconcile_address(processed_data)
+    if parcel_cache is not None:
+        parcel_cache.put(apn, "property", processed_data, FIELD_GROUPS, doc["_id"], required=ADDRESS_KEY_FIELDS)
+    return processed_data
+
+def build_property_output(doc, processed_data: Dict) -> Dict:
+    """Format one document's property result: Mongo fields, output file and line."""
+    image_name = doc.get('filename', 'unknown.TIF')
+    batch_name = batch_name_of(doc)
+    PROPERTY_VALIDATOR.validate(processed_data)
+    reconcile_address(processed_data)
+    output_schema = generate_header()
+    output_line = format_output(image_name, batch_name, "1", processed_data)
+    
+    # Header is stored once in the schema registry; rehydrate with SchemaRegistry.rehydrate
+    output_property = stage_output(output_schema, output_line, processed_at=time.time(), status="completed")
+    
+    return {
+        "updates": {
+            "propertydata": processed_data,
+            "output_property": output_property
+        },
+        "output_file": os.path.join(PROPERTY_OUTPUT_DIR, batch_name, f"{batch_name}_Property.txt"),
+        "output_schema": output_schema,
+        "output_line": output_line,
+        "plan": PROPERTY_PLAN,
+        "row": (image_name, batch_name, "1", processed_data)
+    }
+
 def process_property_data():
     """Monitor MongoDB collection and process new property data"""
     print("Starting property data processing service...")
+    if not MONGO_URI:
+        raise ValueError("MONGO_URI not found in environment variables")
+    mongo_client = MongoClient(MONGO_URI)
+    db = mongo_client[DB_NAME]
+    collection = db[COLLECTION_NAME]
+    payload_store = PayloadStore(db[PAYLOAD_COLLECTION])
+    schema_registry = SchemaRegistry(db[SCHEMA_COLLECTION])
+    parcel_cache = ParcelCache(db[PARCEL_COLLECTION])
     print(f"Connected to MongoDB database: {DB_NAME}")
     print(f"Monitoring collection: {COLLECTION_NAME}")
+    schema_registry.register(generate_header(), "property")
     
     while True:
         try:
             query = {"status": "partypassed"}
-            unprocessed_docs = collection.find(query)
+            unprocessed_docs = raw_collection(collection).find(query)
             
             for doc in unprocessed_docs:
+                doc = payload_store.lazy(doc)
                 print(f"\nProcessing document ID: {doc['_id']}")
                 print(f"Filename: {doc.get('filename', 'unknown')}")
                 
+                document_type = document_type_of(doc)
+                if "property" not in route_for(document_type).stages:
+                    print(f"Skipping property extraction for document type {document_type.code}")
+                    collection.update_one({"_id": doc['_id']}, {"$set": {"status": "propertypassed"}})
+                    continue
+                
                 ocr_text = doc.get('ocr_text', '')
                 if not ocr_text:
                     print("No OCR text found!")
@@ -377,67 +397,40 @@ def process_property_data():
                 print("\nFirst 200 chars of OCR text:")
                 print(ocr_text[:200])
                 
-                extracted_data = {"text": str(ocr_text)}
-                processed_data = post_process_with_llm(extracted_data)
+                prepared_text, _ = prepare_document_text(doc)
+                processed_data = extract_property(doc, prepared_text, parcel_cache)
                 
                 # Validate extracted data
-                if all(processed_data[field].get("value") == "NONE" for field in ["House_Number", "Street_Name", "City", "State"]):
+                if all(processed_data[field].get("value") == "NONE" for field in ADDRESS_KEY_FIELDS):
                     print("Warning: No address components found, retrying with different prompt...")
                     # Could add fallback processing here
                     
                 # Format output
-                image_name = doc.get('filename', 'unknown.TIF')
-                batch_name = doc.get('cat_name', '06107-20241205-01')
-                output_schema = generate_header()
-                output_line = format_output(image_name, batch_name, "1", processed_data)
+                result = build_property_output(doc, processed_data)
+                output_schema = result["output_schema"]
+                output_line = result["output_line"]
                 
-                # Create output_property structure
-                output_property = {
-                    "schema": output_schema.split("|"),
-                    "values": output_line.split("|"),
-                    "raw_line": output_line,
-                    "processed_at": time.time(),
-                    "status": "completed"
-                }
+                # Write output file with header; raises before the status update if it fails
+                get_output_writer().write(result["output_file"], output_schema, output_line).result()
+                export_result(result)
                 
                 # Update MongoDB with results
                 collection.update_one(
                     {"_id": doc['_id']},
-                    {"$set": {
+                    payload_store.offload_update({
                         "status": "propertypassed",  # Update status to propertypassed
-                        "propertydata": processed_data,
-                        "output_property": output_property,
-                        "propertyoutput": {
-                            "schema": output_schema,
-                            "value": output_line,
-                            "processedat": time.time()
-                        }
-                    }}
+                        **result["updates"]
+                    })
                 )
-                
-                # Write output file with header
-                output_file = os.path.join(OUTPUT_DIR, batch_name, f"{batch_name}_Property.txt")
-                os.makedirs(os.path.dirname(output_file), exist_ok=True)
-                
-                # Always write header if file doesn't exist
-                if not os.path.exists(output_file):
-                    with open(output_file, "w", encoding='utf-8') as f:
-                        header = generate_header()
-                        f.write(f"{header}\n")
-                        print(f"Created new file with header: {output_file}")
-                
-                with open(output_file, "a", encoding='utf-8') as f:
-                    
-                
-                    # Write the output line
-                    f.write(output_line + "\n")
-                    
+
                 print(f"Successfully processed document {doc['_id']}")
                 print("\nProcessed Output:")
                 print("-" * 80)
                 print("Schema:  " + output_schema)
                 print("Values:  " + output_line)
                 print("-" * 80)
+
+            close_expired_exports()
                 
         except Exception as e:
             print(f"Error in main processing loop: {str(e)}")
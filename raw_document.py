@@ -0,0 +1,194 @@
+"""Queue documents that decode only the fields a stage reads.
+
+A stage loop fetches whole queue documents but reads a handful of fields
+(`_id`, `filename`, `cat_name`, `ocr_text`). Decoding the rest, such as
+`output_party.parties`, `json_data` and earlier stages' payloads, costs CPU
+and allocations on every document of a large backlog.
+
+`raw_collection(collection).find(...)` reads the results with
+find_raw_batches, so the driver hands back each batch as raw BSON bytes, and
+wraps every document of a batch in a LazyBSONDocument. On first access the
+document scans its element headers once to find each top-level field's
+offset, without decoding any value. Each field is decoded, as plain dicts and
+lists, the first time it is read. LazyBSONDocument is a read-only Mapping, so
+the stage functions run against it unchanged.
+
+The collection's document class is left alone: the driver decodes its own
+command replies with it, and a lazy reply would hand back the cursor's
+documents as plain dicts.
+"""
+import os
+import struct
+from collections.abc import ItemsView, KeysView, ValuesView
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+
+RAW_DOCUMENTS = os.getenv("RAW_DOCUMENTS", "true").lower() == "true"
+
+_INT32 = struct.Struct("<i")
+
+# Value sizes of the fixed-width BSON types
+_FIXED_SIZES = {
+    0x01: 8,    # double
+    0x06: 0,    # undefined
+    0x07: 12,   # ObjectId
+    0x08: 1,    # boolean
+    0x09: 8,    # UTC datetime
+    0x0A: 0,    # null
+    0x10: 4,    # int32
+    0x11: 8,    # timestamp
+    0x12: 8,    # int64
+    0x13: 16,   # decimal128
+    0x7F: 0,    # max key
+    0xFF: 0,    # min key
+}
+_STRING_TYPES = (0x02, 0x0D, 0x0E)        # string, code, symbol
+_LENGTH_PREFIXED_TYPES = (0x03, 0x04, 0x0F)  # document, array, code with scope
+
+
+def _value_size(raw: bytes, type_byte: int, start: int) -> int:
+    if type_byte in _FIXED_SIZES:
+        return _FIXED_SIZES[type_byte]
+    if type_byte in _STRING_TYPES:
+        return 4 + _INT32.unpack_from(raw, start)[0]
+    if type_byte in _LENGTH_PREFIXED_TYPES:
+        return _INT32.unpack_from(raw, start)[0]
+    if type_byte == 0x05:  # binary: length, subtype, data
+        return 5 + _INT32.unpack_from(raw, start)[0]
+    if type_byte == 0x0B:  # regex: pattern and options cstrings
+        return raw.index(b"\x00", raw.index(b"\x00", start) + 1) + 1 - start
+    if type_byte == 0x0C:  # DBPointer: string and ObjectId
+        return 4 + _INT32.unpack_from(raw, start)[0] + 12
+    raise InvalidBSON(f"Unknown BSON type 0x{type_byte:02x}")
+
+
+def field_offsets(raw: bytes) -> dict:
+    """Start and end offset of every top-level element, found without decoding values."""
+    offsets = {}
+    position, end = 4, len(raw) - 1
+    while position < end:
+        name_end = raw.index(b"\x00", position + 1)
+        value_end = name_end + 1 + _value_size(raw, raw[position], name_end + 1)
+        offsets[raw[position + 1:name_end].decode("utf-8")] = (position, value_end)
+        position = value_end
+    return offsets
+
+
+class LazyBSONDocument(RawBSONDocument):
+    """Raw BSON document that decodes each top-level field on first access."""
+
+    __slots__ = ("_offsets", "_values", "_decode_options")
+
+    def __init__(self, bson_bytes, codec_options=None):
+        codec_options = codec_options or RAW_CODEC_OPTIONS
+        # Cursor batches hand over memoryview slices; bytes() is a no-op for bytes
+        super().__init__(bytes(bson_bytes), codec_options)
+        self._offsets = None
+        self._values = {}
+        self._decode_options = codec_options.with_options(document_class=dict)
+
+    def _index(self) -> dict:
+        if self._offsets is None:
+            self._offsets = field_offsets(self.raw)
+        return self._offsets
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        start, end = self._index()[key]
+        element = self.raw[start:end]
+        value = bson.decode(_INT32.pack(len(element) + 5) + element + b"\x00",
+                            codec_options=self._decode_options)[key]
+        self._values[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return key in self._index()
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def decoded_fields(self) -> list:
+        """Fields decoded so far, for checking what a stage actually reads."""
+        return list(self._values)
+
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=LazyBSONDocument)
+
+
+def iter_documents(batch, codec_options=RAW_CODEC_OPTIONS):
+    """LazyBSONDocuments of a raw batch, i.e. BSON documents laid end to end."""
+    view = memoryview(batch)
+    position = 0
+    while position < len(view):
+        size = _INT32.unpack_from(view, position)[0]
+        yield LazyBSONDocument(view[position:position + size], codec_options)
+        position += size
+
+
+class LazyCursor:
+    """Iterates a RawBatchCursor one LazyBSONDocument at a time."""
+
+    def __init__(self, raw_cursor, codec_options=RAW_CODEC_OPTIONS):
+        self._cursor = raw_cursor
+        self._codec_options = codec_options
+
+    def __iter__(self):
+        for batch in self._cursor:
+            yield from iter_documents(batch, self._codec_options)
+
+    def limit(self, limit: int) -> "LazyCursor":
+        self._cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size: int) -> "LazyCursor":
+        self._cursor.batch_size(batch_size)
+        return self
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RawCollection:
+    """Collection whose find() yields LazyBSONDocuments; everything else goes to the collection."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._codec_options = collection.codec_options.with_options(document_class=LazyBSONDocument)
+
+    def find(self, *args, **kwargs) -> LazyCursor:
+        return LazyCursor(self._collection.find_raw_batches(*args, **kwargs), self._codec_options)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+def raw_collection(collection):
+    """`collection` returning LazyBSONDocuments from find() (unchanged when RAW_DOCUMENTS is off)."""
+    if not RAW_DOCUMENTS:
+        return collection
+    return RawCollection(collection)
@@ -0,0 +1,175 @@
+"""Columnar container for the legal results of a whole batch.
+
+`process_document_batch` used to hold one dict per document, each with a
+processed_data dict of 64 field dicts, until the batch finished. ResultBatch
+keeps the same data as columns indexed by FIELD_GROUPS position:
+
+    values       one list per field; repeated strings share a single object
+    confidences  one array('B') per field, one byte per document
+    flags        one array('I') per field of codes into a table of distinct flag tuples
+
+plus a few per-document lists (doc id, image, batch, near-duplicate source).
+Rows are rebuilt as StageResults only while they are formatted or written,
+so output lines, Mongo bulk writes and statistics are produced from the
+columns without ever materializing the whole batch. The legal service
+collects streamed results into one and writes it every RESULT_BATCH_SIZE
+documents.
+"""
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List
+
+from pymongo import UpdateOne
+
+from field_definitions import FIELD_GROUPS
+from result_types import FieldResult, StageResult, compile_stage_result
+from row_format import ColumnPlan, HIGH_CONFIDENCE
+
+# Mongo operations sent per bulk_write call
+BULK_WRITE_SIZE = 500
+
+
+class ResultBatch:
+    def __init__(self, fields: List[str] = FIELD_GROUPS, name: str = "LegalResult"):
+        self.fields = tuple(fields)
+        self.result_type = compile_stage_result(name, self.fields)
+        self.doc_ids = []
+        self.image_names = []
+        self.batch_names = []
+        self.image_header_ids = []
+        self.near_duplicate_of = []
+        self.values = [[] for _ in self.fields]
+        self.confidences = [array("B") for _ in self.fields]
+        self.flag_codes = [array("I") for _ in self.fields]
+        self.flag_sets = []
+        self._flag_index = {}
+        self._strings = {}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _intern(self, value):
+        if value is None:
+            return ""
+        value = str(value)
+        return self._strings.setdefault(value, value)
+
+    def _flag_code(self, flags) -> int:
+        key = tuple(flags or ())
+        code = self._flag_index.get(key)
+        if code is None:
+            code = self._flag_index[key] = len(self.flag_sets)
+            self.flag_sets.append(key)
+        return code
+
+    def append(self, result: Dict):
+        """Add a process_single_document result; its processed_data is not kept."""
+        data = result["processed_data"]
+        if isinstance(data, StageResult) and data.fields == self.fields:
+            entries = data.entries
+        else:
+            entries = [data.get(field) or FieldResult.missing() for field in self.fields]
+
+        self.doc_ids.append(result["doc_id"])
+        self.image_names.append(result["image_name"])
+        self.batch_names.append(self._intern(result["batch_name"]))
+        self.image_header_ids.append(self._intern(result.get("image_header_id", "1")))
+        self.near_duplicate_of.append(result.get("near_duplicate_of"))
+        for position, entry in enumerate(entries):
+            self.values[position].append(self._intern(entry.get("value")))
+            self.confidences[position].append(max(0, min(100, int(entry.get("confidence") or 0))))
+            self.flag_codes[position].append(self._flag_code(entry.get("flags")))
+
+    def row(self, index: int) -> StageResult:
+        """processed_data of one document, rebuilt from the columns."""
+        return self.result_type([
+            FieldResult(self.values[position][index], self.confidences[position][index],
+                        list(self.flag_sets[self.flag_codes[position][index]]))
+            for position in range(len(self.fields))
+        ])
+
+    def row_key(self, index: int) -> tuple:
+        """(image_name, batch_name, image_header_id, processed_data) of one document."""
+        return self.image_names[index], self.batch_names[index], self.image_header_ids[index], self.row(index)
+
+    def rows(self, indices: Iterable[int] = None) -> Iterator[tuple]:
+        """row_key of each document, or of the documents at `indices`."""
+        for index in (range(len(self)) if indices is None else indices):
+            yield self.row_key(index)
+
+    def payload(self, index: int, plan: ColumnPlan) -> Dict:
+        """Journal payload of one document, as the legal service records it."""
+        image_name, batch_name, image_header_id, processed_data = self.row_key(index)
+        return {
+            "output_line": plan.format_row(image_name, batch_name, image_header_id, processed_data),
+            "processed_data": processed_data,
+            "image_name": image_name,
+            "batch_name": batch_name,
+            "near_duplicate_of": self.near_duplicate_of[index]
+        }
+
+    def by_batch(self) -> Dict[str, List[int]]:
+        """Document positions grouped by batch name, in arrival order."""
+        groups = {}
+        for index, batch_name in enumerate(self.batch_names):
+            groups.setdefault(batch_name, []).append(index)
+        return groups
+
+    def output_lines(self, plan: ColumnPlan) -> Iterator[str]:
+        for row in self.rows():
+            yield plan.format_row(*row)
+
+    def write_to_mongo(self, collection, output_collection, plan: ColumnPlan, status: str = "legalpassed",
+                       bulk_size: int = BULK_WRITE_SIZE, payload_store=None, **output_fields) -> int:
+        """Record every result in the output collection and mark its source document.
+
+        :param payload_store: Offloads processed_data from the queue documents when given
+        :param output_fields: Extra fields for each output record, e.g. schema_version
+        :return: Number of documents written
+        """
+        queue_ops, output_ops = [], []
+
+        def flush():
+            if output_ops:
+                output_collection.bulk_write(output_ops, ordered=False)
+                collection.bulk_write(queue_ops, ordered=False)
+                output_ops.clear()
+                queue_ops.clear()
+
+        for index, (image_name, batch_name, image_header_id, processed_data) in enumerate(self.rows()):
+            doc_id = self.doc_ids[index]
+            output_ops.append(UpdateOne({"original_id": doc_id}, {"$set": {
+                "original_id": doc_id,
+                "filename": image_name,
+                "batch_name": batch_name,
+                "output": plan.format_row(image_name, batch_name, image_header_id, processed_data),
+                "processed_data": processed_data,
+                "near_duplicate_of": self.near_duplicate_of[index],
+                "status": status,
+                **output_fields
+            }}, upsert=True))
+            updates = {"status": status, "processed": True, "processed_data": processed_data}
+            queue_ops.append(UpdateOne({"_id": doc_id}, payload_store.offload_update(updates)
+                                       if payload_store is not None else {"$set": updates}))
+            if len(output_ops) >= bulk_size:
+                flush()
+        flush()
+        return len(self)
+
+    def statistics(self) -> Dict[str, Dict]:
+        """Per-field fill rate, mean confidence, HIGH share and most common flags."""
+        count = max(1, len(self))
+        stats = {}
+        for position, field in enumerate(self.fields):
+            confidences = self.confidences[position]
+            flag_counts = Counter()
+            for code, occurrences in Counter(self.flag_codes[position]).items():
+                for flag in self.flag_sets[code]:
+                    flag_counts[flag] += occurrences
+            stats[field] = {
+                "filled": sum(1 for value in self.values[position] if value not in ("", "NONE")) / count,
+                "mean_confidence": sum(confidences) / count,
+                "high": sum(1 for confidence in confidences if confidence >= HIGH_CONFIDENCE) / count,
+                "flags": dict(flag_counts.most_common(5))
+            }
+        return stats
@@ -0,0 +1,106 @@
+"""Typed containers for extraction results.
+
+A stage result was a dict holding one {"value", "confidence", "flags"} dict
+per field, so every field of every document allocated a fresh dict.
+FieldResult is a `__slots__` object with those three attributes. Each stage
+compiles a StageResult subclass that keeps its FieldResults in a list, in
+field order, and shares one field -> position table across instances.
+
+Both are Mappings, so code that reads a result as a dict
+(`result[field]["value"]`, `.get("flags")`, `dict(result)`) keeps working,
+and BSON encodes them directly. ColumnPlan and the Parquet export read the
+attributes and entry list without lookups. JSON needs `default=dict`.
+"""
+import functools
+from collections.abc import Mapping
+from typing import Iterable, List
+
+FIELD_KEYS = ("value", "confidence", "flags")
+
+
+class FieldResult(Mapping):
+    __slots__ = FIELD_KEYS
+
+    def __init__(self, value="", confidence: int = 0, flags: List[str] = None):
+        self.value = value
+        self.confidence = confidence
+        self.flags = flags if flags is not None else []
+
+    @classmethod
+    def missing(cls, missing_value: str = "") -> "FieldResult":
+        return cls(missing_value, 0, ["FIELD_NOT_FOUND"])
+
+    def __getitem__(self, key):
+        if key in FIELD_KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in FIELD_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(FIELD_KEYS)
+
+    def __len__(self):
+        return len(FIELD_KEYS)
+
+    def __contains__(self, key):
+        return key in FIELD_KEYS
+
+    def __repr__(self):
+        return f"FieldResult({self.value!r}, {self.confidence!r}, {self.flags!r})"
+
+    def to_dict(self) -> dict:
+        return {"value": self.value, "confidence": self.confidence, "flags": list(self.flags)}
+
+
+class StageResult(Mapping):
+    """One stage's field results in field order; subclasses come from compile_stage_result."""
+
+    __slots__ = ("entries",)
+    fields = ()
+    _positions = {}
+
+    def __init__(self, entries: List[FieldResult]):
+        self.entries = entries
+
+    def __getitem__(self, field):
+        return self.entries[self._positions[field]]
+
+    def __setitem__(self, field, entry):
+        self.entries[self._positions[field]] = entry
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, field):
+        return field in self._positions
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(zip(self.fields, self.entries))!r})"
+
+    def __reduce__(self):
+        return _restore_stage_result, (type(self).__name__, self.fields, self.entries)
+
+    def to_dict(self) -> dict:
+        return {field: dict(entry) for field, entry in zip(self.fields, self.entries)}
+
+
+@functools.lru_cache(maxsize=64)
+def compile_stage_result(name: str, fields: Iterable[str]) -> type:
+    """StageResult subclass for `fields`, in that order."""
+    fields = tuple(fields)
+    return type(name, (StageResult,), {
+        "__slots__": (),
+        "fields": fields,
+        "_positions": {field: i for i, field in enumerate(fields)}
+    })
+
+
+def _restore_stage_result(name: str, fields: tuple, entries: List[FieldResult]) -> StageResult:
+    return compile_stage_result(name, fields)(entries)
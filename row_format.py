@@ -0,0 +1,100 @@
+"""Column plans for the pipe-delimited output files.
+
+Each stage's output file has a header of key columns, one column per field
+value, one CL_ column per field confidence and a few constant trailing
+columns. A ColumnPlan is compiled once from that header: it resolves every
+column to a slot up front, so formatting a row is one pass over the fields
+and a single join, and rows cannot drift out of step with the header.
+"""
+from typing import Dict, Iterable, List, Tuple
+
+from result_types import FieldResult, StageResult
+
+KEY_COLUMNS = ["ImageName", "BatchName", "ImageHeaderID"]
+CONFIDENCE_PREFIX = "CL_"
+
+# Confidence at or above this is labelled HIGH, anything else LOW
+HIGH_CONFIDENCE = 90
+
+
+def build_header(fields: List[str], trailing_columns: List[str] = ()) -> str:
+    """Header with the key columns, the fields, their CL_ columns and any trailing columns."""
+    return "|".join(KEY_COLUMNS + list(fields) + [CONFIDENCE_PREFIX + f for f in fields] + list(trailing_columns))
+
+
+class ColumnPlan:
+    """Row formatter compiled from a header.
+
+    :param header: Pipe-delimited header, e.g. from a stage's generate_header
+    :param fields: The stage's field names; each needs a value and a CL_ column
+    :param constants: Values for the remaining (trailing) columns
+    :param missing_value: Cell used when a field is missing or empty
+    :param upper: Upper-case field values
+    """
+
+    def __init__(self, header: str, fields: List[str], constants: Dict[str, str] = None,
+                 missing_value: str = "", upper: bool = False):
+        self.header = header
+        self.columns = header.split("|")
+        self.fields = list(fields)
+        self._field_tuple = tuple(self.fields)
+        self.constants = dict(constants or {})
+        self.missing_value = missing_value
+        self.upper = upper
+
+        # Row slots: key cells, field values, confidence labels, then constants
+        field_count = len(self.fields)
+        constant_names = list(self.constants)
+        slots = {name: i for i, name in enumerate(KEY_COLUMNS)}
+        for i, field in enumerate(self.fields):
+            slots[field] = len(KEY_COLUMNS) + i
+            slots[CONFIDENCE_PREFIX + field] = len(KEY_COLUMNS) + field_count + i
+        for i, name in enumerate(constant_names):
+            slots[name] = len(KEY_COLUMNS) + 2 * field_count + i
+
+        unknown = [column for column in self.columns if column not in slots]
+        if unknown:
+            raise ValueError(f"Header columns without a source: {unknown}")
+        unused = [column for column in slots if column not in self.columns]
+        if unused:
+            raise ValueError(f"Fields missing from the header: {unused}")
+
+        self._order = [slots[column] for column in self.columns]
+        self._constant_cells = [self.constants[name] for name in constant_names]
+
+    def _value_cell(self, entry) -> str:
+        if isinstance(entry, FieldResult):
+            value = entry.value
+        else:
+            value = entry.get("value") if isinstance(entry, dict) else None
+        if value is None or value == "":
+            return self.missing_value
+        return str(value).upper() if self.upper else str(value)
+
+    @staticmethod
+    def _confidence_cell(entry) -> str:
+        if isinstance(entry, FieldResult):
+            confidence = entry.confidence
+        else:
+            confidence = entry.get("confidence", 0) if isinstance(entry, dict) else 0
+        return "HIGH" if (confidence or 0) >= HIGH_CONFIDENCE else "LOW"
+
+    def format_row(self, image_name: str, batch_name: str, image_header_id: str, data: Dict) -> str:
+        if isinstance(data, StageResult) and data.fields == self._field_tuple:
+            entries = data.entries
+        else:
+            entries = [data.get(field) for field in self.fields]
+        cells = [image_name, batch_name, image_header_id]
+        cells += [self._value_cell(entry) for entry in entries]
+        cells += [self._confidence_cell(entry) for entry in entries]
+        cells += self._constant_cells
+        return "|".join([cells[slot] for slot in self._order])
+
+    def format_rows(self, rows: Iterable[Tuple[str, str, str, Dict]]) -> str:
+        """Format (image_name, batch_name, image_header_id, data) rows as one newline-joined block."""
+        return "\n".join([self.format_row(*row) for row in rows])
+
+    def error_row(self, image_name: str, batch_name: str, image_header_id: str) -> str:
+        """Row with ERROR in every column after the key columns."""
+        cells = {"ImageName": image_name, "BatchName": batch_name, "ImageHeaderID": image_header_id}
+        return "|".join([cells.get(column, "ERROR") for column in self.columns])
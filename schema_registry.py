@@ -0,0 +1,78 @@
+"""Registry of output schemas, so documents store a version id instead of a header.
+
+Stage outputs used to embed their full header in every document, as a
+string, as a split array or both. Each header is now stored once in the
+output_schemas collection under a hash of its text. A stage output holds
+only `schema_version` and its `values` array:
+
+    {"schema_version": "3f9c0a1b2c4d", "values": ["a.TIF", "06107-...", "1", ...], ...}
+
+The version is derived from the header itself, so building an output needs
+no database round trip; services register their headers once at startup.
+`SchemaRegistry.rehydrate` restores the schema, values and raw line.
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List
+
+SCHEMA_COLLECTION = os.getenv("SCHEMA_COLLECTION", "output_schemas")
+
+
+@functools.lru_cache(maxsize=64)
+def schema_version(header: str) -> str:
+    return hashlib.blake2b(header.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def stage_output(header: str, output_line: str, **fields) -> Dict:
+    """Compact stage output: schema version, values array and any extra fields."""
+    return {"schema_version": schema_version(header), "values": output_line.split("|"), **fields}
+
+
+class SchemaRegistry:
+    def __init__(self, collection):
+        self.collection = collection
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def register(self, header: str, stage: str = None) -> str:
+        """Store `header` under its version id (once) and return the id."""
+        version = schema_version(header)
+        with self._lock:
+            if version in self._columns:
+                return version
+        self.collection.update_one(
+            {"_id": version},
+            {"$setOnInsert": {"header": header, "columns": header.split("|"), "stage": stage,
+                              "registered_at": time.time()}},
+            upsert=True
+        )
+        with self._lock:
+            self._columns[version] = header.split("|")
+        return version
+
+    def columns(self, version: str) -> List[str]:
+        with self._lock:
+            if version in self._columns:
+                return self._columns[version]
+        stored = self.collection.find_one({"_id": version})
+        if stored is None:
+            raise KeyError(f"Unknown schema version {version}")
+        with self._lock:
+            self._columns[version] = stored["columns"]
+        return stored["columns"]
+
+    def rehydrate(self, output: Dict) -> Dict:
+        """Expand a compact stage output back to schema, values and raw line."""
+        if "schema_version" not in output:
+            return output
+        expanded = {key: value for key, value in output.items() if key != "schema_version"}
+        expanded["schema"] = self.columns(output["schema_version"])
+        expanded["raw_line"] = "|".join(output["values"])
+        return expanded
+
+    def as_record(self, output: Dict) -> Dict:
+        """Stage output as a column -> value dict."""
+        return dict(zip(self.columns(output["schema_version"]), output["values"]))
@@ -0,0 +1,98 @@
+"""Coalesce concurrent identical extraction calls into a single Claude request.
+
+Batches often contain re-scans and duplicate cover sheets with byte-identical
+OCR text. When those are processed concurrently, only the first call for a
+given (stage, text hash) goes to Claude; the others wait for it and receive a
+copy of its result.
+"""
+import copy
+import functools
+import hashlib
+import threading
+
+
+def text_hash(text) -> str:
+    """Stable hash of OCR text, accepting the list form stored in Mongo."""
+    if isinstance(text, list):
+        text = " ".join(str(item) for item in text)
+    return hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its outcome."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Each caller gets its own copy so later stages can modify it safely
+            return copy.deepcopy(call.result)
+
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+            return result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                # Waiters copy a snapshot taken before the leader's caller can modify the result
+                call.result = copy.deepcopy(result)
+                print(f"Shared one {key[0]} extraction with {call.waiters} duplicate request(s)")
+            call.done.set()
+
+
+_flights = SingleFlight()
+
+
+def coalesce_by_text(stage: str):
+    """Decorate a stage extraction function taking an `extracted_data` dict.
+
+    Calls are keyed by the stage name, the hash of `extracted_data["text"]` and
+    any other simple arguments (such as a retry counter), so retries never
+    wait on themselves.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            extracted_data = next((arg for arg in args if isinstance(arg, dict)), None)
+            if extracted_data is None:
+                return fn(*args, **kwargs)
+
+            extra_args = tuple(
+                arg for arg in args
+                if isinstance(arg, (str, int, float, bool))
+            )
+            key = (
+                stage,
+                text_hash(extracted_data.get("text", "")),
+                extra_args,
+                tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+            )
+            return _flights.do(key, fn, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,65 @@
+import json
+import os
+
+from dedup_index import NearDuplicateIndex, reuse_near_duplicate
+from field_definitions import FIELD_GROUPS
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "imagesdemo_erl.json")
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for NearDuplicateIndex."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find(self, query):
+        bands = set(query["bands"]["$in"])
+        return [dict(doc) for doc in self.documents.values()
+                if doc["stage"] == query["stage"] and bands & set(doc["bands"])]
+
+    def update_one(self, query, update, upsert=False):
+        self.documents.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+
+def extraction(apn: str):
+    result = {field: {"value": "", "confidence": 0, "flags": ["FIELD_NOT_FOUND"]} for field in FIELD_GROUPS}
+    result["APN_AIN"] = {"value": apn, "confidence": 95, "flags": ["NO_FLAGS"]}
+    result["Legal_Type"] = {"value": "DO", "confidence": 95, "flags": ["NO_FLAGS"]}
+    return result
+
+
+def test_form_identical_documents_for_different_parcels_do_not_share_apn():
+    with open(SAMPLE_PATH, encoding="utf-8") as f:
+        text = json.load(f)[0]["ocr_full_text"]
+    other_parcel = (text.replace("256-560-450-000", "118-220-031-000")
+                    .replace("2024-117569", "2024-117601")
+                    .replace("154611-010881", "154611-010912"))
+
+    index = NearDuplicateIndex(MemoryCollection())
+    index.add("legal", "first", text, extraction("256-560-450-000"))
+    match = index.find("legal", other_parcel)
+    assert match is not None and not match["same_identifiers"]
+
+    result = reuse_near_duplicate("legal", match, FIELD_GROUPS,
+                                  lambda fields: {field: extraction("118-220-031-000")[field] for field in fields})
+    assert result["APN_AIN"]["value"] == "118-220-031-000"
+    assert "NEAR_DUPLICATE_REUSED" not in result["APN_AIN"]["flags"]
+    assert "NEAR_DUPLICATE_REUSED" not in result["Legal_Type"]["flags"]
+
+
+def test_rescan_reuses_identifier_fields():
+    with open(SAMPLE_PATH, encoding="utf-8") as f:
+        text = json.load(f)[0]["ocr_full_text"]
+
+    index = NearDuplicateIndex(MemoryCollection())
+    index.add("legal", "first", text, extraction("256-560-450-000"))
+    match = index.find("legal", text + " ")
+    assert match["same_identifiers"]
+
+    result = reuse_near_duplicate("legal", match, FIELD_GROUPS, lambda fields: {field: {} for field in fields})
+    assert result["APN_AIN"]["value"] == "256-560-450-000"
+    assert "NEAR_DUPLICATE_REUSED" in result["APN_AIN"]["flags"]
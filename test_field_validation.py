@@ -0,0 +1,58 @@
+from field_definitions import FIELD_INSTRUCTIONS
+from field_validation import (FORMAT_FLAG, VIOLATION_CONFIDENCE, FieldValidator, code_list_pattern, format_codes,
+                              prompt_codes)
+
+# Code lines laid out as in config.SYSTEM_PROMPT
+PROMPT = """DOCUMENT TYPE STANDARDIZATION:
+1. Legal Document Types and Requirements:
+   DO = DEED OF TRUST
+       Required: APN, Document Number
+
+   GD = GRANT DEED
+       Required: APN or Map Reference, Document Number
+
+   QC = QUITCLAIM DEED
+       Required: APN or Map Reference, Document Number
+
+2. Format Standards:
+   Document Numbers:
+   ✓ DOC-YYYY-XXXXXXX-XX
+"""
+
+
+def legal_validator():
+    codes = prompt_codes(PROMPT) + format_codes(FIELD_INSTRUCTIONS["Legal_Type"]["format"])
+    return FieldValidator(FIELD_INSTRUCTIONS, {"Legal_Type": code_list_pattern(codes)})
+
+
+def legal_type(value):
+    return {"Legal_Type": {"value": value, "confidence": 95, "flags": ["NO_FLAGS"]}}
+
+
+def test_prompt_codes_reads_code_lines_only():
+    assert prompt_codes(PROMPT) == ["DO", "GD", "QC"]
+
+
+def test_grant_and_quitclaim_deeds_keep_their_confidence():
+    results = [legal_type("GD"), legal_type("QC"), legal_type("DO/GD")]
+    assert legal_validator().validate_batch(results) == 0
+    for result in results:
+        assert result["Legal_Type"] == {"value": result["Legal_Type"]["value"], "confidence": 95,
+                                        "flags": ["NO_FLAGS"]}
+
+
+def test_format_codes_are_still_allowed():
+    result = legal_type("BMP")
+    assert legal_validator().validate(result) == 0
+
+
+def test_unknown_code_is_flagged_and_capped():
+    result = legal_type("XX")
+    assert legal_validator().validate(result) == 1
+    assert result["Legal_Type"]["flags"] == [FORMAT_FLAG]
+    assert result["Legal_Type"]["confidence"] == VIOLATION_CONFIDENCE
+
+
+def test_format_alone_rejects_prompt_codes():
+    result = legal_type("GD")
+    assert FieldValidator(FIELD_INSTRUCTIONS).validate(result) == 1
@@ -0,0 +1,92 @@
+from journal import OutputJournal, compact_output, prompt_version
+
+
+def test_reopened_journal_resumes_each_document_at_its_last_state(tmp_path):
+    journal = OutputJournal("legal", "v1", str(tmp_path))
+    journal.record("doc1", "result", {"output_line": "a.TIF|B1|1"})
+    journal.record("doc1", "written", {"output_line": "a.TIF|B1|1"})
+    journal.record("doc2", "result", {"output_line": "b.TIF|B1|2"})
+    journal.record("doc3", "result", {"output_line": "c.TIF|B1|3"})
+    journal.record("doc3", "written", {"output_line": "c.TIF|B1|3"})
+    journal.record("doc3", "done")
+    journal.close()
+
+    reopened = OutputJournal("legal", "v1", str(tmp_path))
+    try:
+        assert reopened.state("doc1") == "written"
+        assert reopened.get("doc1")["payload"] == {"output_line": "a.TIF|B1|1"}
+        assert reopened.state("doc2") == "result"
+        assert reopened.state("doc3") == "done"
+        assert reopened.state("doc4") is None
+    finally:
+        reopened.close()
+
+
+def test_new_prompt_version_does_not_match_old_entries(tmp_path):
+    journal = OutputJournal("legal", prompt_version("prompt", "tool"), str(tmp_path))
+    journal.record("doc1", "done")
+    journal.close()
+
+    changed = OutputJournal("legal", prompt_version("changed prompt", "tool"), str(tmp_path))
+    try:
+        assert changed.state("doc1") is None
+    finally:
+        changed.close()
+
+
+def test_torn_last_line_is_skipped_and_terminated(tmp_path):
+    journal = OutputJournal("legal", "v1", str(tmp_path))
+    journal.record("doc1", "result", {"output_line": "a.TIF|B1|1"})
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"id": "doc2", "v": "v1", "sta')
+
+    reopened = OutputJournal("legal", "v1", str(tmp_path))
+    try:
+        assert reopened.state("doc2") is None
+        reopened.record("doc2", "result", {"output_line": "b.TIF|B1|2"})
+    finally:
+        reopened.close()
+
+    again = OutputJournal("legal", "v1", str(tmp_path))
+    try:
+        assert again.state("doc1") == "result"
+        assert again.state("doc2") == "result"
+    finally:
+        again.close()
+
+
+def test_journal_is_compacted_on_open(tmp_path):
+    journal = OutputJournal("legal", "v1", str(tmp_path))
+    for state in ("result", "written", "done"):
+        journal.record("doc1", state)
+    journal.record("doc2", "result")
+    journal.close()
+    old = OutputJournal("legal", "v0", str(tmp_path))
+    old.record("doc3", "done")
+    old.close()
+
+    reopened = OutputJournal("legal", "v1", str(tmp_path))
+    reopened.close()
+    with open(reopened.path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 5
+
+    # More than JOURNAL_COMPACT_RATIO records per key: rewritten with the current version's keys
+    for _ in range(10):
+        reopened = OutputJournal("legal", "v1", str(tmp_path))
+        reopened.record("doc1", "done")
+        reopened.close()
+    compacted = OutputJournal("legal", "v1", str(tmp_path))
+    try:
+        assert compacted.state("doc1") == "done" and compacted.state("doc2") == "result"
+    finally:
+        compacted.close()
+    with open(compacted.path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+
+
+def test_compact_output_keeps_the_last_line_per_image(tmp_path):
+    path = tmp_path / "B1_Legal.txt"
+    path.write_text("BatchName|ImageName|Value\nB1|a.TIF|1\nB1|b.TIF|2\nB1|a.TIF|3\n", encoding="utf-8")
+    assert compact_output(str(path)) == 1
+    assert path.read_text(encoding="utf-8") == "BatchName|ImageName|Value\nB1|b.TIF|2\nB1|a.TIF|3\n"
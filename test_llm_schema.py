@@ -0,0 +1,51 @@
+import pytest
+
+from llm_schema import compile_batch_decoder, compile_compact_decoder
+
+FIELDS = ["APN_AIN", "Legal_Type", "LotNumber"]
+
+
+def test_entries_are_decoded_by_index_and_omitted_fields_are_missing():
+    decode = compile_compact_decoder(FIELDS, missing_value="NONE")
+    result = decode({"f": [[1, "gd", "H"], [0, "123-456-789", "m", "partial_apn"]]})
+    assert result["APN_AIN"] == {"value": "123-456-789", "confidence": 80, "flags": ["PARTIAL_APN"]}
+    assert result["Legal_Type"] == {"value": "GD", "confidence": 95, "flags": ["NO_FLAGS"]}
+    assert result["LotNumber"] == {"value": "NONE", "confidence": 0, "flags": ["FIELD_NOT_FOUND"]}
+
+
+def test_empty_value_and_unknown_confidence_code():
+    decode = compile_compact_decoder(FIELDS)
+    result = decode({"f": [[2, "", "X"]]})
+    assert result["LotNumber"] == {"value": "", "confidence": 0, "flags": ["NO_FLAGS"]}
+
+
+def test_empty_payload_decodes_to_all_missing():
+    result = compile_compact_decoder(FIELDS)({})
+    assert [result[field]["flags"] for field in FIELDS] == [["FIELD_NOT_FOUND"]] * 3
+
+
+@pytest.mark.parametrize("payload", [
+    {"f": [[3, "X", "H"]]},
+    {"f": [[-1, "X", "H"]]},
+    {"f": [["one", "X", "H"]]},
+    {"f": [[0, "X"]]},
+    {"f": ["0|X|H"]},
+    {"f": "0,X,H"},
+    [],
+])
+def test_invalid_payloads_raise_value_error(payload):
+    with pytest.raises(ValueError):
+        compile_compact_decoder(FIELDS)(payload)
+
+
+def test_batch_decoder_leaves_skipped_documents_as_none():
+    decode_batch = compile_batch_decoder(FIELDS)
+    results = decode_batch({"d": [{"doc": 2, "f": [[0, "1", "H"]]}, {"doc": 0, "f": []}]}, 3)
+    assert results[1] is None
+    assert results[0]["APN_AIN"]["flags"] == ["FIELD_NOT_FOUND"]
+    assert results[2]["APN_AIN"]["value"] == "1"
+
+
+def test_batch_decoder_rejects_out_of_range_documents():
+    with pytest.raises(ValueError):
+        compile_batch_decoder(FIELDS)({"d": [{"doc": 3, "f": []}]}, 3)
@@ -0,0 +1,83 @@
+import os
+
+from output_index import OutputIndex, lookup
+
+HEADER = "ImageName|BatchName|Value\n"
+
+
+def write_rows(path, rows):
+    """Append rows the way the output writer does and index them."""
+    new = not os.path.exists(path)
+    index = OutputIndex.open(path) if not new else None
+    with open(path, "a", encoding="utf-8") as f:
+        if new:
+            f.write(HEADER)
+            f.flush()
+            index = OutputIndex.open(path)
+        for row in rows:
+            offset = f.tell()
+            f.write(row + "\n")
+            f.flush()
+            index.put(row.split("|", 1)[0], offset, f.tell() - offset, f.tell())
+    index.close()
+
+
+def test_lookup_returns_the_latest_row(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    write_rows(path, ["a.TIF|B1|1", "b.TIF|B1|2", "a.TIF|B1|3"])
+    assert lookup(path, "a.TIF") == "a.TIF|B1|3"
+    assert lookup(path, "b.TIF") == "b.TIF|B1|2"
+    assert lookup(path, "c.TIF") is None
+
+
+def test_missing_index_is_built_on_lookup(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HEADER + "a.TIF|B1|1\na.TIF|B1|2\n")
+    assert lookup(path, "a.TIF") == "a.TIF|B1|2"
+    assert os.path.exists(path + ".idx")
+
+
+def test_stale_index_is_rebuilt_on_open(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    write_rows(path, ["a.TIF|B1|1"])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("b.TIF|B1|2\n")
+    index = OutputIndex.open(path)
+    try:
+        assert index.live == 2
+        assert index.data_size == os.path.getsize(path)
+    finally:
+        index.close()
+    assert lookup(path, "b.TIF") == "b.TIF|B1|2"
+
+
+def test_compact_keeps_live_rows_only(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    write_rows(path, ["a.TIF|B1|1", "b.TIF|B1|2", "a.TIF|B1|3", "c.TIF|B1|4"])
+    index = OutputIndex.open(path)
+    try:
+        assert index.dead_bytes == len("a.TIF|B1|1\n")
+        assert index.tombstone("c.TIF")
+        assert not index.tombstone("c.TIF")
+        assert index.compact() == len("a.TIF|B1|1\n") + len("c.TIF|B1|4\n")
+        assert index.dead_bytes == 0 and index.live == 2
+    finally:
+        index.close()
+
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == HEADER + "b.TIF|B1|2\na.TIF|B1|3\n"
+    assert lookup(path, "a.TIF") == "a.TIF|B1|3"
+    assert lookup(path, "c.TIF") is None
+
+
+def test_index_grows_past_its_load_limit(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    write_rows(path, [f"{number}.TIF|B1|{number}" for number in range(1000)])
+    index = OutputIndex.open(path)
+    try:
+        assert index.slot_count > 1024
+        assert index.live == 1000
+    finally:
+        index.close()
+    assert lookup(path, "999.TIF") == "999.TIF|B1|999"
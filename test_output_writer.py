@@ -0,0 +1,46 @@
+import os
+
+from output_index import lookup
+from output_writer import OutputWriter
+
+HEADER = "ImageName|BatchName|Value"
+
+
+def test_header_is_written_once_and_blocks_are_split_into_rows(tmp_path):
+    path = str(tmp_path / "B1" / "B1_Legal.txt")
+    writer = OutputWriter(fsync_interval=0.05)
+    try:
+        writer.write(path, HEADER, "a.TIF|B1|1").result(timeout=5)
+        writer.write(path, HEADER, "b.TIF|B1|2\nc.TIF|B1|3").result(timeout=5)
+    finally:
+        writer.close()
+
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == HEADER + "\na.TIF|B1|1\nb.TIF|B1|2\nc.TIF|B1|3\n"
+    assert lookup(path, "c.TIF") == "c.TIF|B1|3"
+
+
+def test_existing_file_keeps_its_header(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HEADER + "\na.TIF|B1|1\n")
+    writer = OutputWriter(fsync_interval=0.05)
+    try:
+        writer.write(path, HEADER, "a.TIF|B1|2").result(timeout=5)
+    finally:
+        writer.close()
+
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == HEADER + "\na.TIF|B1|1\na.TIF|B1|2\n"
+    assert lookup(path, "a.TIF") == "a.TIF|B1|2"
+
+
+def test_failed_write_fails_its_future(tmp_path):
+    path = str(tmp_path / "B1_Legal.txt")
+    os.makedirs(path)
+    writer = OutputWriter(fsync_interval=0.05)
+    try:
+        done = writer.write(path, HEADER, "a.TIF|B1|1")
+        assert done.exception(timeout=5) is not None
+    finally:
+        writer.close()
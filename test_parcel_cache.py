@@ -0,0 +1,113 @@
+import time
+
+from parcel_cache import CACHE_FLAG, ParcelCache, normalize_apn, reuse_parcel
+
+_MISSING = object()
+
+
+def resolve(doc, path):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def evaluate(expression, doc):
+    """The aggregation expressions ParcelCache.put uses, evaluated against `doc`."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return resolve(doc, expression[1:])
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        operator, argument = next(iter(expression.items()))
+        if operator == "$literal":
+            return argument
+        if operator == "$type":
+            return "missing" if evaluate(argument, doc) is _MISSING else "object"
+        if operator == "$ne":
+            left, right = (evaluate(item, doc) for item in argument)
+            return left != right
+        if operator == "$and":
+            return all(evaluate(item, doc) for item in argument)
+        if operator == "$or":
+            return any(evaluate(item, doc) for item in argument)
+    return {key: evaluate(value, doc) for key, value in expression.items()}
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for ParcelCache, pipeline updates included."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def find_one(self, query, projection=None):
+        return self.documents.get(query["_id"])
+
+    def find_one_and_update(self, query, pipeline, projection=None, upsert=False, return_document=None):
+        doc = self.documents.get(query["_id"], {"_id": query["_id"]})
+        for stage in pipeline:
+            doc = {**doc, **{field: evaluate(value, doc) for field, value in stage["$set"].items()}}
+        self.documents[query["_id"]] = doc
+        return doc
+
+
+FIELDS = ["APN_AIN", "LotNumber", "Block"]
+
+
+def extraction(lot, confidence=95, flags=("NO_FLAGS",)):
+    return {"APN_AIN": {"value": "123-456-789", "confidence": confidence, "flags": list(flags)},
+            "LotNumber": {"value": lot, "confidence": confidence, "flags": list(flags)},
+            "Block": {"value": "NONE", "confidence": 0, "flags": ["FIELD_NOT_FOUND"]}}
+
+
+def test_normalize_apn():
+    assert normalize_apn("123-456-789") == normalize_apn("123456789") == "123456789"
+    assert normalize_apn("12-3") is None
+    assert normalize_apn("NONE") is None
+
+
+def test_snapshot_is_served_until_it_expires():
+    collection = MemoryCollection()
+    cache = ParcelCache(collection)
+    assert cache.put("123456789", "legal", extraction("7"), FIELDS, doc_id=1)
+    assert cache.get("123456789", "legal") == {"APN_AIN": {"value": "123-456-789", "confidence": 95},
+                                               "LotNumber": {"value": "7", "confidence": 95},
+                                               "Block": {"value": "", "confidence": 0}}
+    assert cache.get("123456789", "property") is None
+    collection.documents["123456789"]["legal"]["updated_at"] = time.time() - 400 * 86400
+    assert cache.get("123456789", "legal") is None
+
+
+def test_untrustworthy_results_are_not_stored():
+    cache = ParcelCache(MemoryCollection())
+    assert not cache.put("123456789", "legal", extraction("7", confidence=80), FIELDS)
+    assert not cache.put("123456789", "legal", extraction("7"), FIELDS, required=["Block"])
+    assert not cache.put("123456789", "legal", extraction("7", flags=[CACHE_FLAG]), FIELDS)
+    assert cache.get("123456789", "legal") is None
+
+
+def test_disagreeing_snapshots_disable_the_parcel_until_they_agree():
+    cache = ParcelCache(MemoryCollection())
+    cache.put("123456789", "legal", extraction("7"), FIELDS, doc_id=1)
+    cache.put("123456789", "legal", extraction("8"), FIELDS, doc_id=2)
+    assert cache.get("123456789", "legal") is None
+    cache.put("123456789", "legal", extraction("8"), FIELDS, doc_id=3)
+    assert cache.get("123456789", "legal")["LotNumber"]["value"] == "8"
+
+
+def test_reuse_parcel_extracts_only_fields_the_snapshot_lacks():
+    asked = []
+
+    def extract_fields(fields):
+        asked.extend(fields)
+        return {"Legal_Type": {"value": "GD", "confidence": 95, "flags": ["NO_FLAGS"]}}
+
+    cached = {"APN_AIN": {"value": "123-456-789", "confidence": 95}, "Block": {"value": "", "confidence": 0}}
+    result = reuse_parcel(cached, ["APN_AIN", "Block", "Legal_Type", "LotNumber"], "NONE", extract_fields)
+    assert asked == ["Legal_Type", "LotNumber"]
+    assert result["APN_AIN"]["flags"] == [CACHE_FLAG]
+    assert result["Block"]["value"] == "NONE" and result["Block"]["flags"] == ["FIELD_NOT_FOUND", CACHE_FLAG]
+    assert result["Legal_Type"]["value"] == "GD"
+    assert result["LotNumber"]["flags"] == ["FIELD_NOT_FOUND"]
@@ -0,0 +1,73 @@
+from payload_store import PayloadStore
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for PayloadStore."""
+
+    def __init__(self):
+        self.documents = {}
+        self.reads = 0
+
+    def update_one(self, query, update, upsert=False):
+        doc = self.documents.get(query["_id"])
+        if doc is None:
+            doc = self.documents[query["_id"]] = {"_id": query["_id"], **update.get("$setOnInsert", {})}
+        for path, value in update.get("$set", {}).items():
+            *parents, field = path.split(".")
+            target = doc
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[field] = value
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+    def find_one(self, query):
+        self.reads += 1
+        return self.documents.get(query["_id"])
+
+
+OCR_TEXT = "GRANT DEED " * 500
+
+
+def test_identical_values_are_stored_once_and_read_back():
+    payloads = MemoryCollection()
+    store = PayloadStore(payloads)
+    digest = store.put(OCR_TEXT)
+    assert store.put(OCR_TEXT) == digest
+    assert len(payloads.documents) == 1
+    assert payloads.documents[digest]["size"] > len(payloads.documents[digest]["data"])
+
+    # A fresh store has nothing cached and reads the compressed copy
+    assert PayloadStore(payloads).get(digest) == OCR_TEXT
+    assert payloads.reads == 1
+
+
+def test_offload_update_references_stage_fields_only():
+    store = PayloadStore(MemoryCollection())
+    update = store.offload_update({"status": "legalpassed", "processed_data": {"APN_AIN": {"value": "1"}},
+                                   "propertydata": None})
+    digest = update["$set"]["payload_refs.processed_data"]
+    assert update["$set"]["status"] == "legalpassed"
+    assert update["$set"]["propertydata"] is None
+    assert update["$unset"] == {"processed_data": ""}
+    assert store.get(digest) == {"APN_AIN": {"value": "1"}}
+
+
+def test_slimmed_document_reads_through_lazy_wrapper():
+    queue, payloads = MemoryCollection(), MemoryCollection()
+    store = PayloadStore(payloads)
+    queue.documents[1] = {"_id": 1, "filename": "a.TIF", "ocr_full_text": OCR_TEXT, "status": "ocrpassed"}
+    assert store.slim_document(queue, queue.documents[1])
+    assert not store.slim_document(queue, queue.documents[1])
+
+    slimmed = queue.documents[1]
+    assert "ocr_full_text" not in slimmed
+    doc = PayloadStore(payloads).lazy(slimmed)
+    assert doc["ocr_full_text"] == OCR_TEXT
+    assert doc.get("ocr_text") is None
+    assert set(doc) == {"_id", "filename", "status", "payload_refs", "ocr_full_text"}
+
+    doc["status"] = "legalpassed"
+    del doc["ocr_full_text"]
+    assert "ocr_full_text" not in doc
+    assert slimmed["status"] == "ocrpassed"
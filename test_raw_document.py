@@ -0,0 +1,66 @@
+import bson
+from bson.codec_options import CodecOptions
+
+from raw_document import LazyBSONDocument, raw_collection
+
+DOCUMENTS = [
+    {"_id": 1, "filename": "a.TIF", "cat_name": "06107-20241205-01",
+     "json_data": {"pages": [{"text": "GRANT DEED"}]}, "status": "mailingpassed"},
+    {"_id": 2, "filename": "b.TIF", "cat_name": "06107-20241205-01",
+     "json_data": {"pages": []}, "status": "mailingpassed"},
+    {"_id": 3, "filename": "c.TIF", "cat_name": "06107-20241205-02", "status": "mailingpassed"},
+]
+
+
+class RawBatchCursor:
+    """Batches of documents laid end to end, as find_raw_batches returns them."""
+
+    def __init__(self, documents, batch_size=2):
+        self.documents = documents
+        self.batch_size = batch_size
+        self.closed = False
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        for start in range(0, len(self.documents), self.batch_size):
+            yield b"".join(bson.encode(doc) for doc in self.documents[start:start + self.batch_size])
+
+
+class RawBatchCollection:
+    """Just enough of a pymongo collection for raw_collection."""
+
+    codec_options = CodecOptions()
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find_raw_batches(self, query=None, **kwargs):
+        query = query or {}
+        return RawBatchCursor([doc for doc in self.documents
+                               if all(doc.get(key) == value for key, value in query.items())])
+
+
+def test_find_yields_lazy_documents_decoded_on_access():
+    docs = list(raw_collection(RawBatchCollection(DOCUMENTS)).find({"status": "mailingpassed"}))
+
+    assert [type(doc) for doc in docs] == [LazyBSONDocument] * 3
+    assert all(doc.decoded_fields() == [] for doc in docs)
+
+    assert docs[0]["filename"] == "a.TIF"
+    assert docs[0]["json_data"] == {"pages": [{"text": "GRANT DEED"}]}
+    assert type(docs[0]["json_data"]) is dict
+    assert docs[0].decoded_fields() == ["filename", "json_data"]
+    assert docs[2].get("json_data") is None
+
+
+def test_limit_and_close_reach_the_raw_cursor():
+    cursor = raw_collection(RawBatchCollection(DOCUMENTS)).find().limit(2)
+    assert [doc["_id"] for doc in cursor] == [1, 2]
+    cursor.close()
+    assert cursor._cursor.closed
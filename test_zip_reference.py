@@ -0,0 +1,58 @@
+from zip_reference import CENTROID_CONFIDENCE, REFERENCE_CONFIDENCE, ZipReference, build_reference, reconcile_address
+
+SOURCE = """zip,city,state,latitude,longitude
+92501,Riverside,CA,33.980600,-117.375500
+10001,New York,NY,40.750600,-73.997200
+2108,Boston,MA,42.357800,-71.063500
+"""
+
+
+def reference(tmp_path):
+    source = tmp_path / "zip_reference.csv"
+    source.write_text(SOURCE, encoding="utf-8")
+    path = str(tmp_path / "zip_reference.bin")
+    assert build_reference(str(source), path) == 3
+    return ZipReference(path)
+
+
+def entry(value, confidence=95):
+    return {"value": value, "confidence": confidence, "flags": ["NO_FLAGS"]}
+
+
+def missing():
+    return {"value": "NONE", "confidence": 0, "flags": ["FIELD_NOT_FOUND"]}
+
+
+def test_lookup_pads_short_zips_and_ignores_plus_four(tmp_path):
+    zips = reference(tmp_path)
+    assert zips.lookup("02108").city == "BOSTON"
+    assert zips.lookup("92501-1234").state == "CA"
+    assert zips.lookup("99999") is None
+
+
+def test_fills_missing_fields_and_keeps_centroids_below_high(tmp_path):
+    data = {"Zip": entry("92501-1234"), "Zip_4": missing(), "State": missing(), "City": missing(),
+            "Latitude": missing(), "Longitude": missing()}
+    assert reconcile_address(data, reference(tmp_path))
+    assert data["City"]["value"] == "RIVERSIDE" and data["City"]["confidence"] == REFERENCE_CONFIDENCE
+    assert data["State"]["value"] == "CA"
+    assert data["Zip_4"]["value"] == "1234"
+    # Coordinates are stored as float32
+    assert abs(float(data["Latitude"]["value"]) - 33.9806) < 1e-4
+    assert data["Latitude"]["confidence"] == CENTROID_CONFIDENCE < 90
+    assert data["Longitude"]["flags"] == ["ZIP_CENTROID"]
+
+
+def test_state_mismatch_leaves_city_and_coordinates_unfilled(tmp_path):
+    data = {"Zip": entry("10001"), "State": entry("CA"), "City": missing(), "Latitude": missing()}
+    assert reconcile_address(data, reference(tmp_path))
+    assert "ZIP_STATE_MISMATCH" in data["State"]["flags"]
+    assert data["City"]["value"] == "NONE"
+    assert data["Latitude"]["value"] == "NONE"
+
+
+def test_unknown_zip_is_flagged(tmp_path):
+    data = {"Zip": entry("99999")}
+    assert reconcile_address(data, reference(tmp_path))
+    assert data["Zip"]["flags"] == ["ZIP_NOT_IN_REFERENCE"]
+    assert data["Zip"]["confidence"] == 50
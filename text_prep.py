@@ -0,0 +1,158 @@
+"""OCR text preparation before prompting.
+
+Documents carry the same text up to three times (`ocr_text`, `ocr_full_text`,
+`json_data.paragraphs`) and much of it is statutory boilerplate such as the
+SB2 fee exemption cover sheet. `prepare_document_text` merges the sources
+once, collapses whitespace and strips known boilerplate phrases so every
+stage sends fewer input tokens.
+
+The phrase dictionary starts from BOILERPLATE_PHRASES and can be extended
+from a corpus with `learn_boilerplate`, which keeps sentences that recur in a
+large share of documents and saves them to BOILERPLATE_PATH.
+"""
+import json
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+BOILERPLATE_PATH = os.getenv("BOILERPLATE_PATH", "boilerplate_phrases.json")
+
+# Learned phrases must recur in this share of documents and be this long
+MIN_DOC_FRACTION = 0.2
+MIN_DOC_COUNT = 5
+MIN_PHRASE_LENGTH = 40
+
+# Rough characters-per-token ratio used for the savings report
+CHARS_PER_TOKEN = 4
+
+BOILERPLATE_PHRASES = [
+    "Pursuant to Senate Bill 2 - Building Homes and Jobs Act (GC Code Section 27388.1), "
+    "effective January 1, 2018, a fee of seventy-five dollars ($75.00) shall be paid at the "
+    "time of recording of every real estate instrument, paper, or notice required or permitted "
+    "by law to be recorded, except those expressly exempted from payment of recording fees, per "
+    "each single transaction per parcel of real property.",
+    "The fee imposed by this section shall not exceed two hundred twenty-five dollars ($225.00).",
+    "Exempt from fee per GC 27388.1 (a) (2); recorded concurrently \"in connection with\" a "
+    "transfer subject to the imposition of documentary transfer tax (DTT).",
+    "Exempt from fee per GC 27388.1 (a) (2); recorded concurrently \"in connection with\" a "
+    "transfer of real property that is a residential dwelling to an owner-occupier.",
+    "Exempt from fee per GC 27388.1 (a) (1); fee cap of $225.00 reached.",
+    "Exempt from the fee per GC 27388.1 (a) (1); not related to real property.",
+    "THIS COVER SHEET ADDED TO PROVIDE ADEQUATE SPACE FOR RECORDING INFORMATION "
+    "($3.00 Additional Recording Fee Applies)",
+]
+
+_WHITESPACE = re.compile(r"\s+")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?;])\s+(?=[A-Z\"(])")
+_boilerplate_pattern = None
+
+
+def collapse_whitespace(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _as_text(value) -> str:
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value if item)
+    if isinstance(value, dict):
+        return str(value.get("text", ""))
+    return str(value) if value else ""
+
+
+def collect_sources(doc: Dict) -> List[str]:
+    """Return the distinct OCR texts of a document, longest first.
+
+    A source is dropped when its whitespace-collapsed text is contained in
+    one already kept, which removes the usual triple copy.
+    """
+    candidates = [
+        doc.get("ocr_text"),
+        doc.get("ocr_full_text"),
+        (doc.get("json_data") or {}).get("paragraphs"),
+        doc.get("ocr_output"),
+    ]
+    texts = sorted({collapse_whitespace(_as_text(value)) for value in candidates} - {""},
+                   key=len, reverse=True)
+
+    kept = []
+    for text in texts:
+        if not any(text in existing for existing in kept):
+            kept.append(text)
+    return kept
+
+
+def _phrase_regex(phrase: str) -> str:
+    return r"\s*".join(re.escape(part) for part in collapse_whitespace(phrase).split(" "))
+
+
+def load_boilerplate(path: str = BOILERPLATE_PATH) -> List[str]:
+    """Seed phrases plus any learned phrases saved at `path`."""
+    phrases = list(BOILERPLATE_PHRASES)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            phrases.extend(json.load(f))
+    return phrases
+
+
+def boilerplate_pattern():
+    """Compiled alternation of all boilerplate phrases, built on first use."""
+    global _boilerplate_pattern
+    if _boilerplate_pattern is None:
+        phrases = sorted(set(load_boilerplate()), key=len, reverse=True)
+        _boilerplate_pattern = re.compile("|".join(_phrase_regex(p) for p in phrases), re.IGNORECASE)
+    return _boilerplate_pattern
+
+
+def strip_boilerplate(text: str) -> str:
+    return collapse_whitespace(boilerplate_pattern().sub(" ", text))
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def prepare_document_text(doc: Dict) -> Tuple[str, Dict]:
+    """Build the prompt text for a document and report the tokens saved.
+
+    :param doc: Mongo document with any of the OCR text fields
+    :return: (prepared text, stats dict with original/prepared/saved tokens)
+    """
+    original = _as_text(doc.get("ocr_text")) or _as_text(doc.get("ocr_full_text"))
+    prepared = strip_boilerplate(" ".join(collect_sources(doc)))
+
+    original_tokens = estimate_tokens(str(original))
+    prepared_tokens = estimate_tokens(prepared)
+    stats = {
+        "original_tokens": original_tokens,
+        "prepared_tokens": prepared_tokens,
+        "tokens_saved": max(0, original_tokens - prepared_tokens)
+    }
+    print(f"Text preparation for {doc.get('filename', doc.get('_id'))}: "
+          f"{original_tokens} -> {prepared_tokens} tokens ({stats['tokens_saved']} saved)")
+    return prepared, stats
+
+
+def learn_boilerplate(texts: Iterable[str], path: str = BOILERPLATE_PATH) -> List[str]:
+    """Learn recurring sentences from a corpus and save them to `path`.
+
+    :param texts: OCR texts, one per document
+    :return: The learned phrases
+    """
+    counts = Counter()
+    doc_count = 0
+    for text in texts:
+        doc_count += 1
+        sentences = {collapse_whitespace(s) for s in _SENTENCE_BREAK.split(collapse_whitespace(text))}
+        counts.update(s for s in sentences if len(s) >= MIN_PHRASE_LENGTH)
+
+    threshold = max(MIN_DOC_COUNT, doc_count * MIN_DOC_FRACTION)
+    learned = sorted(sentence for sentence, count in counts.items() if count >= threshold)
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(learned, f, indent=2)
+
+    global _boilerplate_pattern
+    _boilerplate_pattern = None
+    print(f"Learned {len(learned)} boilerplate phrases from {doc_count} documents")
+    return learned
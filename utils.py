@@ -1,20 +1,40 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from typing import List, Dict
 import fitz
 from PIL import Image
-from field_definitions import FIELD_GROUPS
-import multiprocessing
+from field_definitions import FIELD_GROUPS, FIELD_INSTRUCTIONS
+from field_validation import FieldValidator, code_list_pattern, format_codes, prompt_codes
+from dedup_index import reuse_near_duplicate
+from parcel_cache import LEGAL_PARCEL_FIELDS, parcel_key, reuse_parcel
+from document_type import complete_result, document_type_of, legal_fields_for, route_for, tag_legal_type
+from text_prep import prepare_document_text
+from concurrency import API_LIMITER
+from row_format import ColumnPlan, build_header
+from batch_merge import batch_name_of
+from config import SYSTEM_PROMPT
+from result_batch import ResultBatch
 
-# Number of worker threads (adjust based on your CPU)
-MAX_WORKERS = multiprocessing.cpu_count() * 2
+# Legal output columns; IsFromModel and XrefRemarks are left empty
+LEGAL_PLAN = ColumnPlan(
+    build_header(FIELD_GROUPS, ["IsFromModel", "XrefRemarks"]), FIELD_GROUPS,
+    {"IsFromModel": "", "XrefRemarks": ""}
+)
 
-def process_document_batch(docs, processor, batch_name):
-    """Process a batch of documents in parallel."""
-    results = []
+# Legal_Type takes the document-type codes SYSTEM_PROMPT defines as well as its format's map codes
+LEGAL_TYPE_CODES = prompt_codes(SYSTEM_PROMPT)
+LEGAL_VALIDATOR = FieldValidator(FIELD_INSTRUCTIONS, {"Legal_Type": code_list_pattern(
+    LEGAL_TYPE_CODES + format_codes(FIELD_INSTRUCTIONS["Legal_Type"]["format"]))})
+
+# Worker threads mostly wait on Claude; API_LIMITER decides how many calls are in flight
+MAX_WORKERS = API_LIMITER.max_limit
+
+def process_document_batch(docs, processor, batch_name, dedup_index=None, parcel_cache=None) -> ResultBatch:
+    """Process a batch of documents in parallel into a columnar ResultBatch."""
+    results = ResultBatch(FIELD_GROUPS)
     
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         future_to_doc = {
-            executor.submit(process_single_document, doc, processor): doc 
+            executor.submit(process_single_document, doc, processor, dedup_index, parcel_cache): doc 
             for doc in docs
         }
         
@@ -28,15 +48,97 @@ def process_document_batch(docs, processor, batch_name):
     
     return results
 
-def process_single_document(doc, processor):
-    """Process a single document."""
-    ocr_text = doc.get('ocr_text', '')
-    extracted_data = {"text": str(ocr_text)}
-    processed_data = processor.post_process_with_llm(extracted_data)
+def process_document_stream(docs, processor, on_result, window: int = MAX_WORKERS, dedup_index=None,
+                            parcel_cache=None) -> int:
+    """Process documents from an iterable (e.g. a Mongo cursor) with at most `window` in flight.
+
+    Documents are pulled only as slots free up, and `on_result` is called in
+    this thread as each one completes, so memory stays flat on large backlogs
+    and results are written immediately.
+    :return: Number of documents pulled from `docs`
+    """
+    pulled = 0
+    with ThreadPoolExecutor(max_workers=min(window, MAX_WORKERS)) as executor:
+        in_flight = {}
+        docs = iter(docs)
+        exhausted = False
+        
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < window:
+                doc = next(docs, None)
+                if doc is None:
+                    exhausted = True
+                    break
+                pulled += 1
+                in_flight[executor.submit(process_single_document, doc, processor, dedup_index, parcel_cache)] = doc
+            
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                doc = in_flight.pop(future)
+                try:
+                    on_result(future.result())
+                except Exception as e:
+                    print(f"Error processing document {doc['_id']}: {str(e)}")
+    
+    return pulled
+
+def process_single_document(doc, processor, dedup_index=None, parcel_cache=None, apn: str = None,
+                            document_type=None):
+    """Process a single document, reusing its parcel's cached fields or a near-duplicate's extraction.
+
+    :param apn: Normalized APN of the document; read from its APN stage result when not given
+    :param document_type: Classification of the document; read from the document when not given
+    """
+    ocr_text, _ = prepare_document_text(doc)
+    extracted_data = {"text": ocr_text}
+    if document_type is None:
+        document_type = document_type_of(doc, ocr_text)
+    # A code the legal prompt does not define stays on the document and Claude fills the field
+    tags_legal_type = document_type.confident and document_type.code in LEGAL_TYPE_CODES
+    legal_fields = legal_fields_for(document_type, tags_legal_type)
+
+    def extract_fields(fields):
+        return processor.post_process_with_llm(extracted_data, fields=fields)
+
+    if parcel_cache is not None and apn is None:
+        apn = parcel_key(doc.get("processeddata"))
+    cached = parcel_cache.get(apn, "legal") if parcel_cache is not None else None
+    near_duplicate = None
+    if cached is not None:
+        print(f"Document {doc['_id']} reuses the cached legal fields of parcel {apn}")
+        parcel_fields = {field: cached[field] for field in LEGAL_PARCEL_FIELDS if field in cached}
+        processed_data = reuse_parcel(parcel_fields, FIELD_GROUPS, extract_fields=extract_fields)
+    else:
+        near_duplicate = dedup_index.find("legal", ocr_text) if dedup_index is not None else None
+        if near_duplicate is not None:
+            print(f"Document {doc['_id']} is a near-duplicate of {near_duplicate['doc_id']} "
+                  f"(distance {near_duplicate['distance']})")
+            processed_data = reuse_near_duplicate("legal", near_duplicate, FIELD_GROUPS, extract_fields)
+        elif len(legal_fields) < len(FIELD_GROUPS):
+            # Only the fields this document type carries go to Claude
+            processed_data = complete_result(extract_fields(legal_fields), FIELD_GROUPS)
+        else:
+            processed_data = processor.post_process_with_llm(extracted_data)
+    if tags_legal_type:
+        tag_legal_type(processed_data, document_type)
+    LEGAL_VALIDATOR.validate(processed_data)
     
     image_name = doc.get('filename', 'unknown.TIF')
-    batch_name = doc.get('cat_name', '06107-20241205-01')
+    batch_name = batch_name_of(doc)
     image_header_id = "1"
+
+    extraction_failed = any(
+        "LLM_PROCESSING_ERROR" in (field_data.get("flags") or [])
+        for field_data in processed_data.values()
+    )
+    if dedup_index is not None and near_duplicate is None and cached is None and not extraction_failed:
+        dedup_index.add("legal", doc['_id'], ocr_text, processed_data, image_name, batch_name)
+    # A partial extraction would overwrite the parcel's full snapshot with NOT_APPLICABLE fields
+    if (parcel_cache is not None and cached is None and not extraction_failed
+            and route_for(document_type).legal_fields is None):
+        parcel_cache.put(apn, "legal", processed_data, LEGAL_PARCEL_FIELDS, doc['_id'])
     
     output_line = format_output(image_name, batch_name, image_header_id, processed_data)
     
@@ -45,7 +147,10 @@ def process_single_document(doc, processor):
         "output_line": output_line,
         "processed_data": processed_data,
         "image_name": image_name,
-        "batch_name": batch_name
+        "batch_name": batch_name,
+        "near_duplicate_of": near_duplicate["doc_id"] if near_duplicate is not None else None,
+        "plan": LEGAL_PLAN,
+        "row": (image_name, batch_name, image_header_id, processed_data)
     }
 process_single_document
 def convert_document_to_images(file_path: str) -> List[Image.Image]:
@@ -66,35 +171,11 @@ def convert_document_to_images(file_path: str) -> List[Image.Image]:
         raise ValueError("Unsupported file format. Please provide a TIFF file.")
 
 def format_output(image_name: str, batch_name: str, image_header_id: str, extracted_data: Dict) -> str:
-    output = f"{image_name}|{batch_name}|{image_header_id}"
-    
-    # Format field values
-    for field in FIELD_GROUPS:
-        field_data = extracted_data.get(field, {})
-        value = field_data.get("value", "") if isinstance(field_data, dict) else ""
-        value = str(value) if value is not None else ""
-        output += f"|{value}"
-    
-    # Format confidence levels
-    for field in FIELD_GROUPS:
-        field_data = extracted_data.get(field, {})
-        confidence = field_data.get("confidence", 0) if isinstance(field_data, dict) else 0
-        confidence_label = "HIGH" if confidence >= 90 else "LOW"
-        output += f"|{confidence_label}"
-    
-    # Add empty fields for IsFromModel and XrefRemarks
-    output += "||"
-    
-    return output
+    return LEGAL_PLAN.format_row(image_name, batch_name, image_header_id, extracted_data)
 
 def generate_header():
     """Generate the complete header schema."""
-    # Define field headers first
-    field_header = "|".join(FIELD_GROUPS)
-    confidence_header = "|".join([f"CL_{field}" for field in FIELD_GROUPS])
-    
-    # Combine into final header
-    header = f"ImageName|BatchName|ImageHeaderID|{field_header}|{confidence_header}|IsFromModel|XrefRemarks"
+    header = LEGAL_PLAN.header
     print("Generated Header:")
     print(header)
     return header 
\ No newline at end of file
@@ -0,0 +1,226 @@
+"""Offline ZIP reference index used to fill and verify address fields.
+
+The LLM either guesses City, State, Latitude and Longitude or returns NONE
+for them. A ZIP code pins most of them down, so the mailing and property
+stages check their results against a local reference before formatting.
+
+The source is a USPS/Census-style CSV (ZIP_REFERENCE_SOURCE) with the
+columns zip, city, state, latitude and longitude, one row per 5-digit ZIP.
+It is compiled once into a binary file (ZIP_REFERENCE_PATH) of fixed-width
+records sorted by ZIP. The binary file is memory-mapped and binary-searched.
+`get_zip_reference()` opens it on first use, compiling it when the CSV is
+newer, so a process pays the cost once and processes share the pages.
+The data is not shipped with the code; without it a warning is printed once
+and the check is skipped.
+
+Record layout: zip uint32, state 2 bytes, 2 pad bytes, latitude and
+longitude float32, city 28 bytes (the USPS city name limit), space-padded.
+"""
+import csv
+import mmap
+import os
+import re
+import struct
+import threading
+from typing import Mapping, NamedTuple, Optional
+
+from field_validation import MISSING_VALUES, VIOLATION_CONFIDENCE, merge_flags
+
+ZIP_REFERENCE_SOURCE = os.getenv("ZIP_REFERENCE_SOURCE", os.path.join("reference", "zip_reference.csv"))
+ZIP_REFERENCE_PATH = os.getenv("ZIP_REFERENCE_PATH", os.path.join("reference", "zip_reference.bin"))
+
+MAGIC = b"ZREF"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sII")
+RECORD = struct.Struct("<I2s2xff28s")
+ZIP_FIELD = struct.Struct("<I")
+
+# Confidence of a value taken from the reference
+REFERENCE_CONFIDENCE = 95
+# Confidence of a ZIP centroid coordinate: only near the address, so below HIGH_CONFIDENCE
+CENTROID_CONFIDENCE = 70
+
+# USPS state and territory codes
+STATE_CODES = frozenset(
+    "AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO MT NE NV NH NJ "
+    "NM NY NC ND OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY AS GU MP PR VI UM FM MH PW AA AE AP".split()
+)
+
+_ZIP = re.compile(r"(\d{5})(?:-?(\d{4}))?")
+
+
+class ZipPlace(NamedTuple):
+    zip: str
+    city: str
+    state: str
+    latitude: float
+    longitude: float
+
+
+def build_reference(source_path: str = ZIP_REFERENCE_SOURCE, path: str = ZIP_REFERENCE_PATH) -> int:
+    """Compile the reference CSV into the binary index.
+
+    :return: Number of ZIPs written
+    """
+    records = {}
+    with open(source_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            match = _ZIP.fullmatch(row["zip"].strip().zfill(5))
+            if not match:
+                continue
+            records[int(match.group(1))] = RECORD.pack(
+                int(match.group(1)),
+                row["state"].strip().upper().encode("ascii")[:2],
+                float(row["latitude"]), float(row["longitude"]),
+                row["city"].strip().upper().encode("utf-8")[:28].ljust(28)
+            )
+
+    partial = path + ".partial"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(partial, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records)))
+        for zip_code in sorted(records):
+            f.write(records[zip_code])
+    os.replace(partial, path)
+    print(f"Built ZIP reference {path} with {len(records)} ZIPs")
+    return len(records)
+
+
+class ZipReference:
+    def __init__(self, path: str = ZIP_REFERENCE_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Not a ZIP reference file: {path}")
+
+    def _zip_at(self, index: int) -> int:
+        return ZIP_FIELD.unpack_from(self._map, HEADER.size + index * RECORD.size)[0]
+
+    def lookup(self, zip_code) -> Optional[ZipPlace]:
+        """Place of a ZIP (the first five digits are used), or None."""
+        match = _ZIP.match(str(zip_code or "").strip())
+        if not match:
+            return None
+        target = int(match.group(1))
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._zip_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self._zip_at(low) != target:
+            return None
+        _, state, latitude, longitude, city = RECORD.unpack_from(self._map, HEADER.size + low * RECORD.size)
+        return ZipPlace(match.group(1), city.decode("utf-8").rstrip(), state.decode("ascii"),
+                        latitude, longitude)
+
+    def close(self):
+        self._map.close()
+
+
+_reference = None
+_reference_loaded = False
+_reference_lock = threading.Lock()
+
+
+def get_zip_reference() -> Optional[ZipReference]:
+    """Process-wide reference, opened (and compiled if stale) on first use; None without data."""
+    global _reference, _reference_loaded
+    if _reference_loaded:
+        return _reference
+    with _reference_lock:
+        if not _reference_loaded:
+            try:
+                if os.path.exists(ZIP_REFERENCE_SOURCE) and (
+                        not os.path.exists(ZIP_REFERENCE_PATH)
+                        or os.path.getmtime(ZIP_REFERENCE_SOURCE) > os.path.getmtime(ZIP_REFERENCE_PATH)):
+                    build_reference()
+                if os.path.exists(ZIP_REFERENCE_PATH):
+                    _reference = ZipReference(ZIP_REFERENCE_PATH)
+                else:
+                    print(f"WARNING: no ZIP reference data at {ZIP_REFERENCE_SOURCE} or {ZIP_REFERENCE_PATH}. "
+                          f"Provide a zip,city,state,latitude,longitude CSV (ZIP_REFERENCE_SOURCE) to fill and "
+                          f"check City, State, Zip_4 and coordinates; until then they are left as extracted")
+            except Exception as e:
+                print(f"Error loading ZIP reference: {str(e)}")
+            _reference_loaded = True
+    return _reference
+
+
+def _is_missing(entry) -> bool:
+    return entry is None or entry.get("value") is None or str(entry.get("value")) in MISSING_VALUES
+
+
+def _fill(entry, value: str, flag: str, confidence: int = REFERENCE_CONFIDENCE):
+    entry["value"] = value
+    entry["confidence"] = confidence
+    entry["flags"] = merge_flags([flag for flag in entry.get("flags") or [] if flag != "FIELD_NOT_FOUND"], [flag])
+
+
+def _flag(entry, flag: str, demote: bool = False):
+    entry["flags"] = merge_flags(entry.get("flags"), [flag])
+    if demote:
+        entry["confidence"] = min(entry.get("confidence") or 0, VIOLATION_CONFIDENCE)
+
+
+def reconcile_address(data: Mapping, reference: ZipReference = None) -> bool:
+    """Fill missing City/State/Zip_4/Latitude/Longitude from the ZIP and flag disagreements, in place.
+
+    When the ZIP's state disagrees with the extracted State, either could be
+    wrong, so City and the coordinates are left as extracted.
+    :return: False when there is no reference or no usable ZIP
+    """
+    reference = reference or get_zip_reference()
+    state = data.get("State")
+    if state is not None and not _is_missing(state) and str(state["value"]) not in STATE_CODES:
+        _flag(state, "INVALID_STATE", demote=True)
+
+    zip_entry = data.get("Zip")
+    if reference is None or _is_missing(zip_entry):
+        return False
+    match = _ZIP.fullmatch(str(zip_entry["value"]).strip())
+    if not match:
+        return False
+
+    place = reference.lookup(match.group(1))
+    if place is None:
+        _flag(zip_entry, "ZIP_NOT_IN_REFERENCE", demote=True)
+        return True
+
+    zip_4 = data.get("Zip_4")
+    if match.group(2) and zip_4 is not None and _is_missing(zip_4):
+        _fill(zip_4, match.group(2), "FILLED_FROM_ZIP")
+
+    if state is not None:
+        if _is_missing(state):
+            _fill(state, place.state, "FILLED_FROM_ZIP")
+        elif str(state["value"]) != place.state:
+            _flag(state, "ZIP_STATE_MISMATCH", demote=True)
+            _flag(zip_entry, "ZIP_STATE_MISMATCH", demote=True)
+            return True
+
+    city = data.get("City")
+    if city is not None:
+        if _is_missing(city):
+            _fill(city, place.city, "FILLED_FROM_ZIP")
+        elif str(city["value"]) != place.city:
+            # Many ZIPs have accepted alternate city names, so this is only flagged
+            _flag(city, "ZIP_CITY_MISMATCH")
+
+    for field, coordinate in (("Latitude", place.latitude), ("Longitude", place.longitude)):
+        entry = data.get(field)
+        if entry is not None and _is_missing(entry):
+            _fill(entry, f"{coordinate:.6f}", "ZIP_CENTROID", CENTROID_CONFIDENCE)
+    return True
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        build_reference(*sys.argv[2:4])
+    else:
+        print(get_zip_reference().lookup(sys.argv[1]) if get_zip_reference() else "No ZIP reference")